@@ -1,7 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 from typing import List, Optional
+import csv
+import io
 import os
 
 from api.auth import get_current_user
@@ -163,10 +166,13 @@ async def approve_payment(
         
         user_id = payment['user_id']
         
-        await conn.execute(
-            "UPDATE payments SET status='approved', admin_id=$1 WHERE id=$2",
-            admin['user_id'], data.payment_id
-        )
+        await conn.execute("""
+            WITH p AS (
+                UPDATE payments SET status='approved', admin_id=$1 WHERE id=$2 RETURNING id, user_id
+            )
+            INSERT INTO payment_events(payment_id, user_id, event, admin_id, created_at)
+            SELECT id, user_id, 'approved', $1, $3 FROM p
+        """, admin['user_id'], data.payment_id, int(datetime.utcnow().timestamp()))
         
         if len(data.group_ids) == 1:
             await conn.execute("""
@@ -195,10 +201,13 @@ async def reject_payment(
     """Reject payment"""
     db = await get_db()
     async with db.acquire() as conn:
-        await conn.execute(
-            "UPDATE payments SET status='rejected', admin_id=$1 WHERE id=$2",
-            admin['user_id'], data.payment_id
-        )
+        await conn.execute("""
+            WITH p AS (
+                UPDATE payments SET status='rejected', admin_id=$1 WHERE id=$2 RETURNING id, user_id
+            )
+            INSERT INTO payment_events(payment_id, user_id, event, admin_id, created_at)
+            SELECT id, user_id, 'rejected', $1, $3 FROM p
+        """, admin['user_id'], data.payment_id, int(datetime.utcnow().timestamp()))
     
     return {"success": True, "message": "Payment rejected"}
 
@@ -214,3 +223,75 @@ async def get_groups(admin: dict = Depends(require_admin)):
                 GROUP_IDS.append(int(x))
     
     return {"groups": [{"id": gid, "name": f"Group {gid}"} for gid in GROUP_IDS]}
+
+EXPORT_PREFETCH = int(os.getenv("EXPORT_PREFETCH", "500"))
+EXPORT_FLUSH_BYTES = 64 * 1024
+
+EXPORT_QUERIES = {
+    "subscribers": (
+        ["user_id", "username", "full_name", "phone", "group_id", "expires_at", "status"],
+        """
+        SELECT user_id, username, full_name, phone, group_id, expires_at
+        FROM subscriber_export
+        WHERE $1::BIGINT IS NULL OR group_id = $1
+        ORDER BY group_id, user_id
+        """,
+    ),
+    "payments": (
+        ["payment_id", "user_id", "username", "full_name", "phone", "group_id", "payment_type", "status", "created_at", "admin_id"],
+        """
+        SELECT p.id, p.user_id, u.username, u.full_name, u.phone, u.group_id,
+               COALESCE(p.payment_type, 'initial') AS payment_type, p.status, p.created_at, p.admin_id
+        FROM payments p
+        LEFT JOIN users u ON u.user_id = p.user_id
+        WHERE $1::BIGINT IS NULL
+           OR u.group_id = $1
+           OR EXISTS (SELECT 1 FROM user_groups ug WHERE ug.user_id = p.user_id AND ug.group_id = $1)
+        ORDER BY p.id
+        """,
+    ),
+}
+
+def _export_row(kind: str, row, now: int) -> list:
+    values = ["" if v is None else v for v in row.values()]
+    if kind == "subscribers":
+        expires_at = row['expires_at'] or 0
+        values.append("none" if not expires_at else ("active" if expires_at > now else "expired"))
+    return values
+
+async def _stream_export(kind: str, group_id: Optional[int]):
+    """Stream CSV rows from a server-side cursor in ~64 KB chunks"""
+    columns, sql = EXPORT_QUERIES[kind]
+    now = int(datetime.utcnow().timestamp())
+    buf = io.StringIO()
+    buf.write("\ufeff")
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    
+    db = await get_db()
+    async with db.acquire() as conn:
+        async with conn.transaction():
+            async for row in conn.cursor(sql, group_id, prefetch=EXPORT_PREFETCH):
+                writer.writerow(_export_row(kind, row, now))
+                if buf.tell() >= EXPORT_FLUSH_BYTES:
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+    yield buf.getvalue()
+
+@router.get("/export/{kind}")
+async def export_rows(
+    kind: str,
+    group_id: Optional[int] = None,
+    admin: dict = Depends(require_admin)
+):
+    """Download subscribers or payments as CSV"""
+    if kind not in EXPORT_QUERIES:
+        raise HTTPException(status_code=404, detail="Unknown export")
+    
+    filename = f"{kind}_{group_id}.csv" if group_id else f"{kind}.csv"
+    return StreamingResponse(
+        _stream_export(kind, group_id),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
@@ -92,9 +92,15 @@ async def submit_payment(
     db = await get_db()
     async with db.acquire() as conn:
         row = await conn.fetchrow("""
-            INSERT INTO payments(user_id, photo_file, status, created_at)
-            VALUES($1, $2, 'pending', $3)
-            RETURNING id
+            WITH p AS (
+                INSERT INTO payments(user_id, photo_file, status, created_at)
+                VALUES($1, $2, 'pending', $3)
+                RETURNING id, user_id, created_at
+            ), ev AS (
+                INSERT INTO payment_events(payment_id, user_id, event, created_at)
+                SELECT id, user_id, 'submitted', created_at FROM p
+            )
+            SELECT id FROM p
         """, current_user['user_id'], file_path, int(datetime.utcnow().timestamp()))
     
     return {
@@ -1,20 +1,32 @@
 import os
 import io
 import re
+import hmac
+import csv
+import signal
+import threading
 import asyncio
+import heapq
+import json
 import logging
+import time
+import tempfile
 from datetime import datetime, timedelta
 from typing import Optional
+from contextlib import asynccontextmanager, aclosing
+from concurrent.futures import ThreadPoolExecutor
 
 import asyncpg
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import (
     Message, CallbackQuery, ChatMemberUpdated,
     InlineKeyboardMarkup, InlineKeyboardButton,
     ReplyKeyboardMarkup, KeyboardButton, FSInputFile, BufferedInputFile,
-    WebAppInfo
+    WebAppInfo, Update
 )
 from aiogram.filters import Command
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
 from dotenv import load_dotenv
 
 logging.basicConfig(
@@ -106,19 +118,227 @@ dp = Dispatcher()
 # PostgreSQL connection pool
 db_pool: Optional[asyncpg.Pool] = None
 
-WAIT_DATE_FOR: dict[int, int] = {}
-MULTI_PICK: dict[int, dict] = {}
-WAIT_CONTACT_FOR: set[int] = set()
-WAIT_FULLNAME_FOR: set[int] = set()
-WAIT_CONTRACT_CONFIRM: set[int] = set()
-WAIT_CONTRACT_EDIT: set[int] = set()
-WAIT_PAYMENT_EDIT: set[int] = set()
-WAIT_PAYMENT_PHOTO: set[int] = set()
-WAIT_RENEWAL_RECEIPT: set[int] = set()
-NOT_PAID_COUNTER: dict[tuple[int, int], int] = {}
 # Admin xabarlarini kuzatish (payment_id -> [message_ids])
 ADMIN_MESSAGES: dict[int, list[int]] = {}
 
+# ==================== CONVERSATION STATE ====================
+# Suhbat holatlari (kutilayotgan sana, kontakt, chek va h.k.) bitta API orqali saqlanadi:
+# state_set / state_get / state_has / state_pop. Har bir yozuvning TTL'i bor.
+# STATE_BACKEND=memory - faqat xotira; STATE_BACKEND=postgres - conversation_state jadvali
+# manba, xotira esa uning keshi: o'zgarishlar fonda partiyalab yoziladi (write-behind),
+# to'lov/shartnoma qadamlari state_commit() bilan darhol yozadi. Har bir yozuv trigger
+# orqali NOTIFY yuboradi - boshqa replica'lar shu kalitni jadvaldan qayta o'qiydi.
+
+STATE_BACKEND = os.getenv("STATE_BACKEND", "postgres").strip().lower()  # memory | postgres
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "2"))  # soniya
+STATE_FLUSH_BATCH = int(os.getenv("STATE_FLUSH_BATCH", "200"))  # bufer shu hajmga yetsa darhol yoziladi
+STATE_DEFAULT_TTL = int(os.getenv("STATE_DEFAULT_TTL", str(7 * 86400)))
+
+# Namespace'lar (avvalgi global set/dict'lar o'rniga)
+WAIT_DATE_FOR = "wait_date"                 # admin -> payment_id / user_id
+MULTI_PICK = "multi_pick"                   # admin -> {"pid", "start_iso", "selected"}
+WAIT_CONTACT_FOR = "wait_contact"
+WAIT_FULLNAME_FOR = "wait_fullname"
+WAIT_CONTRACT_CONFIRM = "wait_contract_confirm"
+WAIT_CONTRACT_EDIT = "wait_contract_edit"
+WAIT_PAYMENT_EDIT = "wait_payment_edit"
+WAIT_PAYMENT_PHOTO = "wait_payment_photo"
+WAIT_RENEWAL_RECEIPT = "wait_renewal_receipt"
+NOT_PAID_COUNTER = "not_paid"               # (user_id, group_id) -> son
+
+STATE_TTLS: dict[str, int] = {
+    WAIT_DATE_FOR: 86400,
+    MULTI_PICK: 86400,
+    WAIT_CONTRACT_EDIT: 86400,
+    WAIT_PAYMENT_EDIT: 86400,
+    NOT_PAID_COUNTER: 90 * 86400,
+}
+
+_STATE: dict[tuple[str, str], tuple[float, object]] = {}  # (namespace, key) -> (expires_at, value)
+_STATE_DIRTY: set[tuple[str, str]] = set()  # hali database'ga yozilmagan kalitlar
+_STATE_FLUSH_WAKE = asyncio.Event()
+_STATE_FLUSH_LOCK = asyncio.Lock()  # parallel flush'lar eski qiymatni ustiga yozmasligi uchun
+STATE_CHANNEL = "conversation_state"
+
+def _state_key(key) -> str:
+    """int yoki (uid, gid) kalitini matnga aylantirish."""
+    if isinstance(key, tuple):
+        return ":".join(str(k) for k in key)
+    return str(key)
+
+def _state_touch(item: tuple[str, str]):
+    if STATE_BACKEND != "postgres":
+        return
+    _STATE_DIRTY.add(item)
+    if len(_STATE_DIRTY) >= STATE_FLUSH_BATCH:
+        _STATE_FLUSH_WAKE.set()
+
+def state_set(namespace: str, key, value=True, ttl: Optional[int] = None):
+    """Holatni saqlash. Qiymat JSON'ga aylanadigan bo'lishi kerak (set emas, list)."""
+    ttl = ttl or STATE_TTLS.get(namespace, STATE_DEFAULT_TTL)
+    item = (namespace, _state_key(key))
+    _STATE[item] = (time.time() + ttl, value)
+    _state_touch(item)
+
+def state_get(namespace: str, key, default=None):
+    """Holatni olish (muddati o'tgan bo'lsa default)."""
+    item = (namespace, _state_key(key))
+    entry = _STATE.get(item)
+    if entry is None:
+        return default
+    if entry[0] <= time.time():
+        del _STATE[item]
+        _state_touch(item)
+        return default
+    return entry[1]
+
+def state_has(namespace: str, key) -> bool:
+    return state_get(namespace, key, None) is not None
+
+def state_pop(namespace: str, key, default=None):
+    """Holatni olib tashlash va qiymatini qaytarish."""
+    value = state_get(namespace, key, None)
+    item = (namespace, _state_key(key))
+    if _STATE.pop(item, None) is not None:
+        _state_touch(item)
+    return default if value is None else value
+
+async def load_conversation_state():
+    """Database'dagi amal qilayotgan holatlarni xotiraga yuklash (startup va LISTEN qayta ulanishi).
+    
+    Hali yozilmagan (_STATE_DIRTY) kalitlar xotiradagi qiymatini saqlab qoladi.
+    """
+    if STATE_BACKEND != "postgres":
+        return
+    now = time.time()
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT namespace, state_key, value, expires_at FROM conversation_state WHERE expires_at > $1",
+            int(now)
+        )
+    loaded: dict[tuple[str, str], tuple[float, object]] = {}
+    for row in rows:
+        try:
+            loaded[(row['namespace'], row['state_key'])] = (float(row['expires_at']), json.loads(row['value']))
+        except Exception as e:
+            logger.warning(f"Skipping broken conversation state {row['namespace']}:{row['state_key']}: {e}")
+    for item in _STATE_DIRTY:
+        if item in _STATE:
+            loaded[item] = _STATE[item]
+        else:
+            loaded.pop(item, None)
+    _STATE.clear()
+    _STATE.update(loaded)
+    logger.info(f"Loaded {len(rows)} conversation state entries")
+
+async def reload_state_key(namespace: str, state_key: str):
+    """Boshqa replica o'zgartirgan bitta kalitni jadvaldan qayta o'qish."""
+    item = (namespace, state_key)
+    if item in _STATE_DIRTY:
+        return  # lokal o'zgarish yangiroq - flush uni yozadi
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT value, expires_at FROM conversation_state WHERE namespace=$1 AND state_key=$2 AND expires_at > $3",
+            namespace, state_key, int(time.time())
+        )
+    if item in _STATE_DIRTY:
+        return
+    if row is None:
+        _STATE.pop(item, None)
+    else:
+        _STATE[item] = (float(row['expires_at']), json.loads(row['value']))
+
+async def _reload_state_key_safe(namespace: str, state_key: str):
+    try:
+        await reload_state_key(namespace, state_key)
+    except Exception as e:
+        logger.warning(f"Failed to reload conversation state {namespace}:{state_key}: {e}")
+
+def _on_state_notify(_conn, _pid, _channel, payload: str):
+    """NOTIFY payload: "namespace|state_key"."""
+    namespace, _, state_key = payload.partition("|")
+    asyncio.create_task(_reload_state_key_safe(namespace, state_key))
+
+async def flush_conversation_state():
+    """Buferdagi o'zgarishlarni bitta tranzaksiyada yozish (upsert + delete)."""
+    async with _STATE_FLUSH_LOCK:
+        if not _STATE_DIRTY:
+            return
+        items = list(_STATE_DIRTY)
+        _STATE_DIRTY.clear()
+        now = time.time()
+        upserts, deletes = [], []
+        for item in items:
+            entry = _STATE.get(item)
+            if entry is None or entry[0] <= now:
+                deletes.append(item)
+            else:
+                upserts.append((item[0], item[1], json.dumps(entry[1]), int(entry[0])))
+        try:
+            async with db_pool.acquire() as conn:
+                async with conn.transaction():
+                    if upserts:
+                        await conn.executemany("""
+                            INSERT INTO conversation_state(namespace, state_key, value, expires_at)
+                            VALUES($1, $2, $3, $4)
+                            ON CONFLICT (namespace, state_key)
+                            DO UPDATE SET value=EXCLUDED.value, expires_at=EXCLUDED.expires_at
+                        """, upserts)
+                    if deletes:
+                        await conn.executemany(
+                            "DELETE FROM conversation_state WHERE namespace=$1 AND state_key=$2",
+                            deletes
+                        )
+        except Exception:
+            # Keyingi urinishda qayta yozish (shu orada yangi o'zgarishlar ham qo'shilgan bo'lishi mumkin)
+            _STATE_DIRTY.update(items)
+            raise
+
+async def state_commit():
+    """Muhim qadamlar (to'lov, shartnoma) uchun o'zgarishlarni darhol yozish.
+    
+    Xato bo'lsa o'zgarishlar buferda qoladi va write-behind loop qayta urinadi.
+    """
+    if STATE_BACKEND != "postgres":
+        return
+    try:
+        await flush_conversation_state()
+    except Exception as e:
+        logger.warning(f"Failed to commit conversation state ({len(_STATE_DIRTY)} pending): {e}")
+
+async def conversation_state_listener_loop():
+    """Boshqa replica'lar yozgan holatlarni LISTEN orqali kuzatish."""
+    if STATE_BACKEND != "postgres":
+        return
+    await pg_listen_loop(STATE_CHANNEL, _on_state_notify, load_conversation_state)
+
+async def conversation_state_loop():
+    """Write-behind flush va muddati o'tgan holatlarni tozalash."""
+    last_purge = 0.0
+    while True:
+        try:
+            await asyncio.wait_for(_STATE_FLUSH_WAKE.wait(), timeout=STATE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _STATE_FLUSH_WAKE.clear()
+        
+        now = time.time()
+        if now - last_purge >= 600:
+            last_purge = now
+            for item in [item for item, (exp, _v) in _STATE.items() if exp <= now]:
+                del _STATE[item]
+            if STATE_BACKEND == "postgres":
+                try:
+                    async with db_pool.acquire() as conn:
+                        await conn.execute("DELETE FROM conversation_state WHERE expires_at <= $1", int(now))
+                except Exception as e:
+                    logger.warning(f"Failed to purge expired conversation state: {e}")
+        
+        try:
+            await flush_conversation_state()
+        except Exception as e:
+            logger.warning(f"Failed to flush conversation state ({len(_STATE_DIRTY)} pending): {e}")
+
 CONTRACT_TEXT = """ONLAYN O'QUV SHARTNOMA
 
 O'rtasida:
@@ -248,90 +468,379 @@ CREATE INDEX IF NOT EXISTS idx_admins_active ON admins(active);
 CREATE INDEX IF NOT EXISTS idx_admins_expires ON admins(expires_at);
 """
 
+# Suhbat holatlari (STATE_BACKEND=postgres uchun write-behind jadvali)
+CONVERSATION_STATE_SQL = """
+CREATE TABLE IF NOT EXISTS conversation_state(
+    namespace TEXT NOT NULL,
+    state_key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires_at BIGINT NOT NULL,
+    PRIMARY KEY (namespace, state_key)
+);
+CREATE INDEX IF NOT EXISTS idx_conversation_state_expires ON conversation_state(expires_at);
+"""
+
+# conversation_state'ning har bir o'zgargan kaliti haqida replica'larga xabar
+CONVERSATION_STATE_NOTIFY_SQL = """
+CREATE OR REPLACE FUNCTION notify_conversation_state() RETURNS trigger AS $$
+DECLARE
+    r conversation_state;
+BEGIN
+    IF TG_OP = 'DELETE' THEN r := OLD; ELSE r := NEW; END IF;
+    PERFORM pg_notify('conversation_state', r.namespace || '|' || r.state_key);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_conversation_state_notify ON conversation_state;
+CREATE TRIGGER trg_conversation_state_notify
+    AFTER INSERT OR UPDATE OR DELETE ON conversation_state
+    FOR EACH ROW EXECUTE FUNCTION notify_conversation_state();
+"""
+
+# Dashboard snapshot'iga ta'sir qiladigan o'zgarishlar (bot, API, boshqa replica'lar) -
+# commit'dan keyin user_id bilan xabar; LISTEN qilgan jarayon faqat shu userni qayta o'qiydi
+DASHBOARD_NOTIFY_SQL = """
+CREATE OR REPLACE FUNCTION notify_dashboard_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('dashboard_changed', OLD.user_id::TEXT);
+    ELSE
+        PERFORM pg_notify('dashboard_changed', NEW.user_id::TEXT);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_payments_dashboard_notify ON payments;
+CREATE TRIGGER trg_payments_dashboard_notify
+    AFTER INSERT OR DELETE OR UPDATE OF status, payment_type ON payments
+    FOR EACH ROW EXECUTE FUNCTION notify_dashboard_changed();
+
+DROP TRIGGER IF EXISTS trg_users_dashboard_notify ON users;
+CREATE TRIGGER trg_users_dashboard_notify
+    AFTER INSERT OR DELETE OR UPDATE OF username, full_name, phone, group_id, expires_at ON users
+    FOR EACH ROW EXECUTE FUNCTION notify_dashboard_changed();
+
+DROP TRIGGER IF EXISTS trg_user_groups_dashboard_notify ON user_groups;
+CREATE TRIGGER trg_user_groups_dashboard_notify
+    AFTER INSERT OR DELETE OR UPDATE OF expires_at ON user_groups
+    FOR EACH ROW EXECUTE FUNCTION notify_dashboard_changed();
+"""
+
+# Obunachilar eksporti uchun umumiy manba (bot va API bitta so'rovni o'qiydi).
+# subscription_rows backfill tugaguncha eski users + user_groups; backfill_subscriptions
+# tugagach uni subscriptions jadvaliga almashtiradi (SUBSCRIPTION_ROWS_READY_SQL).
+SUBSCRIPTION_ROWS_LEGACY_SQL = """
+CREATE OR REPLACE VIEW subscription_rows AS
+    SELECT user_id, group_id, expires_at FROM users WHERE group_id IS NOT NULL
+    UNION ALL
+    SELECT user_id, group_id, expires_at FROM user_groups;
+"""
+
+SUBSCRIPTION_ROWS_READY_SQL = """
+CREATE OR REPLACE VIEW subscription_rows AS
+    SELECT user_id, group_id, expires_at FROM subscriptions;
+"""
+
+SUBSCRIBER_EXPORT_VIEW_SQL = SUBSCRIPTION_ROWS_LEGACY_SQL + """
+CREATE OR REPLACE VIEW subscriber_export AS
+    SELECT DISTINCT ON (s.group_id, s.user_id)
+           s.group_id, s.user_id, u.username, u.full_name, u.phone, s.expires_at
+    FROM subscription_rows s
+    LEFT JOIN users u ON u.user_id = s.user_id
+    ORDER BY s.group_id, s.user_id, COALESCE(s.expires_at, 0) DESC;
+"""
+
+# Bir martalik fon ishlari tugaganini saqlash (masalan, subscriptions backfill) - restart'da qayta bajarilmaydi
+APP_MARKERS_SQL = """
+CREATE TABLE IF NOT EXISTS app_markers(
+    name TEXT PRIMARY KEY,
+    created_at BIGINT NOT NULL
+);
+
+-- subscription_rows allaqachon subscriptions'ga almashtirilgan bo'lsa - backfill tugagan
+INSERT INTO app_markers(name, created_at)
+SELECT 'subscriptions_backfill', EXTRACT(EPOCH FROM now())::BIGINT
+WHERE pg_get_viewdef('subscription_rows'::regclass) NOT LIKE '%user_groups%'
+ON CONFLICT (name) DO NOTHING;
+"""
+
+# Transactional outbox: handlerlar xabarni DB tranzaksiyasi ichida navbatga qo'yadi
+OUTBOX_SQL = """
+CREATE TABLE IF NOT EXISTS notification_outbox(
+    id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'message',
+    payload TEXT NOT NULL,
+    payment_id INTEGER,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at BIGINT NOT NULL,
+    locked_until BIGINT,
+    created_at BIGINT NOT NULL,
+    sent_at BIGINT,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_pending ON notification_outbox(next_attempt_at, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_outbox_chat_pending ON notification_outbox(chat_id, id) WHERE status = 'pending';
+"""
+
+# To'lovlar browser'i uchun keyset pagination index'i
+PAYMENTS_KEYSET_SQL = """
+CREATE INDEX IF NOT EXISTS idx_pay_status_created_id ON payments(status, created_at DESC, id DESC);
+"""
+
+# Yagona obunalar jadvali: users (asosiy guruh) va user_groups (qo'shimcha guruhlar)
+# o'rniga bitta qator (user_id, group_id). Eski jadvallar hozircha yozish manbai bo'lib
+# qoladi - triggerlar har bir o'zgarishni subscriptions'ga ko'chiradi (moslik qatlami).
+SUBSCRIPTIONS_SQL = """
+CREATE TABLE IF NOT EXISTS subscriptions(
+    user_id BIGINT NOT NULL,
+    group_id BIGINT NOT NULL,
+    expires_at BIGINT NOT NULL DEFAULT 0,
+    last_warning_sent_at BIGINT,
+    is_primary BOOLEAN NOT NULL DEFAULT FALSE,
+    updated_at BIGINT,
+    PRIMARY KEY (user_id, group_id)
+);
+CREATE INDEX IF NOT EXISTS idx_subs_group ON subscriptions(group_id);
+CREATE INDEX IF NOT EXISTS idx_subs_expires ON subscriptions(expires_at);
+
+CREATE OR REPLACE FUNCTION sync_subscription(p_user BIGINT, p_group BIGINT) RETURNS void AS $$
+BEGIN
+    IF p_group IS NULL THEN
+        RETURN;
+    END IF;
+    INSERT INTO subscriptions(user_id, group_id, expires_at, last_warning_sent_at, is_primary, updated_at)
+    SELECT p_user, p_group, MAX(COALESCE(src.expires_at, 0)), MAX(src.last_warning_sent_at),
+           BOOL_OR(src.is_primary), EXTRACT(EPOCH FROM now())::BIGINT
+    FROM (
+        SELECT expires_at, last_warning_sent_at, TRUE AS is_primary
+        FROM users WHERE user_id = p_user AND group_id = p_group
+        UNION ALL
+        SELECT expires_at, last_warning_sent_at, FALSE
+        FROM user_groups WHERE user_id = p_user AND group_id = p_group
+    ) src
+    HAVING COUNT(*) > 0
+    ON CONFLICT (user_id, group_id) DO UPDATE SET
+        expires_at = EXCLUDED.expires_at,
+        last_warning_sent_at = EXCLUDED.last_warning_sent_at,
+        is_primary = EXCLUDED.is_primary,
+        updated_at = EXCLUDED.updated_at;
+    IF NOT FOUND THEN
+        DELETE FROM subscriptions WHERE user_id = p_user AND group_id = p_group;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION subscriptions_mirror() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM sync_subscription(OLD.user_id, OLD.group_id);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND (NEW.user_id, NEW.group_id) IS DISTINCT FROM (OLD.user_id, OLD.group_id)) THEN
+        PERFORM sync_subscription(NEW.user_id, NEW.group_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_users_subscriptions ON users;
+CREATE TRIGGER trg_users_subscriptions
+    AFTER INSERT OR DELETE OR UPDATE OF user_id, group_id, expires_at, last_warning_sent_at ON users
+    FOR EACH ROW EXECUTE FUNCTION subscriptions_mirror();
+
+DROP TRIGGER IF EXISTS trg_user_groups_subscriptions ON user_groups;
+CREATE TRIGGER trg_user_groups_subscriptions
+    AFTER INSERT OR DELETE OR UPDATE OF user_id, group_id, expires_at, last_warning_sent_at ON user_groups
+    FOR EACH ROW EXECUTE FUNCTION subscriptions_mirror();
+"""
+
+# Muddat skanerlari uchun partial covering index'lar: expires_at bo'yicha diapazon,
+# qolgan ustunlar INCLUDE'da - jadvalga murojaat qilmasdan (index-only scan)
+EXPIRY_INDEXES_SQL = """
+CREATE INDEX IF NOT EXISTS idx_users_expiry_scan ON users(expires_at)
+    INCLUDE (user_id, group_id, last_warning_sent_at) WHERE expires_at > 0;
+CREATE INDEX IF NOT EXISTS idx_ug_expiry_scan ON user_groups(expires_at)
+    INCLUDE (user_id, group_id, last_warning_sent_at) WHERE expires_at > 0;
+CREATE INDEX IF NOT EXISTS idx_subs_expiry_scan ON subscriptions(expires_at)
+    INCLUDE (user_id, group_id, last_warning_sent_at) WHERE expires_at > 0;
+"""
+
+# payment_settings / contract_templates o'zgarganda boshqa jarayonlarga xabar (LISTEN config_changed)
+CONFIG_NOTIFY_SQL = """
+CREATE OR REPLACE FUNCTION notify_config_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('config_changed', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_payment_settings_notify ON payment_settings;
+CREATE TRIGGER trg_payment_settings_notify
+    AFTER INSERT OR UPDATE OR DELETE ON payment_settings
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_config_changed();
+
+DROP TRIGGER IF EXISTS trg_contract_templates_notify ON contract_templates;
+CREATE TRIGGER trg_contract_templates_notify
+    AFTER INSERT OR UPDATE OR DELETE ON contract_templates
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_config_changed();
+"""
+
+# Admin -> guruh bog'lanishi: admins.managed_groups massivi yozish manbai bo'lib qoladi,
+# trigger har bir o'zgarishni admin_groups'ga ko'chiradi ("guruh G adminlari" - index bo'yicha)
+ADMIN_GROUPS_SQL = """
+CREATE TABLE IF NOT EXISTS admin_groups(
+    admin_id BIGINT NOT NULL,
+    group_id BIGINT NOT NULL,
+    PRIMARY KEY (admin_id, group_id)
+);
+CREATE INDEX IF NOT EXISTS idx_admin_groups_group ON admin_groups(group_id);
+
+CREATE OR REPLACE FUNCTION admin_groups_mirror() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM admin_groups WHERE admin_id = OLD.user_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO admin_groups(admin_id, group_id)
+        SELECT NEW.user_id, gid FROM unnest(COALESCE(NEW.managed_groups, '{}'::BIGINT[])) AS gid
+        ON CONFLICT DO NOTHING;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_admins_admin_groups ON admins;
+CREATE TRIGGER trg_admins_admin_groups
+    AFTER INSERT OR DELETE OR UPDATE OF user_id, managed_groups ON admins
+    FOR EACH ROW EXECUTE FUNCTION admin_groups_mirror();
+
+INSERT INTO admin_groups(admin_id, group_id)
+SELECT a.user_id, gid FROM admins a, unnest(COALESCE(a.managed_groups, '{}'::BIGINT[])) AS gid
+ON CONFLICT DO NOTHING;
+"""
+
+# To'lov hodisalari (append-only): payments.status - oxirgi hodisa proyeksiyasi.
+# Yozuvchilar hodisa va status'ni bitta so'rovda yozadi (PREPARED_SQL, API routes).
+PAYMENT_EVENTS_SQL = """
+CREATE TABLE IF NOT EXISTS payment_events(
+    id BIGSERIAL PRIMARY KEY,
+    payment_id INTEGER NOT NULL,
+    user_id BIGINT NOT NULL,
+    event TEXT NOT NULL,
+    admin_id BIGINT,
+    created_at BIGINT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_payment_events_user ON payment_events(user_id, id DESC);
+CREATE INDEX IF NOT EXISTS idx_payment_events_payment ON payment_events(payment_id, id);
+
+-- Mavjud to'lovlar tarixi: yuborilgan + hozirgi holat (aniq vaqti noma'lum - created_at)
+INSERT INTO payment_events(payment_id, user_id, event, admin_id, created_at)
+SELECT p.id, p.user_id, ev.event, ev.admin_id, COALESCE(p.created_at, 0)
+FROM payments p
+CROSS JOIN LATERAL (
+    VALUES ('submitted', NULL::BIGINT), (p.status, p.admin_id)
+) AS ev(event, admin_id)
+WHERE p.user_id IS NOT NULL
+  AND (ev.event = 'submitted' OR p.status <> 'pending')
+  AND NOT EXISTS (SELECT 1 FROM payment_events pe WHERE pe.payment_id = p.id)
+ORDER BY p.id, ev.event = 'submitted' DESC;
+"""
+
+# ==================== SCHEMA MIGRATIONS ====================
+# Har bir migratsiya bir marta, o'z tranzaksiyasida bajariladi va schema_version
+# jadvaliga yoziladi. Sxema o'zgarmagan bo'lsa startup bitta SELECT bilan tugaydi.
+# Migratsiyalar IF NOT EXISTS bilan yozilgan - runner'dan oldingi database'larda
+# ham xavfsiz qayta bajariladi. Yangi migratsiya faqat ro'yxat oxiriga qo'shiladi.
+
+MIGRATIONS: list[tuple[int, str, str]] = [
+    (1, "baseline tables and indexes", CREATE_SQL),
+    (2, "late columns: course_name, admin tariff, warnings, group/payment type, video_link", """
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS course_name TEXT;
+        ALTER TABLE admins ADD COLUMN IF NOT EXISTS max_groups INTEGER DEFAULT -1;
+        ALTER TABLE admins ADD COLUMN IF NOT EXISTS tariff TEXT;
+        ALTER TABLE admins ADD COLUMN IF NOT EXISTS last_warning_sent_at BIGINT;
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS last_warning_sent_at BIGINT;
+        ALTER TABLE user_groups ADD COLUMN IF NOT EXISTS last_warning_sent_at BIGINT;
+        ALTER TABLE groups ADD COLUMN IF NOT EXISTS type TEXT DEFAULT 'group';
+        ALTER TABLE payments ADD COLUMN IF NOT EXISTS payment_type TEXT DEFAULT 'initial';
+        ALTER TABLE payment_settings ADD COLUMN IF NOT EXISTS video_link TEXT;
+    """),
+    (3, "unified subscriptions table and sync triggers", SUBSCRIPTIONS_SQL),
+    (4, "conversation state", CONVERSATION_STATE_SQL),
+    (5, "notification outbox", OUTBOX_SQL),
+    (6, "payments keyset index", PAYMENTS_KEYSET_SQL),
+    (7, "expiry scan covering indexes", EXPIRY_INDEXES_SQL),
+    (8, "config change notify triggers", CONFIG_NOTIFY_SQL),
+    (9, "admin_groups membership table (backfilled from admins.managed_groups)", ADMIN_GROUPS_SQL),
+    (10, "append-only payment event log (backfilled from payments)", PAYMENT_EVENTS_SQL),
+    (11, "conversation state change notify trigger", CONVERSATION_STATE_NOTIFY_SQL),
+    (12, "dashboard change notify triggers", DASHBOARD_NOTIFY_SQL),
+    (13, "shared subscriber export view", SUBSCRIBER_EXPORT_VIEW_SQL),
+    (14, "approved payment events index", """
+        CREATE INDEX IF NOT EXISTS idx_payment_events_approved ON payment_events(user_id, id DESC) WHERE event = 'approved';
+    """),
+    (15, "app markers (subscriptions backfill completion)", APP_MARKERS_SQL),
+]
+
+SCHEMA_VERSION_SQL = """
+CREATE TABLE IF NOT EXISTS schema_version(
+    version INTEGER PRIMARY KEY,
+    description TEXT NOT NULL,
+    applied_at BIGINT NOT NULL
+);
+"""
+SCHEMA_LOCK_ID = 7_206_001  # pg_advisory_lock kaliti - replikalar bir vaqtda migratsiya qilmasin
+
+async def _schema_version(conn) -> int:
+    try:
+        return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    except asyncpg.UndefinedTableError:
+        return 0
+
+async def run_migrations(conn) -> int:
+    """Bajarilmagan migratsiyalarni tartib bilan qo'llash.
+    
+    Returns:
+        Qo'llangan migratsiyalar soni
+    """
+    latest = MIGRATIONS[-1][0]
+    if await _schema_version(conn) >= latest:
+        return 0
+    
+    await conn.execute("SELECT pg_advisory_lock($1)", SCHEMA_LOCK_ID)
+    try:
+        await conn.execute(SCHEMA_VERSION_SQL)
+        # Lock kutilayotganda boshqa replika migratsiyani tugatgan bo'lishi mumkin
+        current = await _schema_version(conn)
+        applied = 0
+        for version, description, sql in MIGRATIONS:
+            if version <= current:
+                continue
+            async with conn.transaction():
+                await conn.execute(sql)
+                await conn.execute(
+                    "INSERT INTO schema_version(version, description, applied_at) VALUES($1, $2, $3)",
+                    version, description, int(datetime.utcnow().timestamp())
+                )
+            applied += 1
+            logger.info(f"Migration {version} applied: {description}")
+        return applied
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", SCHEMA_LOCK_ID)
+
 async def db_init():
     global db_pool, GROUP_IDS
     try:
-        db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=2, max_size=10)
+        db_pool = await asyncpg.create_pool(
+            DATABASE_URL, min_size=2, max_size=10,
+            connection_class=PreparedConnection, init=init_db_connection
+        )
         async with db_pool.acquire() as conn:
-            await conn.execute(CREATE_SQL)
-            
-            # Migration: course_name ustunini qo'shish (agar yo'q bo'lsa)
-            try:
-                await conn.execute("""
-                    ALTER TABLE users ADD COLUMN IF NOT EXISTS course_name TEXT;
-                """)
-                logger.info("Migration: course_name column added/verified")
-            except Exception as me:
-                logger.warning(f"Migration warning (likely already exists): {me}")
-            
-            # Migration: admins jadvalidagi yangi ustunlarni qo'shish
-            try:
-                await conn.execute("""
-                    ALTER TABLE admins ADD COLUMN IF NOT EXISTS max_groups INTEGER DEFAULT -1;
-                """)
-                logger.info("Migration: max_groups column added/verified")
-            except Exception as me:
-                logger.warning(f"Migration warning: {me}")
-            
-            try:
-                await conn.execute("""
-                    ALTER TABLE admins ADD COLUMN IF NOT EXISTS tariff TEXT;
-                """)
-                logger.info("Migration: tariff column added/verified")
-            except Exception as me:
-                logger.warning(f"Migration warning: {me}")
-            
-            try:
-                await conn.execute("""
-                    ALTER TABLE admins ADD COLUMN IF NOT EXISTS last_warning_sent_at BIGINT;
-                """)
-                logger.info("Migration: last_warning_sent_at column added/verified for admins")
-            except Exception as me:
-                logger.warning(f"Migration warning (admins): {me}")
-            
-            # Migration: last_warning_sent_at for users and user_groups (kuniga 1 marta warning uchun)
-            try:
-                await conn.execute("""
-                    ALTER TABLE users ADD COLUMN IF NOT EXISTS last_warning_sent_at BIGINT;
-                """)
-                logger.info("Migration: last_warning_sent_at column added/verified for users")
-            except Exception as me:
-                logger.warning(f"Migration warning (users): {me}")
-            
-            try:
-                await conn.execute("""
-                    ALTER TABLE user_groups ADD COLUMN IF NOT EXISTS last_warning_sent_at BIGINT;
-                """)
-                logger.info("Migration: last_warning_sent_at column added/verified for user_groups")
-            except Exception as me:
-                logger.warning(f"Migration warning (user_groups): {me}")
-            
-            # Migration: groups jadvaliga 'type' ustuni qo'shish (group/channel farqlash uchun)
-            try:
-                await conn.execute("""
-                    ALTER TABLE groups ADD COLUMN IF NOT EXISTS type TEXT DEFAULT 'group';
-                """)
-                logger.info("Migration: groups.type column added/verified")
-            except Exception as me:
-                logger.warning(f"Migration warning: {me}")
-            
-            # Migration: payments jadvaliga 'payment_type' ustuni qo'shish (initial/renewal farqlash uchun)
-            try:
-                await conn.execute("""
-                    ALTER TABLE payments ADD COLUMN IF NOT EXISTS payment_type TEXT DEFAULT 'initial';
-                """)
-                logger.info("Migration: payments.payment_type column added/verified")
-            except Exception as me:
-                logger.warning(f"Migration warning: {me}")
-            
-            # Migration: payment_settings jadvaliga 'video_link' ustuni qo'shish (YouTube tutorial uchun)
-            try:
-                await conn.execute("""
-                    ALTER TABLE payment_settings ADD COLUMN IF NOT EXISTS video_link TEXT;
-                """)
-                logger.info("Migration: payment_settings.video_link column added/verified")
-            except Exception as me:
-                logger.warning(f"Migration warning: {me}")
+            applied = await run_migrations(conn)
+            await load_subscriptions_ready(conn)
             
             # Default shartnoma matnini qo'shish (agar yo'q bo'lsa)
             count = await conn.fetchval("SELECT COUNT(*) FROM contract_templates")
@@ -375,55 +884,239 @@ async def db_init():
                 logger.warning(f"Database has no groups, keeping {len(GROUP_IDS)} from environment variable")
             else:
                 logger.warning("No groups found in database or environment - bot may not function properly")
-                
+        
+        # Migratsiyalardan keyin connection'larni yangilash - so'rovlar yakuniy sxema bo'yicha prepare qilinadi
+        if applied:
+            await db_pool.expire_connections()
         logger.info("PostgreSQL database initialized successfully")
     except Exception as e:
         logger.error(f"Database initialization failed: {e}")
         raise
 
-async def add_payment(user: Message, file_id: str, payment_type: str = 'initial') -> int:
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "INSERT INTO payments(user_id, photo_file, status, created_at, payment_type) VALUES($1,$2,$3,$4,$5) RETURNING id",
-            user.from_user.id, file_id, "pending", int(datetime.utcnow().timestamp()), payment_type
+# ==================== DATA ACCESS LAYER ====================
+# Eng ko'p ishlatiladigan so'rovlar har bir pool connection'i uchun bir marta
+# (pool init hook'ida) prepare qilinadi. Natijalar tuple emas, nomlangan record
+# obyektlari sifatida qaytadi. Helper'lar ixtiyoriy conn qabul qiladi - handler
+# bitta connection'da bir nechta helper'ni ishlatishi mumkin (db_conn orqali).
+
+PREPARED_SQL = {
+    "get_user": "SELECT user_id, group_id, expires_at, username, full_name, phone, agreed_at FROM users WHERE user_id=$1",
+    "get_payment": "SELECT id, user_id, status, photo_file, payment_type FROM payments WHERE id=$1",
+    "add_payment": """
+        WITH p AS (
+            INSERT INTO payments(user_id, photo_file, status, created_at, payment_type) VALUES($1,$2,$3,$4,$5)
+            RETURNING id, user_id, created_at
+        ), ev AS (
+            INSERT INTO payment_events(payment_id, user_id, event, created_at)
+            SELECT id, user_id, 'submitted', created_at FROM p
+        )
+        SELECT id FROM p
+    """,
+    "set_payment_status": """
+        WITH p AS (
+            UPDATE payments SET status=$1, admin_id=$2 WHERE id=$3 RETURNING id, user_id
+        ), ev AS (
+            INSERT INTO payment_events(payment_id, user_id, event, admin_id, created_at)
+            SELECT id, user_id, $1, $2, $4 FROM p
         )
-        return int(row['id'])
+        SELECT user_id FROM p
+    """,
+    "latest_payment_event": "SELECT payment_id, event, created_at FROM payment_events WHERE user_id=$1 ORDER BY id DESC LIMIT 1",
+    # Oxirgi tasdiqlangan (keyin rad etilmagan/o'chirilmagan) to'lov - idx_payment_events_approved
+    "latest_approved_payment": """
+        SELECT pe.payment_id FROM payment_events pe
+        WHERE pe.user_id=$1 AND pe.event='approved'
+          AND NOT EXISTS (
+              SELECT 1 FROM payment_events later
+              WHERE later.payment_id = pe.payment_id AND later.id > pe.id
+          )
+        ORDER BY pe.id DESC LIMIT 1
+    """,
+    "has_pending_renewal": "SELECT id FROM payments WHERE user_id=$1 AND status='pending' AND payment_type='renewal' LIMIT 1",
+    "upsert_user": """
+        INSERT INTO users(user_id, username, full_name, group_id, expires_at, phone, agreed_at)
+        VALUES($1,$2,$3,$4,$5,$6,$7)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username=EXCLUDED.username,
+            full_name=EXCLUDED.full_name,
+            group_id=EXCLUDED.group_id,
+            expires_at=EXCLUDED.expires_at,
+            phone=COALESCE(EXCLUDED.phone, users.phone),
+            agreed_at=COALESCE(EXCLUDED.agreed_at, users.agreed_at)
+    """,
+    "update_user_expiry": "UPDATE users SET expires_at=$1 WHERE user_id=$2",
+    "add_user_group": """
+        INSERT INTO user_groups(user_id, group_id, expires_at)
+        VALUES($1,$2,$3)
+        ON CONFLICT(user_id, group_id) DO UPDATE SET expires_at=EXCLUDED.expires_at
+    """,
+}
 
-async def set_payment_status(pid: int, status: str, admin_id: Optional[int]):
-    async with db_pool.acquire() as conn:
-        await conn.execute("UPDATE payments SET status=$1, admin_id=$2 WHERE id=$3", status, admin_id, pid)
+class PreparedConnection(asyncpg.Connection):
+    """Pool connection'i: prepare qilingan so'rovlar shu connection'da saqlanadi."""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: dict = {}  # name -> PreparedStatement
+        self.commit_hooks: Optional[list] = None  # db_transaction() ichida: commit'dan keyingi hook'lar
 
-async def get_payment(pid: int):
+async def init_db_connection(conn: PreparedConnection):
+    """Pool init hook: PREPARED_SQL so'rovlarini oldindan prepare qilish."""
+    for name, sql in PREPARED_SQL.items():
+        try:
+            conn.prepared[name] = await conn.prepare(sql)
+        except Exception as e:
+            # Birinchi ishga tushishda jadval/ustun hali bo'lmasligi mumkin - keyin lazy prepare qilinadi
+            logger.debug(f"Statement {name} not prepared on connect: {e}")
+
+async def prepared(conn, name: str):
+    """Connection'dagi prepare qilingan so'rovni olish (yo'q bo'lsa shu yerda prepare qilinadi)."""
+    stmt = conn.prepared.get(name)
+    if stmt is None:
+        stmt = await conn.prepare(PREPARED_SQL[name])
+        conn.prepared[name] = stmt
+    return stmt
+
+@asynccontextmanager
+async def db_conn(conn=None):
+    """Berilgan connection'ni qayta ishlatish yoki pool'dan yangisini olish."""
+    if conn is not None:
+        yield conn
+        return
     async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT id, user_id, status, photo_file, payment_type FROM payments WHERE id=$1", pid)
-        return (row['id'], row['user_id'], row['status'], row['photo_file'], row.get('payment_type', 'initial')) if row else None
+        yield conn
 
-async def has_pending_renewal(user_id: int) -> bool:
-    """User'ning pending renewal payment'i bormi?"""
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT id FROM payments WHERE user_id=$1 AND status='pending' AND payment_type='renewal' LIMIT 1",
-            user_id
-        )
-        return row is not None
+@asynccontextmanager
+async def db_transaction(conn=None):
+    """Tranzaksiya (unit of work): after_commit() hook'lari faqat commit'dan keyin bajariladi.
+    
+    Rollback bo'lsa hook'lar tashlab yuboriladi. Ichma-ich chaqirilsa savepoint ochiladi,
+    hook'larni esa tashqi tranzaksiya bajaradi.
+    """
+    async with db_conn(conn) as conn:
+        if conn.is_in_transaction():
+            async with conn.transaction():
+                yield conn
+            return
+        conn.commit_hooks = []
+        try:
+            async with conn.transaction():
+                yield conn
+            hooks = conn.commit_hooks
+        finally:
+            conn.commit_hooks = None
+        for hook, args in hooks:
+            try:
+                hook(*args)
+            except Exception as e:
+                logger.warning(f"After-commit hook {hook.__name__} failed: {e}")
 
-async def upsert_user(uid: int, username: str, full_name: str, group_id: int, expires_at: int, phone: Optional[str] = None, agreed_at: Optional[int] = None):
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO users(user_id, username, full_name, group_id, expires_at, phone, agreed_at)
-            VALUES($1,$2,$3,$4,$5,$6,$7)
-            ON CONFLICT(user_id) DO UPDATE SET
-                username=EXCLUDED.username,
-                full_name=EXCLUDED.full_name,
-                group_id=EXCLUDED.group_id,
-                expires_at=EXCLUDED.expires_at,
-                phone=COALESCE(EXCLUDED.phone, users.phone),
-                agreed_at=COALESCE(EXCLUDED.agreed_at, users.agreed_at)
-        """, uid, username, full_name, group_id, expires_at, phone, agreed_at)
-
-async def update_user_expiry(uid: int, new_expires_at: int):
-    async with db_pool.acquire() as conn:
-        await conn.execute("UPDATE users SET expires_at=$1 WHERE user_id=$2", new_expires_at, uid)
+def after_commit(conn, hook, *args):
+    """hook(*args) ni joriy db_transaction() commit bo'lgach bajarish (tranzaksiyasiz - darhol)."""
+    hooks = getattr(conn, "commit_hooks", None)
+    if hooks is None:
+        hook(*args)
+    else:
+        hooks.append((hook, args))
+
+class UserRecord:
+    """users jadvalidagi qator (get_user natijasi)."""
+    __slots__ = ("user_id", "group_id", "expires_at", "username", "full_name", "phone", "agreed_at")
+    
+    def __init__(self, row: asyncpg.Record):
+        self.user_id: int = row['user_id']
+        self.group_id: Optional[int] = row['group_id']
+        self.expires_at: Optional[int] = row['expires_at']
+        self.username: Optional[str] = row['username']
+        self.full_name: Optional[str] = row['full_name']
+        self.phone: Optional[str] = row['phone']
+        self.agreed_at: Optional[int] = row['agreed_at']
+    
+    def __repr__(self) -> str:
+        return f"UserRecord(user_id={self.user_id}, group_id={self.group_id}, expires_at={self.expires_at})"
+
+class PaymentRecord:
+    """payments jadvalidagi qator (get_payment natijasi)."""
+    __slots__ = ("id", "user_id", "status", "photo_file", "payment_type")
+    
+    def __init__(self, row: asyncpg.Record):
+        self.id: int = row['id']
+        self.user_id: int = row['user_id']
+        self.status: str = row['status']
+        self.photo_file: Optional[str] = row['photo_file']
+        self.payment_type: str = row['payment_type'] or 'initial'
+    
+    def __repr__(self) -> str:
+        return f"PaymentRecord(id={self.id}, user_id={self.user_id}, status={self.status!r}, payment_type={self.payment_type!r})"
+
+# conn berilsa, helper chaqiruvchining tranzaksiyasi ichida ishlaydi (masalan, outbox bilan birga)
+async def add_payment(user: Message, file_id: str, payment_type: str = 'initial', conn=None) -> int:
+    async with db_conn(conn) as conn:
+        stmt = await prepared(conn, "add_payment")
+        pid = await stmt.fetchval(user.from_user.id, file_id, "pending", int(datetime.utcnow().timestamp()), payment_type)
+        after_commit(conn, dashboard_touch, user.from_user.id)
+    return int(pid)
+
+async def set_payment_status(pid: int, status: str, admin_id: Optional[int], conn=None):
+    async with db_conn(conn) as conn:
+        stmt = await prepared(conn, "set_payment_status")
+        uid = await stmt.fetchval(status, admin_id, pid, int(datetime.utcnow().timestamp()))
+        if uid is not None:
+            after_commit(conn, dashboard_touch, uid)
+
+async def latest_payment_event(user_id: int, conn=None) -> Optional[str]:
+    """User'ning oxirgi to'lov hodisasi (submitted | approved | rejected | removed) yoki None."""
+    async with db_conn(conn) as conn:
+        stmt = await prepared(conn, "latest_payment_event")
+        row = await stmt.fetchrow(user_id)
+    return row['event'] if row else None
+
+async def latest_approved_payment(user_id: int, conn=None) -> Optional[int]:
+    """User'ning hozir ham tasdiqlangan holatdagi oxirgi to'lovi (payment_id) yoki None.
+    
+    Boshqa to'lovlar keyinroq rad etilgan bo'lsa ham (masalan, takroriy chek) natija o'zgarmaydi.
+    """
+    async with db_conn(conn) as conn:
+        stmt = await prepared(conn, "latest_approved_payment")
+        return await stmt.fetchval(user_id)
+
+async def payment_history(user_id: int, limit: int = 30, conn=None) -> list[asyncpg.Record]:
+    """User'ning to'lov hodisalari (yangidan eskiga) - idx_payment_events_user bo'yicha."""
+    async with db_conn(conn) as conn:
+        return await conn.fetch("""
+            SELECT pe.payment_id, pe.event, pe.admin_id, pe.created_at, p.payment_type
+            FROM payment_events pe
+            LEFT JOIN payments p ON p.id = pe.payment_id
+            WHERE pe.user_id = $1
+            ORDER BY pe.id DESC
+            LIMIT $2
+        """, user_id, limit)
+
+async def get_payment(pid: int, conn=None) -> Optional[PaymentRecord]:
+    async with db_conn(conn) as conn:
+        stmt = await prepared(conn, "get_payment")
+        row = await stmt.fetchrow(pid)
+    return PaymentRecord(row) if row else None
+
+async def has_pending_renewal(user_id: int, conn=None) -> bool:
+    """User'ning pending renewal payment'i bormi?"""
+    async with db_conn(conn) as conn:
+        stmt = await prepared(conn, "has_pending_renewal")
+        return await stmt.fetchval(user_id) is not None
+
+async def upsert_user(uid: int, username: str, full_name: str, group_id: int, expires_at: int, phone: Optional[str] = None, agreed_at: Optional[int] = None, conn=None):
+    async with db_conn(conn) as conn:
+        stmt = await prepared(conn, "upsert_user")
+        await stmt.fetchval(uid, username, full_name, group_id, expires_at, phone, agreed_at)
+        after_commit(conn, rearm_expiry, "users", uid, group_id, expires_at)
+        after_commit(conn, dashboard_touch, uid)
+
+async def update_user_expiry(uid: int, new_expires_at: int, conn=None):
+    async with db_conn(conn) as conn:
+        stmt = await prepared(conn, "update_user_expiry")
+        await stmt.fetchval(new_expires_at, uid)
+        after_commit(conn, rearm_expiry, "users", uid, None, new_expires_at)
+        after_commit(conn, dashboard_touch, uid)
 
 async def update_user_phone(uid: int, phone: str):
     async with db_pool.acquire() as conn:
@@ -437,68 +1130,237 @@ async def update_user_agreed(uid: int, ts: int):
     async with db_pool.acquire() as conn:
         await conn.execute("UPDATE users SET agreed_at=$1 WHERE user_id=$2", ts, uid)
 
-async def approve_renewal_payment(pid: int, uid: int, admin_id: int):
+# Bir yoki ko'p userning barcha obunalarini bitta so'rovda uzaytirish:
+# yangi muddat = max(hozirgi muddat, hozir) + $3 (erta yangilansa, qolgan kunlar saqlanadi)
+RENEWAL_EXTEND_SQL = """
+WITH u AS (
+    UPDATE users SET expires_at = GREATEST(COALESCE(expires_at, 0), $2) + $3
+    WHERE user_id = ANY($1::bigint[]) AND group_id IS NOT NULL
+    RETURNING user_id, group_id, expires_at
+), ug AS (
+    UPDATE user_groups SET expires_at = GREATEST(COALESCE(expires_at, 0), $2) + $3
+    WHERE user_id = ANY($1::bigint[])
+    RETURNING user_id, group_id, expires_at
+)
+SELECT 'users' AS source, user_id, group_id, expires_at FROM u
+UNION ALL
+SELECT 'user_groups' AS source, user_id, group_id, expires_at FROM ug
+"""
+
+async def renew_subscriptions_bulk(user_ids: list[int], days: int = SUBSCRIPTION_DAYS, conn=None) -> dict[int, list[tuple[int, int]]]:
+    """Ko'p userning barcha obunalarini bitta UPDATE ... RETURNING bilan uzaytirish.
+    
+    Returns:
+        {user_id: [(group_id, new_expires_at)]} - faqat obunasi bor userlar
+    """
+    now = int(datetime.utcnow().timestamp())
+    renewed: dict[int, list[tuple[int, int]]] = {}
+    async with db_conn(conn) as conn:
+        rows = await conn.fetch(RENEWAL_EXTEND_SQL, list(user_ids), now, days * 86400)
+        
+        # Avval asosiy guruh (users), keyin qo'shimcha guruhlar - bir guruh bir marta
+        for row in sorted(rows, key=lambda r: r['source'] != 'users'):
+            after_commit(conn, rearm_expiry, row['source'], row['user_id'], row['group_id'], row['expires_at'])
+            groups = renewed.setdefault(row['user_id'], [])
+            if not any(gid == row['group_id'] for gid, _exp in groups):
+                groups.append((row['group_id'], row['expires_at']))
+        if renewed:
+            after_commit(conn, dashboard_touch, *renewed)
+    return renewed
+
+async def approve_renewal_payment(pid: int, uid: int, admin_id: int, conn=None) -> Optional[list[tuple[int, int]]]:
     """
     Renewal payment'ni approve qilish - barcha hozirgi obunalarni +30 kun uzaytirish.
     Link yuborilmaydi, faqat hozirgi obunalar uzaytiriladi.
-    """
-    now = int(datetime.utcnow().timestamp())
-    new_exp = int((datetime.utcnow() + timedelta(days=SUBSCRIPTION_DAYS)).timestamp())
     
-    updated_groups = []
+    Bitta tranzaksiyada ishlaydi (conn berilsa - chaqiruvchining tranzaksiyasi ichida).
     
-    async with db_pool.acquire() as conn:
-        # 1. users jadvalidagi asosiy obunani uzaytirish
-        user_row = await conn.fetchrow(
-            "SELECT group_id, expires_at FROM users WHERE user_id = $1", uid
-        )
-        if user_row and user_row['group_id']:
-            gid = user_row['group_id']
-            current_exp = user_row['expires_at'] or now
-            # Hozirgi muddatdan +30 kun qo'shish
-            final_exp = max(current_exp, now) + (SUBSCRIPTION_DAYS * 86400)
-            await conn.execute(
-                "UPDATE users SET expires_at = $1 WHERE user_id = $2",
-                final_exp, uid
-            )
-            updated_groups.append((gid, final_exp))
+    Returns:
+        [(group_id, new_expires_at)]; payment allaqachon tasdiqlangan bo'lsa None;
+        obuna topilmasa [] (payment o'zgartirilmaydi)
+    """
+    async with db_transaction(conn) as conn:
+        if await lock_payment_for_approval(conn, pid) is None:
+            return None
         
-        # 2. user_groups jadvalidagi barcha obunalarni uzaytirish
-        user_groups_rows = await conn.fetch(
-            "SELECT group_id, expires_at FROM user_groups WHERE user_id = $1", uid
-        )
-        for row in user_groups_rows:
-            gid = row['group_id']
-            current_exp = row['expires_at'] or now
-            # Hozirgi muddatdan +30 kun qo'shish
-            final_exp = max(current_exp, now) + (SUBSCRIPTION_DAYS * 86400)
-            await conn.execute(
-                "UPDATE user_groups SET expires_at = $1 WHERE user_id = $2 AND group_id = $3",
-                final_exp, uid, gid
-            )
-            # Agar users'da yo'q bo'lsa, faqat user_groups'ga qo'shamiz
-            if not any(g[0] == gid for g in updated_groups):
-                updated_groups.append((gid, final_exp))
+        # Barcha obunalarni (users + user_groups) bitta so'rovda uzaytirish
+        updated_groups = (await renew_subscriptions_bulk([uid], conn=conn)).get(uid, [])
         
-        # 3. Payment status'ni approved qilish
-        await conn.execute(
-            "UPDATE payments SET status = $1, admin_id = $2 WHERE id = $3",
-            'approved', admin_id, pid
-        )
+        # Payment status'ni approved qilish (obuna bo'lmasa - tasdiqlanmaydi)
+        if updated_groups:
+            await set_payment_status(pid, "approved", admin_id, conn=conn)
     
     return updated_groups
 
+# ==================== APPROVAL SERVICE ====================
+# To'lovni tasdiqlash - bitta connection'da, bitta tranzaksiyada (unit of work):
+# payment holati, users qatori, barcha user_groups qatorlari va user'ga xabar (outbox).
+# Idempotentlik kaliti - payment qatori: FOR UPDATE NOWAIT bilan bloklanadi (boshqa
+# admin/jarayon ishlayotgan bo'lsa ApprovalInProgress), allaqachon tasdiqlangan bo'lsa
+# hech narsa o'zgarmaydi. Invite linklar faqat lock olgan tranzaksiya ichida yaratiladi.
+
+class ApprovalInProgress(Exception):
+    """Payment boshqa admin tomonidan hozir tasdiqlanmoqda (qator bloklangan)."""
+
+async def lock_payment_for_approval(conn, pid: int) -> Optional[PaymentRecord]:
+    """Payment qatorini tranzaksiya oxirigacha bloklash. Topilmasa yoki tasdiqlangan bo'lsa None."""
+    try:
+        row = await conn.fetchrow(
+            "SELECT id, user_id, status, photo_file, payment_type FROM payments WHERE id=$1 FOR UPDATE NOWAIT",
+            pid
+        )
+    except asyncpg.LockNotAvailableError:
+        raise ApprovalInProgress(pid)
+    if not row or row['status'] == "approved":
+        return None
+    return PaymentRecord(row)
+
+async def approve_initial_payment(pid: int, admin_id: int, user_id: int, username: str, full_name: str,
+                                  group_ids: list[int], expires_at: int, make_notify) -> bool:
+    """Dastlabki to'lovni tasdiqlash: group_ids[0] - asosiy guruh (users), qolganlari user_groups.
+    
+    make_notify() - user'ga xabar matnini qaytaruvchi coroutine; invite linklar shu yerda,
+    payment bloklangandan keyin yaratiladi (xato bo'lsa tranzaksiya bekor qilinadi).
+    
+    Returns:
+        False - payment allaqachon tasdiqlangan (hech narsa o'zgarmadi)
+    """
+    extra = [(user_id, gid, expires_at) for gid in group_ids[1:]]
+    async with db_transaction() as conn:
+        if await lock_payment_for_approval(conn, pid) is None:
+            return False
+        await upsert_user(uid=user_id, username=username, full_name=full_name, group_id=group_ids[0], expires_at=expires_at, conn=conn)
+        if extra:
+            stmt = await prepared(conn, "add_user_group")
+            await stmt.executemany(extra)
+            for _uid, gid, _exp in extra:
+                after_commit(conn, rearm_expiry, "user_groups", user_id, gid, expires_at)
+        await set_payment_status(pid, "approved", admin_id, conn=conn)
+        await enqueue_notification(conn, user_id, await make_notify(), parse_mode="Markdown")
+    notify_outbox()
+    return True
+
 async def update_user_course(uid: int, course_name: str):
     async with db_pool.acquire() as conn:
         await conn.execute("UPDATE users SET course_name=$1 WHERE user_id=$2", course_name, uid)
 
+# ==================== CONFIG CACHE ====================
+# payment_settings va contract_templates yilda bir necha marta o'zgaradi, lekin
+# har bir to'lov/shartnoma ekranida o'qiladi. Oxirgi versiyalar xotirada saqlanadi;
+# update_* funksiyalari cache'ni darhol yangilaydi, boshqa jarayonlar (API, bot
+# replikalari) esa trigger yuborgan NOTIFY orqali xabar topadi.
+
+CONFIG_CHANNEL = "config_changed"
+CONFIG_LISTEN_RETRY = 10  # LISTEN connection uzilsa, qayta ulanishdan oldin kutish (soniya)
+
+_CONFIG: dict[str, tuple[int, object]] = {}  # nom -> (versiya, qiymat)
+_CONTRACT_HISTORY: dict[int, str] = {}  # versiya -> matn (o'zgarmaydi, audit uchun)
+
+async def _load_payment_settings(conn) -> tuple[int, object]:
+    row = await conn.fetchrow(
+        "SELECT id, bank_name, card_number, amount, additional_info, video_link FROM payment_settings ORDER BY id DESC LIMIT 1"
+    )
+    return (row['id'], row) if row else (0, None)
+
+async def _load_contract_template(conn) -> tuple[int, object]:
+    row = await conn.fetchrow(
+        "SELECT id, template_text FROM contract_templates ORDER BY id DESC LIMIT 1"
+    )
+    if not row:
+        return 0, CONTRACT_TEXT
+    _CONTRACT_HISTORY[row['id']] = row['template_text']
+    return row['id'], row['template_text']
+
+_CONFIG_LOADERS = {
+    "payment_settings": _load_payment_settings,
+    "contract_templates": _load_contract_template,
+}
+
+async def reload_config(name: Optional[str] = None):
+    """Config'ni database'dan qayta yuklash (name=None - hammasi)."""
+    names = [name] if name else list(_CONFIG_LOADERS)
+    async with db_pool.acquire() as conn:
+        for key in names:
+            version, value = await _CONFIG_LOADERS[key](conn)
+            if _CONFIG.get(key, (None,))[0] != version:
+                logger.info(f"Config {key} loaded: version {version}")
+            _CONFIG[key] = (version, value)
+    if not name or name == "contract_templates":
+        await warm_contract_layout()
+
+async def _get_config(name: str) -> tuple[int, object]:
+    if name not in _CONFIG:
+        await reload_config(name)
+    return _CONFIG[name]
+
+def _on_config_notify(_conn, _pid, _channel, payload: str):
+    """NOTIFY kelganda tegishli config'ni qayta yuklash."""
+    if payload in _CONFIG_LOADERS:
+        asyncio.create_task(_reload_config_safe(payload))
+
+async def _reload_config_safe(name: Optional[str] = None):
+    try:
+        await reload_config(name)
+    except Exception as e:
+        logger.warning(f"Failed to reload config {name or 'all'}: {e}")
+
+async def pg_listen_loop(channel: str, callback, on_connect=None):
+    """Alohida connection'da LISTEN (uzilsa - qayta ulanadi).
+    
+    on_connect har ulanishda chaqiriladi - uzilish paytida o'tkazib yuborilgan
+    xabarlar o'rniga holatni to'liq qayta yuklash uchun.
+    """
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            closed = asyncio.Event()
+            conn.add_termination_listener(lambda _c: closed.set())
+            await conn.add_listener(channel, callback)
+            if on_connect:
+                await on_connect()
+            await closed.wait()
+            logger.warning(f"LISTEN {channel} connection lost, reconnecting")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"LISTEN {channel} error: {e}")
+        finally:
+            if conn and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(CONFIG_LISTEN_RETRY)
+
+async def config_listener_loop():
+    """LISTEN config_changed - boshqa jarayonlardagi sozlama o'zgarishlari."""
+    await pg_listen_loop(CONFIG_CHANNEL, _on_config_notify, _reload_config_safe)
+
+async def get_contract_template_version() -> tuple[int, str]:
+    """Hozirgi shartnoma versiyasi va matni (versiya 0 - standart CONTRACT_TEXT)."""
+    return await _get_config("contract_templates")
+
 async def get_contract_template() -> str:
     """Hozirgi shartnoma matnini olish."""
+    _version, template_text = await get_contract_template_version()
+    return template_text
+
+async def get_contract_template_by_version(version: int) -> Optional[str]:
+    """Shartnomaning ma'lum versiyasi (audit uchun)."""
+    if version in _CONTRACT_HISTORY:
+        return _CONTRACT_HISTORY[version]
     async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT template_text FROM contract_templates ORDER BY id DESC LIMIT 1"
+        text = await conn.fetchval("SELECT template_text FROM contract_templates WHERE id=$1", version)
+    if text is not None:
+        _CONTRACT_HISTORY[version] = text
+    return text
+
+async def list_contract_versions(limit: int = 10) -> list[tuple[int, int, int]]:
+    """Oxirgi shartnoma versiyalari: [(versiya, created_at, uzunlik)]."""
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT id, created_at, LENGTH(template_text) AS size FROM contract_templates ORDER BY id DESC LIMIT $1",
+            limit
         )
-        return row['template_text'] if row else CONTRACT_TEXT
+    return [(r['id'], r['created_at'], r['size']) for r in rows]
 
 async def update_contract_template(new_text: str):
     """Shartnoma matnini yangilash."""
@@ -509,14 +1371,12 @@ async def update_contract_template(new_text: str):
             INSERT INTO contract_templates(template_text, created_at, updated_at)
             VALUES($1, $2, $3)
         """, new_text, now, now)
+    await reload_config("contract_templates")
 
 async def get_payment_settings():
     """To'lov ma'lumotlarini olish."""
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT bank_name, card_number, amount, additional_info, video_link FROM payment_settings ORDER BY id DESC LIMIT 1"
-        )
-        return row if row else None
+    _version, settings = await _get_config("payment_settings")
+    return settings
 
 async def update_payment_settings(bank_name: str, card_number: str, amount: str, additional_info: str, video_link: str, admin_id: int):
     """To'lov ma'lumotlarini yangilash."""
@@ -526,6 +1386,7 @@ async def update_payment_settings(bank_name: str, card_number: str, amount: str,
             INSERT INTO payment_settings(bank_name, card_number, amount, additional_info, video_link, updated_at, updated_by)
             VALUES($1, $2, $3, $4, $5, $6, $7)
         """, bank_name, card_number, amount, additional_info, video_link, now, admin_id)
+    await reload_config("payment_settings")
 
 async def load_groups_from_db() -> list[int]:
     """Database'dan guruhlar ro'yxatini yuklash."""
@@ -542,11 +1403,13 @@ async def add_group_to_db(group_id: int, name: Optional[str] = None, chat_type:
             VALUES($1, $2, $3, $4)
             ON CONFLICT(group_id) DO UPDATE SET name=EXCLUDED.name, type=EXCLUDED.type
         """, group_id, name, now, chat_type)
+    set_group_title(group_id, name)
 
 async def remove_group_from_db(group_id: int):
     """Guruhni o'chirish."""
     async with db_pool.acquire() as conn:
         await conn.execute("DELETE FROM groups WHERE group_id=$1", group_id)
+    forget_group_title(group_id)
 
 async def get_all_groups():
     """Barcha guruhlarni olish (type bilan)."""
@@ -557,17 +1420,17 @@ async def clear_user_group(uid: int, gid: int):
     async with db_pool.acquire() as conn:
         await conn.execute("UPDATE users SET group_id=NULL WHERE user_id=$1 AND group_id=$2", uid, gid)
 
-async def add_user_group(uid: int, gid: int, expires_at: int):
-    async with db_pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO user_groups(user_id, group_id, expires_at)
-            VALUES($1,$2,$3)
-            ON CONFLICT(user_id, group_id) DO UPDATE SET expires_at=EXCLUDED.expires_at
-        """, uid, gid, expires_at)
+async def add_user_group(uid: int, gid: int, expires_at: int, conn=None):
+    async with db_conn(conn) as conn:
+        stmt = await prepared(conn, "add_user_group")
+        await stmt.fetchval(uid, gid, expires_at)
+        after_commit(conn, rearm_expiry, "user_groups", uid, gid, expires_at)
+        after_commit(conn, dashboard_touch, uid)
 
 async def clear_user_group_extra(uid: int, gid: int):
     async with db_pool.acquire() as conn:
         await conn.execute("DELETE FROM user_groups WHERE user_id=$1 AND group_id=$2", uid, gid)
+    dashboard_touch(uid)
 
 async def remove_user_completely(uid: int, admin_id: int) -> dict:
     """
@@ -615,6 +1478,7 @@ async def remove_user_completely(uid: int, admin_id: int) -> dict:
                 try:
                     await bot.ban_chat_member(gid, uid)
                     await bot.unban_chat_member(gid, uid)  # Ban'ni olib tashlash
+                    invalidate_member_status(gid, uid)
                     result['removed_from_groups'].append(gid)
                     logger.info(f"User {uid} removed from Telegram group {gid} by admin {admin_id}")
                 except Exception as e:
@@ -627,12 +1491,18 @@ async def remove_user_completely(uid: int, admin_id: int) -> dict:
             # user_groups jadvalidan o'chirish
             await conn.execute("DELETE FROM user_groups WHERE user_id=$1", uid)
             
-            # 4. Payment'larni 'removed' qilish (audit trail uchun saqlaymiz)
-            payments_result = await conn.execute(
-                "UPDATE payments SET status='removed' WHERE user_id=$1 AND status != 'removed'",
-                uid
-            )
-            result['payments_flagged'] = int(payments_result.split()[-1]) if payments_result else 0
+            # 4. Payment'larni 'removed' qilish (audit trail uchun saqlaymiz, hodisa bilan)
+            result['payments_flagged'] = await conn.fetchval("""
+                WITH p AS (
+                    UPDATE payments SET status='removed' WHERE user_id=$1 AND status != 'removed'
+                    RETURNING id, user_id
+                ), ev AS (
+                    INSERT INTO payment_events(payment_id, user_id, event, admin_id, created_at)
+                    SELECT id, user_id, 'removed', $2, $3 FROM p
+                )
+                SELECT COUNT(*) FROM p
+            """, uid, admin_id, int(datetime.utcnow().timestamp()))
+            dashboard_touch(uid)
             
             logger.info(f"User {uid} completely removed by admin {admin_id}: "
                        f"groups={result['removed_from_groups']}, payments_flagged={result['payments_flagged']}")
@@ -643,23 +1513,30 @@ async def remove_user_completely(uid: int, admin_id: int) -> dict:
         logger.error(f"Error in remove_user_completely for user {uid}: {e}")
         result['error'] = str(e)
     
-    # 5. Cache'larni tozalash (set va dict turlariga qarab)
-    # Sets - discard() ishlatamiz
-    WAIT_FULLNAME_FOR.discard(uid)
-    WAIT_CONTACT_FOR.discard(uid)
-    WAIT_PAYMENT_PHOTO.discard(uid)
-    
-    # Dict - pop() ishlatamiz
-    WAIT_DATE_FOR.pop(uid, None)
+    # 5. Suhbat holatlarini tozalash
+    for namespace in (WAIT_FULLNAME_FOR, WAIT_CONTACT_FOR, WAIT_CONTRACT_CONFIRM,
+                      WAIT_PAYMENT_PHOTO, WAIT_RENEWAL_RECEIPT, WAIT_DATE_FOR):
+        state_pop(namespace, uid)
     
     return result
 
-async def get_user(uid: int):
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT user_id, group_id, expires_at, username, full_name, phone, agreed_at FROM users WHERE user_id=$1", uid)
-        return (row['user_id'], row['group_id'], row['expires_at'], row['username'], row['full_name'], row['phone'], row['agreed_at']) if row else None
+async def get_user(uid: int, conn=None) -> Optional[UserRecord]:
+    async with db_conn(conn) as conn:
+        stmt = await prepared(conn, "get_user")
+        row = await stmt.fetchrow(uid)
+    return UserRecord(row) if row else None
 
 async def all_members_of_group(gid: int):
+    if SUBSCRIPTIONS_READY:
+        async with db_pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT s.user_id, u.username, u.full_name, s.expires_at, u.phone
+                FROM subscriptions s
+                LEFT JOIN users u ON u.user_id = s.user_id
+                WHERE s.group_id=$1
+            """, gid)
+        return [(r['user_id'], r['username'], r['full_name'], r['expires_at'], r['phone']) for r in rows]
+    
     async with db_pool.acquire() as conn:
         u_rows = await conn.fetch("SELECT user_id, username, full_name, expires_at, phone FROM users WHERE group_id=$1", gid)
         g_rows = await conn.fetch("""
@@ -675,67 +1552,287 @@ async def all_members_of_group(gid: int):
             merged[uid] = (username, full_name, exp, phone)
     return [(uid, data[0], data[1], data[2], data[3]) for uid, data in merged.items()]
 
-async def expired_users():
-    """Muddati tugagan userlar, lekin FAQAT 24 soatdan eski warning bor yoki hech warning yo'q."""
-    now = int(datetime.utcnow().timestamp())
-    threshold_24h = now - (24 * 60 * 60)  # 24 soat oldin
+# ==================== SUBSCRIPTIONS (UNIFIED) ====================
+# Backfill fonda, kichik partiyalarda bajariladi (bot ishlashini to'xtatmasdan).
+# Tugaguncha o'quvchi funksiyalar eski users + user_groups so'rovlaridan foydalanadi.
+
+SUBSCRIPTIONS_BACKFILL_BATCH = int(os.getenv("SUBSCRIPTIONS_BACKFILL_BATCH", "1000"))
+SUBSCRIPTIONS_READY = False  # backfill tugagach True - o'qish subscriptions jadvalidan
+SUBSCRIPTIONS_BACKFILL_MARKER = "subscriptions_backfill"  # app_markers'da - backfill bir marta bajariladi
+
+SUBSCRIPTIONS_BACKFILL_SQL = """
+INSERT INTO subscriptions(user_id, group_id, expires_at, last_warning_sent_at, is_primary, updated_at)
+SELECT user_id, group_id, MAX(COALESCE(expires_at, 0)), MAX(last_warning_sent_at), BOOL_OR(is_primary), $3
+FROM (
+    SELECT user_id, group_id, expires_at, last_warning_sent_at, TRUE AS is_primary
+    FROM users WHERE group_id IS NOT NULL AND user_id > $1 AND user_id <= $2
+    UNION ALL
+    SELECT user_id, group_id, expires_at, last_warning_sent_at, FALSE
+    FROM user_groups WHERE user_id > $1 AND user_id <= $2
+) src
+GROUP BY user_id, group_id
+ON CONFLICT (user_id, group_id) DO NOTHING
+"""
+
+def subscriptions_source() -> str:
+    """Obunalar manbasi (FROM uchun): subscriptions jadvali yoki eski users + user_groups."""
+    if SUBSCRIPTIONS_READY:
+        return "(SELECT user_id, group_id, expires_at, last_warning_sent_at FROM subscriptions)"
+    return """(
+        SELECT user_id, group_id, expires_at, last_warning_sent_at FROM users WHERE group_id IS NOT NULL
+        UNION ALL
+        SELECT user_id, group_id, expires_at, last_warning_sent_at FROM user_groups
+    )"""
+
+async def load_subscriptions_ready(conn):
+    """Backfill oldin tugagan bo'lsa (app_markers) - darhol subscriptions'dan o'qish."""
+    global SUBSCRIPTIONS_READY
+    SUBSCRIPTIONS_READY = await conn.fetchval(
+        "SELECT EXISTS(SELECT 1 FROM app_markers WHERE name=$1)", SUBSCRIPTIONS_BACKFILL_MARKER
+    )
+
+async def backfill_subscriptions():
+    """users + user_groups'dagi mavjud obunalarni subscriptions'ga partiyalab ko'chirish.
+    
+    Triggerlar db_init'da yaratilgani uchun backfill paytidagi yangi yozuvlar ham
+    ko'chiriladi; ON CONFLICT DO NOTHING trigger yozgan yangiroq qatorlarni buzmaydi.
+    Tugagach app_markers'ga yoziladi - keyingi ishga tushirishlarda qayta bajarilmaydi
+    (keyin subscriptions triggerlar orqali sinxron turadi).
+    """
+    global SUBSCRIPTIONS_READY
+    if SUBSCRIPTIONS_READY:
+        return
+    last_uid = 0
+    copied = 0
+    try:
+        while True:
+            async with db_pool.acquire() as conn:
+                upto = await conn.fetchval("""
+                    SELECT MAX(user_id) FROM (
+                        SELECT user_id FROM (
+                            SELECT user_id FROM users WHERE user_id > $1
+                            UNION
+                            SELECT user_id FROM user_groups WHERE user_id > $1
+                        ) ids
+                        ORDER BY user_id
+                        LIMIT $2
+                    ) batch
+                """, last_uid, SUBSCRIPTIONS_BACKFILL_BATCH)
+                if upto is None:
+                    break
+                result = await conn.execute(
+                    SUBSCRIPTIONS_BACKFILL_SQL, last_uid, upto, int(datetime.utcnow().timestamp())
+                )
+                copied += int(result.split()[-1])
+            last_uid = upto
+            await asyncio.sleep(0.05)  # boshqa so'rovlarga navbat berish
+        
+        # API eksporti ham subscriptions'dan o'qisin; view va marker bitta tranzaksiyada
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(SUBSCRIPTION_ROWS_READY_SQL)
+                await conn.execute(
+                    "INSERT INTO app_markers(name, created_at) VALUES($1, $2) ON CONFLICT (name) DO NOTHING",
+                    SUBSCRIPTIONS_BACKFILL_MARKER, int(datetime.utcnow().timestamp())
+                )
+        SUBSCRIPTIONS_READY = True
+        logger.info(f"Subscriptions backfill complete: {copied} row(s) copied, reads switched to subscriptions")
+    except Exception as e:
+        logger.error(f"Subscriptions backfill failed at user_id {last_uid}: {e} - legacy tables stay in use")
+
+async def expired_subscriptions():
+    """Muddati tugagan obunalar (subscriptions), FAQAT 24 soatdan eski warning bor yoki hech warning yo'q."""
+    return await _run_expiry_scan("expired_subscriptions")
+
+async def soon_expiring_subscriptions(days: int):
+    """days kun ichida expire bo'ladigan obunalar (subscriptions), FAQAT 24 soatdan eski warning bor yoki hech warning yo'q."""
+    return await _run_expiry_scan("soon_expiring_subscriptions", days)
+
+SUBSCRIPTION_STATS_SQL = """
+WITH subs AS (
+    SELECT user_id, group_id, expires_at FROM {source} src WHERE group_id = ANY($1::BIGINT[])
+),
+per_group AS (
+    SELECT group_id, user_id, MAX(COALESCE(expires_at, 0)) AS exp
+    FROM subs
+    GROUP BY group_id, user_id
+),
+per_user AS (
+    SELECT user_id, MAX(exp) AS exp FROM per_group GROUP BY user_id
+)
+SELECT NULL::BIGINT AS group_id,
+       COUNT(*) AS total,
+       COUNT(*) FILTER (WHERE exp > $2) AS active,
+       COUNT(*) FILTER (WHERE exp > 0 AND exp <= $2) AS expired
+FROM per_user
+UNION ALL
+SELECT group_id,
+       COUNT(*),
+       COUNT(*) FILTER (WHERE exp > $2),
+       COUNT(*) FILTER (WHERE exp > 0 AND exp <= $2)
+FROM per_group
+GROUP BY group_id
+"""
+
+async def subscription_stats(group_ids: list[int], now: Optional[int] = None) -> dict:
+    """Guruhlar bo'yicha statistika bitta SQL so'rov bilan.
+    
+    Returns:
+        {"total", "active", "expired"} - unique userlar bo'yicha,
+        "groups": {group_id: {"total", "active", "expired"}}
+    """
+    now = now or int(datetime.utcnow().timestamp())
+    result = {"total": 0, "active": 0, "expired": 0, "groups": {}}
+    if not group_ids:
+        return result
     
     async with db_pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT u.user_id, u.group_id, u.expires_at 
-            FROM users u
-            INNER JOIN groups g ON u.group_id = g.group_id
-            WHERE u.expires_at > 0 AND u.expires_at <= $1
-              AND (u.last_warning_sent_at IS NULL OR u.last_warning_sent_at < $2)
-        """, now, threshold_24h)
-        return [(r['user_id'], r['group_id'], r['expires_at']) for r in rows]
+        rows = await conn.fetch(SUBSCRIPTION_STATS_SQL.format(source=subscriptions_source()), list(group_ids), now)
+    
+    for row in rows:
+        counts = {"total": row['total'], "active": row['active'], "expired": row['expired']}
+        if row['group_id'] is None:
+            result.update(counts)
+        else:
+            result["groups"][row['group_id']] = counts
+    return result
 
-async def expired_user_groups():
-    """Muddati tugagan user_groups, lekin FAQAT 24 soatdan eski warning bor yoki hech warning yo'q."""
-    now = int(datetime.utcnow().timestamp())
-    threshold_24h = now - (24 * 60 * 60)  # 24 soat oldin
+async def members_of_groups(group_ids: list[int]) -> dict[int, list[tuple]]:
+    """Bir nechta guruh a'zolari bitta so'rov bilan (all_members_of_group formatida).
+    
+    Returns:
+        {group_id: [(uid, username, full_name, exp, phone), ...]}
+    """
+    result: dict[int, list[tuple]] = {gid: [] for gid in group_ids}
+    if not group_ids:
+        return result
     
     async with db_pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT ug.user_id, ug.group_id, ug.expires_at 
-            FROM user_groups ug
-            INNER JOIN groups g ON ug.group_id = g.group_id
-            WHERE ug.expires_at > 0 AND ug.expires_at <= $1
-              AND (ug.last_warning_sent_at IS NULL OR ug.last_warning_sent_at < $2)
-        """, now, threshold_24h)
-        return [(r['user_id'], r['group_id'], r['expires_at']) for r in rows]
+        rows = await conn.fetch(f"""
+            SELECT DISTINCT ON (s.group_id, s.user_id)
+                   s.group_id, s.user_id, u.username, u.full_name, s.expires_at, u.phone
+            FROM {subscriptions_source()} s
+            LEFT JOIN users u ON u.user_id = s.user_id
+            WHERE s.group_id = ANY($1::BIGINT[])
+            ORDER BY s.group_id, s.user_id, COALESCE(s.expires_at, 0) DESC
+        """, list(group_ids))
+    
+    for r in rows:
+        result[r['group_id']].append((r['user_id'], r['username'], r['full_name'], r['expires_at'], r['phone']))
+    return result
 
-async def soon_expiring_users(days: int):
-    """3 kun ichida expire bo'ladigan userlar, lekin FAQAT 24 soatdan eski warning bor yoki hech warning yo'q."""
+# Muddat skanerlari: "expires_at > 0" har bir so'rovda bor - partial index'lar
+# (EXPIRY_INDEXES_SQL) generic plan'da ham ishlatilishi uchun
+EXPIRY_SCAN_SQL = {
+    "expired_users": """
+        SELECT u.user_id, u.group_id, u.expires_at 
+        FROM users u
+        INNER JOIN groups g ON u.group_id = g.group_id
+        WHERE u.expires_at > 0 AND u.expires_at <= $1
+          AND (u.last_warning_sent_at IS NULL OR u.last_warning_sent_at < $2)
+    """,
+    "expired_user_groups": """
+        SELECT ug.user_id, ug.group_id, ug.expires_at 
+        FROM user_groups ug
+        INNER JOIN groups g ON ug.group_id = g.group_id
+        WHERE ug.expires_at > 0 AND ug.expires_at <= $1
+          AND (ug.last_warning_sent_at IS NULL OR ug.last_warning_sent_at < $2)
+    """,
+    "soon_expiring_users": """
+        SELECT u.user_id, u.group_id, u.expires_at 
+        FROM users u
+        INNER JOIN groups g ON u.group_id = g.group_id
+        WHERE u.expires_at > 0 AND u.expires_at > $1 AND u.expires_at <= $2
+          AND (u.last_warning_sent_at IS NULL OR u.last_warning_sent_at < $3)
+    """,
+    "soon_expiring_user_groups": """
+        SELECT ug.user_id, ug.group_id, ug.expires_at 
+        FROM user_groups ug
+        INNER JOIN groups g ON ug.group_id = g.group_id
+        WHERE ug.expires_at > 0 AND ug.expires_at > $1 AND ug.expires_at <= $2
+          AND (ug.last_warning_sent_at IS NULL OR ug.last_warning_sent_at < $3)
+    """,
+    "expired_subscriptions": """
+        SELECT s.user_id, s.group_id, s.expires_at 
+        FROM subscriptions s
+        INNER JOIN groups g ON s.group_id = g.group_id
+        WHERE s.expires_at > 0 AND s.expires_at <= $1
+          AND (s.last_warning_sent_at IS NULL OR s.last_warning_sent_at < $2)
+    """,
+    "soon_expiring_subscriptions": """
+        SELECT s.user_id, s.group_id, s.expires_at 
+        FROM subscriptions s
+        INNER JOIN groups g ON s.group_id = g.group_id
+        WHERE s.expires_at > 0 AND s.expires_at > $1 AND s.expires_at <= $2
+          AND (s.last_warning_sent_at IS NULL OR s.last_warning_sent_at < $3)
+    """,
+}
+
+def _expiry_scan_args(name: str, days: int = REMIND_DAYS) -> tuple:
+    """Skan parametrlari: (now, [upper,] threshold_24h)."""
     now = int(datetime.utcnow().timestamp())
-    upper = now + days * 86400
     threshold_24h = now - (24 * 60 * 60)  # 24 soat oldin
-    
+    if name.startswith("soon_"):
+        return now, now + days * 86400, threshold_24h
+    return now, threshold_24h
+
+async def _run_expiry_scan(name: str, days: int = REMIND_DAYS) -> list[tuple[int, int, int]]:
     async with db_pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT u.user_id, u.group_id, u.expires_at 
-            FROM users u
-            INNER JOIN groups g ON u.group_id = g.group_id
-            WHERE u.expires_at > $1 AND u.expires_at <= $2
-              AND (u.last_warning_sent_at IS NULL OR u.last_warning_sent_at < $3)
-        """, now, upper, threshold_24h)
+        rows = await conn.fetch(EXPIRY_SCAN_SQL[name], *_expiry_scan_args(name, days))
         return [(r['user_id'], r['group_id'], r['expires_at']) for r in rows]
 
+async def expired_users():
+    """Muddati tugagan userlar, lekin FAQAT 24 soatdan eski warning bor yoki hech warning yo'q."""
+    return await _run_expiry_scan("expired_users")
+
+async def expired_user_groups():
+    """Muddati tugagan user_groups, lekin FAQAT 24 soatdan eski warning bor yoki hech warning yo'q."""
+    return await _run_expiry_scan("expired_user_groups")
+
+async def soon_expiring_users(days: int):
+    """3 kun ichida expire bo'ladigan userlar, lekin FAQAT 24 soatdan eski warning bor yoki hech warning yo'q."""
+    return await _run_expiry_scan("soon_expiring_users", days)
+
 async def soon_expiring_user_groups(days: int):
     """3 kun ichida expire bo'ladigan user_groups, lekin FAQAT 24 soatdan eski warning bor yoki hech warning yo'q."""
-    now = int(datetime.utcnow().timestamp())
-    upper = now + days * 86400
-    threshold_24h = now - (24 * 60 * 60)  # 24 soat oldin
+    return await _run_expiry_scan("soon_expiring_user_groups", days)
+
+def _plan_scans(plan: dict) -> list[tuple[str, str, str]]:
+    """EXPLAIN daraxtidagi jadval skanlari: [(jadval, skan turi, index)]."""
+    scans = []
+    if plan.get("Relation Name"):
+        scans.append((plan["Relation Name"], plan["Node Type"], plan.get("Index Name") or ""))
+    for child in plan.get("Plans", []):
+        scans.extend(_plan_scans(child))
+    return scans
+
+EXPIRY_INDEX_RE = re.compile(r"^idx_\w+_expiry")
+
+async def explain_expiry_scans(conn=None) -> dict[str, dict]:
+    """Har bir muddat skaneri uchun EXPLAIN ANALYZE: asosiy jadval skan turi va vaqti.
     
-    async with db_pool.acquire() as conn:
-        rows = await conn.fetch("""
-            SELECT ug.user_id, ug.group_id, ug.expires_at 
-            FROM user_groups ug
-            INNER JOIN groups g ON ug.group_id = g.group_id
-            WHERE ug.expires_at > $1 AND ug.expires_at <= $2
-              AND (ug.last_warning_sent_at IS NULL OR ug.last_warning_sent_at < $3)
-        """, now, upper, threshold_24h)
-        return [(r['user_id'], r['group_id'], r['expires_at']) for r in rows]
+    Returns:
+        {skan nomi: {'table', 'node', 'index', 'ms', 'ok'}} - ok: idx_*_expiry* bo'yicha
+        Index Only Scan (covering index heap'ga murojaat qilmaydi)
+    """
+    report = {}
+    async with db_conn(conn) as conn:
+        for name, sql in EXPIRY_SCAN_SQL.items():
+            table = re.search(r"FROM (\w+)", sql).group(1)
+            raw = await conn.fetchval(f"EXPLAIN (ANALYZE, FORMAT JSON) {sql}", *_expiry_scan_args(name))
+            result = (json.loads(raw) if isinstance(raw, str) else raw)[0]
+            node, index = next(
+                ((n, i) for rel, n, i in _plan_scans(result["Plan"]) if rel == table),
+                ("?", "")
+            )
+            report[name] = {
+                "table": table,
+                "node": node,
+                "index": index,
+                "ms": result.get("Execution Time", 0.0),
+                "ok": node == "Index Only Scan" and bool(EXPIRY_INDEX_RE.match(index)),
+            }
+    return report
 
 def start_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -835,6 +1932,87 @@ def user_reply_keyboard() -> ReplyKeyboardMarkup:
         persistent=True  # Doimiy ko'rinib turadi
     )
 
+# ==================== GROUP TITLE CACHE ====================
+# resolve_group_titles() o'nlab handlerlardan chaqiriladi. Guruh nomlari xotirada
+# saqlanadi: fonda yangilanadi, add/remove_group_from_db orqali o'zgartiriladi,
+# noma'lum nomlar uchun get_chat parallel va takrorlanmasdan chaqiriladi.
+
+GROUP_TITLE_REFRESH = int(os.getenv("GROUP_TITLE_REFRESH", "600"))  # soniya
+
+_GROUP_TITLES: dict[int, str] = {}  # group_id -> real nom (default "Guruh #N" emas)
+_GROUP_TITLES_LOADED = False
+_TITLE_LOOKUPS: dict[int, asyncio.Task] = {}  # hozir bajarilayotgan get_chat so'rovlari
+_TITLE_FAILED: set[int] = set()  # get_chat xato bergan guruhlar (keyingi refresh'gacha)
+
+def _is_real_title(name: Optional[str]) -> bool:
+    """Faqat real nomlar, default "Guruh #N" emas."""
+    return bool(name and name.strip() and not name.startswith("Guruh #"))
+
+def set_group_title(group_id: int, name: Optional[str]):
+    """Cache'dagi guruh nomini yangilash."""
+    _TITLE_FAILED.discard(group_id)
+    if _is_real_title(name):
+        _GROUP_TITLES[group_id] = name
+    else:
+        _GROUP_TITLES.pop(group_id, None)
+
+def forget_group_title(group_id: int):
+    """O'chirilgan guruhni cache'dan olib tashlash."""
+    _GROUP_TITLES.pop(group_id, None)
+    _TITLE_FAILED.discard(group_id)
+
+async def refresh_group_titles():
+    """Database'dan barcha guruh nomlarini qayta yuklash."""
+    global _GROUP_TITLES_LOADED
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("SELECT group_id, name FROM groups")
+    titles = {row['group_id']: row['name'] for row in rows if _is_real_title(row['name'])}
+    _GROUP_TITLES.clear()
+    _GROUP_TITLES.update(titles)
+    _TITLE_FAILED.clear()
+    _GROUP_TITLES_LOADED = True
+
+async def group_titles_refresh_loop():
+    """Guruh nomlarini fonda davriy yangilash."""
+    while True:
+        await asyncio.sleep(GROUP_TITLE_REFRESH)
+        try:
+            await refresh_group_titles()
+        except Exception as e:
+            logger.warning(f"Failed to refresh group titles: {e}")
+
+async def _lookup_group_title(gid: int):
+    """Telegram API'dan guruh nomini olish va database'ni yangilash."""
+    try:
+        chat = await bot.get_chat(gid)
+        title = chat.title or str(gid)
+    except Exception as e:
+        logger.warning(f"Failed to get title for group {gid}: {e}")
+        _TITLE_FAILED.add(gid)
+        return
+    
+    # Database'ni yangilash (agar nom topilsa)
+    if title != str(gid):
+        _GROUP_TITLES[gid] = title
+        try:
+            async with db_pool.acquire() as conn:
+                await conn.execute(
+                    "UPDATE groups SET name=$1 WHERE group_id=$2",
+                    title, gid
+                )
+            logger.info(f"Updated group name in database: {gid} -> {title}")
+        except Exception as update_err:
+            logger.warning(f"Failed to update group name in database: {update_err}")
+
+async def _ensure_group_title(gid: int):
+    """Bir guruh uchun bitta get_chat so'rovi (parallel chaqiruvlar bitta task'ni kutadi)."""
+    task = _TITLE_LOOKUPS.get(gid)
+    if task is None:
+        task = asyncio.create_task(_lookup_group_title(gid))
+        _TITLE_LOOKUPS[gid] = task
+        task.add_done_callback(lambda _t: _TITLE_LOOKUPS.pop(gid, None))
+    await asyncio.shield(task)
+
 async def resolve_group_titles(group_ids: Optional[list[int]] = None) -> list[tuple[int, str]]:
     """Guruh ID'larini nomlariga aylantirish.
     
@@ -846,47 +2024,19 @@ async def resolve_group_titles(group_ids: Optional[list[int]] = None) -> list[tu
     """
     ids_to_resolve = group_ids if group_ids is not None else GROUP_IDS
     
-    # 1. Database'dan barcha guruh nomlarini olish
-    db_titles = {}
-    try:
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch("SELECT group_id, name FROM groups")
-            for row in rows:
-                # Faqat real nomlar, default "Guruh #N" emas
-                if row['name'] and row['name'].strip() and not row['name'].startswith("Guruh #"):
-                    db_titles[row['group_id']] = row['name']
-    except Exception as e:
-        logger.warning(f"Failed to fetch group names from database: {e}")
-    
-    # 2. Har bir guruh uchun nom aniqlash
-    result = []
-    for gid in ids_to_resolve:
-        # Avval database'dan nom olish
-        if gid in db_titles:
-            title = db_titles[gid]
-        else:
-            # Database'da nom yo'q yoki default nom bo'lsa, Telegram API'dan olish
-            try:
-                chat = await bot.get_chat(gid)
-                title = chat.title or str(gid)
-                
-                # Database'ni yangilash (agar nom topilsa)
-                if title != str(gid):
-                    try:
-                        async with db_pool.acquire() as conn:
-                            await conn.execute(
-                                "UPDATE groups SET name=$1 WHERE group_id=$2",
-                                title, gid
-                            )
-                        logger.info(f"Updated group name in database: {gid} -> {title}")
-                    except Exception as update_err:
-                        logger.warning(f"Failed to update group name in database: {update_err}")
-            except Exception as e:
-                logger.warning(f"Failed to get title for group {gid}: {e}")
-                title = str(gid)
-        
-        result.append((gid, title))
-    return result
+    # 1. Birinchi chaqiruvda database'dan nomlarni yuklash
+    if not _GROUP_TITLES_LOADED:
+        try:
+            await refresh_group_titles()
+        except Exception as e:
+            logger.warning(f"Failed to fetch group names from database: {e}")
+    
+    # 2. Nomi noma'lum guruhlar uchun Telegram API (parallel, takrorlanmasdan)
+    missing = [gid for gid in dict.fromkeys(ids_to_resolve) if gid not in _GROUP_TITLES and gid not in _TITLE_FAILED]
+    if missing:
+        await asyncio.gather(*(_ensure_group_title(gid) for gid in missing), return_exceptions=True)
+    
+    return [(gid, _GROUP_TITLES.get(gid, str(gid))) for gid in ids_to_resolve]
 
 async def get_group_type(group_id: int) -> str:
     """Guruh yoki kanal turini database'dan olish."""
@@ -932,29 +2082,69 @@ def is_super_admin(uid: int) -> bool:
     """Super admin tekshirish (ADMIN_IDS'da bo'lganlar)"""
     return uid in ADMIN_IDS
 
+# ==================== ADMIN AUTH CACHE ====================
+# Har bir admin tugmasi/callback is_active_admin + get_allowed_groups + check_group_access
+# chaqiradi. admins jadvali kamdan-kam o'zgaradi, shuning uchun ma'lumot xotirada
+# saqlanadi (TTL + admin helperlari orqali aniq invalidatsiya).
+
+ADMIN_CACHE_TTL = int(os.getenv("ADMIN_CACHE_TTL", "300"))  # soniya
+
+# user_id -> (yuklangan vaqt, {"active", "expires_at", "managed_groups", "managed_order"} yoki None)
+_ADMIN_CACHE: dict[int, tuple[float, Optional[dict]]] = {}
+
+# group_id -> [(admin_id, expires_at)] - admin_groups'dan faol adminlar (teskari indeks)
+_GROUP_ADMINS: dict[int, list[tuple[int, Optional[int]]]] = {}
+_SUPER_DB_ADMINS: list[tuple[int, Optional[int]]] = []  # role = 'super_admin' (barcha guruhlar)
+_GROUP_ADMINS_LOADED_AT: Optional[float] = None
+
+def invalidate_admin_cache(uid: Optional[int] = None):
+    """Admin cache'ni tozalash (uid berilmasa - hammasi)."""
+    global _GROUP_ADMINS_LOADED_AT
+    _GROUP_ADMINS_LOADED_AT = None  # guruh -> adminlar indeksi ham qayta yuklanadi
+    if uid is None:
+        _ADMIN_CACHE.clear()
+    else:
+        _ADMIN_CACHE.pop(uid, None)
+
+async def get_admin_auth(uid: int) -> Optional[dict]:
+    """Adminning ruxsat ma'lumotlari (cache orqali). Admin bo'lmasa - None."""
+    cached = _ADMIN_CACHE.get(uid)
+    if cached and time.monotonic() - cached[0] < ADMIN_CACHE_TTL:
+        return cached[1]
+    
+    async with db_pool.acquire() as conn:
+        row = await conn.fetchrow("""
+            SELECT active, expires_at, managed_groups FROM admins 
+            WHERE user_id = $1
+        """, uid)
+    
+    entry = None
+    if row:
+        managed = tuple(row['managed_groups'] or ())
+        entry = {
+            "active": bool(row['active']),
+            "expires_at": row['expires_at'],
+            "managed_groups": frozenset(managed),
+            "managed_order": managed,  # allowed_groups[0] asosiy guruh sifatida ishlatiladi
+        }
+    _ADMIN_CACHE[uid] = (time.monotonic(), entry)
+    return entry
+
 async def is_active_admin(uid: int) -> bool:
     """Faol admin yoki super admin tekshirish (database + ADMIN_IDS)"""
     if uid in ADMIN_IDS:
         return True
     
     try:
-        async with db_pool.acquire() as conn:
-            now = int(datetime.utcnow().timestamp())
-            row = await conn.fetchrow("""
-                SELECT active, expires_at FROM admins 
-                WHERE user_id = $1
-            """, uid)
-            
-            if not row:
-                return False
-            
-            if not row['active']:
-                return False
-            
-            if row['expires_at'] and row['expires_at'] < now:
-                return False
-            
-            return True
+        auth = await get_admin_auth(uid)
+        if not auth or not auth['active']:
+            return False
+        
+        now = int(datetime.utcnow().timestamp())
+        if auth['expires_at'] and auth['expires_at'] < now:
+            return False
+        
+        return True
     except Exception as e:
         logger.error(f"Error checking active admin {uid}: {e}")
         return False
@@ -982,26 +2172,35 @@ async def add_admin_to_db(user_id: int, name: str, role: str, created_by: int, e
                 max_groups = $8,
                 tariff = $9
         """, user_id, name, role, now, expires_at, created_by, managed_groups or [], max_groups, tariff)
+    invalidate_admin_cache(user_id)
+    rearm_expiry("admins", user_id, None, expires_at)
 
 async def remove_admin_from_db(user_id: int):
     """Adminni o'chirish"""
     async with db_pool.acquire() as conn:
         await conn.execute("DELETE FROM admins WHERE user_id = $1", user_id)
+    invalidate_admin_cache(user_id)
 
 async def pause_admin(user_id: int):
     """Adminni to'xtatish"""
     async with db_pool.acquire() as conn:
         await conn.execute("UPDATE admins SET active = FALSE WHERE user_id = $1", user_id)
+    invalidate_admin_cache(user_id)
 
 async def resume_admin(user_id: int):
     """Adminni qayta faollashtirish"""
     async with db_pool.acquire() as conn:
-        await conn.execute("UPDATE admins SET active = TRUE WHERE user_id = $1", user_id)
+        row = await conn.fetchrow("UPDATE admins SET active = TRUE WHERE user_id = $1 RETURNING expires_at", user_id)
+    invalidate_admin_cache(user_id)
+    if row:
+        rearm_expiry("admins", user_id, None, row['expires_at'])
 
 async def extend_admin(user_id: int, new_expires_at: int):
     """Admin muddatini uzaytirish"""
     async with db_pool.acquire() as conn:
         await conn.execute("UPDATE admins SET expires_at = $1 WHERE user_id = $2", new_expires_at, user_id)
+    invalidate_admin_cache(user_id)
+    rearm_expiry("admins", user_id, None, new_expires_at)
 
 async def get_all_admins():
     """Barcha adminlar ro'yxati"""
@@ -1029,19 +2228,13 @@ async def get_allowed_groups(uid: int) -> list[int]:
     if is_super_admin(uid):
         return GROUP_IDS
     
-    # Database'dan adminning managed_groups'ini olish
-    async with db_pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            SELECT managed_groups FROM admins 
-            WHERE user_id = $1 AND active = TRUE
-        """, uid)
-        
-        if row and row['managed_groups']:
-            # Faqat mavjud guruhlarni qaytarish
-            managed = list(row['managed_groups'])
-            return [gid for gid in managed if gid in GROUP_IDS]
-        
-        return []
+    # Cache'dan adminning managed_groups'ini olish
+    auth = await get_admin_auth(uid)
+    if auth and auth['active'] and auth['managed_order']:
+        # Faqat mavjud guruhlarni qaytarish
+        return [gid for gid in auth['managed_order'] if gid in GROUP_IDS]
+    
+    return []
 
 async def check_group_access(admin_id: int, group_id: int) -> bool:
     """Adminning guruhga ruxsati borligini tekshirish.
@@ -1050,18 +2243,340 @@ async def check_group_access(admin_id: int, group_id: int) -> bool:
         True - agar admin guruhga ruxsat etilgan bo'lsa
         False - agar admin guruhga ruxsat etilmagan bo'lsa
     """
-    allowed_groups = await get_allowed_groups(admin_id)
-    return group_id in allowed_groups
+    if is_super_admin(admin_id):
+        return group_id in GROUP_IDS
+    
+    auth = await get_admin_auth(admin_id)
+    return bool(auth and auth['active'] and group_id in auth['managed_groups'] and group_id in GROUP_IDS)
+
+async def _load_group_admins():
+    """Guruh -> adminlar indeksini bitta so'rovda yuklash."""
+    global _GROUP_ADMINS_LOADED_AT
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch("""
+            SELECT a.user_id, a.role, a.expires_at, ag.group_id
+            FROM admins a
+            LEFT JOIN admin_groups ag ON ag.admin_id = a.user_id
+            WHERE a.active = TRUE
+        """)
+    by_group: dict[int, list[tuple[int, Optional[int]]]] = {}
+    supers: dict[int, Optional[int]] = {}
+    for row in rows:
+        if row['role'] == 'super_admin':
+            supers[row['user_id']] = row['expires_at']
+        if row['group_id'] is not None:
+            by_group.setdefault(row['group_id'], []).append((row['user_id'], row['expires_at']))
+    _GROUP_ADMINS.clear()
+    _GROUP_ADMINS.update(by_group)
+    _SUPER_DB_ADMINS[:] = list(supers.items())
+    _GROUP_ADMINS_LOADED_AT = time.monotonic()
+
+async def group_admin_ids(group_id: int, include_env_admins: bool = True) -> list[int]:
+    """Guruhga ruxsati bor faol (muddati o'tmagan) adminlar - xotiradagi indeksdan.
+    
+    Database'dagi super_admin'lar har doim qo'shiladi.
+    
+    Args:
+        include_env_admins: ADMIN_IDS (environment) super adminlarini ham qo'shish
+    """
+    if _GROUP_ADMINS_LOADED_AT is None or time.monotonic() - _GROUP_ADMINS_LOADED_AT >= ADMIN_CACHE_TTL:
+        await _load_group_admins()
+    
+    now = int(datetime.utcnow().timestamp())
+    candidates = _SUPER_DB_ADMINS + _GROUP_ADMINS.get(group_id, [])
+    if include_env_admins:
+        candidates = [(aid, None) for aid in ADMIN_IDS] + candidates
+    return list(dict.fromkeys(aid for aid, exp in candidates if not exp or exp > now))
+
+# ==================== MEMBERSHIP CACHE ====================
+# bot.get_chat_member natijalari (group_id, user_id) bo'yicha qisqa muddat saqlanadi.
+# on_chat_member_updated join/leave event'lari cache'ni yangilab turadi, shuning
+# uchun statistika qayta ochilganda Telegram'ga so'rov ketmaydi.
+
+MEMBER_CACHE_TTL = int(os.getenv("MEMBER_CACHE_TTL", "120"))  # get_chat_member natijasi (soniya)
+MEMBER_EVENT_TTL = int(os.getenv("MEMBER_EVENT_TTL", "1800"))  # chat_member event'idan kelgan holat
+ACTIVE_MEMBER_STATUSES = ("member", "administrator", "creator")
+
+# (group_id, user_id) -> (amal qilish muddati, status)
+_MEMBER_CACHE: dict[tuple[int, int], tuple[float, str]] = {}
+
+def set_member_status(group_id: int, user_id: int, status: str, ttl: Optional[int] = None):
+    """Cache'ga a'zolik holatini yozish."""
+    if len(_MEMBER_CACHE) > 50000:
+        now = time.monotonic()
+        for key in [k for k, (until, _s) in _MEMBER_CACHE.items() if until < now]:
+            del _MEMBER_CACHE[key]
+    _MEMBER_CACHE[(group_id, user_id)] = (time.monotonic() + (ttl or MEMBER_CACHE_TTL), status)
+
+def invalidate_member_status(group_id: int, user_id: int):
+    """Cache'dan a'zolik holatini o'chirish."""
+    _MEMBER_CACHE.pop((group_id, user_id), None)
+
+async def get_member_status(group_id: int, user_id: int) -> str:
+    """User'ning guruhdagi statusi (cache orqali).
+    
+    Telegram xatolarini (chat not found va h.k.) o'zgartirmasdan ko'taradi - xatolar cache'lanmaydi.
+    """
+    cached = _MEMBER_CACHE.get((group_id, user_id))
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    member = await bot.get_chat_member(group_id, user_id)
+    set_member_status(group_id, user_id, member.status)
+    return member.status
+
+async def is_group_member(group_id: int, user_id: int) -> bool:
+    """User guruhda (member/administrator/creator) ekanligini tekshirish; xato bo'lsa False."""
+    try:
+        return await get_member_status(group_id, user_id) in ACTIVE_MEMBER_STATUSES
+    except Exception:
+        return False
+
+# ==================== TOKEN BUCKET ====================
+
+def new_token_bucket(rate: float, burst: Optional[float] = None) -> dict:
+    """Token bucket yaratish (rate - soniyasiga token, burst - bir zumda olinadigan maksimal token)."""
+    burst = burst or max(rate, 1.0)
+    return {"rate": rate, "burst": burst, "tokens": burst, "ts": 0.0, "blocked_until": 0.0, "lock": asyncio.Lock()}
+
+async def take_token(bucket: dict):
+    """Bucket'dan bitta token olish (token yo'q bo'lsa kutish, navbat bo'yicha)."""
+    loop = asyncio.get_running_loop()
+    async with bucket["lock"]:
+        while True:
+            now = loop.time()
+            if bucket["blocked_until"] > now:
+                await asyncio.sleep(bucket["blocked_until"] - now)
+                continue
+            rate = bucket["rate"]
+            bucket["tokens"] = min(bucket["burst"], bucket["tokens"] + (now - bucket["ts"]) * rate)
+            bucket["ts"] = now
+            if bucket["tokens"] >= 1:
+                bucket["tokens"] -= 1
+                return
+            await asyncio.sleep((1 - bucket["tokens"]) / rate)
+
+def block_token_bucket(bucket: dict, seconds: float):
+    """TelegramRetryAfter kelganda bucket'ni vaqtincha to'xtatish."""
+    until = asyncio.get_running_loop().time() + seconds
+    bucket["blocked_until"] = max(bucket["blocked_until"], until)
+
+# ==================== TELEGRAM RATE LIMITER ====================
+# Bot session middleware: barcha chiqadigan xabarlar shu yerdan o'tadi.
+# Global bucket (~30 msg/s), har bir chat uchun 1 msg/s, guruh/kanal chatlari uchun
+# 20 msg/min. TelegramRetryAfter kelsa tegishli bucket to'xtatiladi va so'rov qayta yuboriladi.
+
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))  # msg/s
+TG_PER_CHAT_RATE = 1.0  # msg/s (shaxsiy chat)
+TG_GROUP_CHAT_RATE = 20 / 60  # msg/s (guruh/kanal)
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+# Limitga tushadigan API metodlari (send_message, send_photo, copy_message, edit_message_text, ...)
+TG_LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+
+_TG_GLOBAL_BUCKET = new_token_bucket(TG_GLOBAL_RATE)
+TG_CHAT_BUCKETS_MAX = 10000  # shundan ko'p bo'lsa bo'sh turgan bucket'lar tozalanadi
+_TG_CHAT_BUCKETS: dict = {}  # chat_id -> bucket
+_TG_METRICS = {
+    "requests": 0,        # limitdan o'tgan so'rovlar
+    "waiting": 0,         # hozir navbatda turganlar (queue depth)
+    "max_waiting": 0,
+    "wait_total": 0.0,    # jami kutish vaqti (soniya)
+    "wait_max": 0.0,
+    "retry_after": 0,     # TelegramRetryAfter soni
+}
+
+def token_bucket_idle(bucket: dict, now: float) -> bool:
+    """Bucket hozir to'la bo'larmidi (tokens faqat take_token'da to'ldiriladi - shu yerda hisoblanadi)."""
+    if bucket["lock"].locked() or bucket["blocked_until"] > now:
+        return False
+    return bucket["tokens"] + (now - bucket["ts"]) * bucket["rate"] >= bucket["burst"]
+
+def _tg_chat_bucket(chat_id) -> dict:
+    bucket = _TG_CHAT_BUCKETS.get(chat_id)
+    if bucket is None:
+        if len(_TG_CHAT_BUCKETS) > TG_CHAT_BUCKETS_MAX:
+            # To'lib bo'lgan (ishlatilmayotgan) bucket'larni tashlab yuborish - yangisi bilan bir xil holat
+            now = asyncio.get_running_loop().time()
+            for cid in [cid for cid, b in _TG_CHAT_BUCKETS.items() if token_bucket_idle(b, now)]:
+                del _TG_CHAT_BUCKETS[cid]
+        is_group = isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+        bucket = new_token_bucket(TG_GROUP_CHAT_RATE if is_group else TG_PER_CHAT_RATE, burst=1)
+        _TG_CHAT_BUCKETS[chat_id] = bucket
+    return bucket
+
+async def _tg_acquire(chat_id):
+    """Chat va global bucket'lardan navbat kutish (metrikalar bilan)."""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    _TG_METRICS["waiting"] += 1
+    _TG_METRICS["max_waiting"] = max(_TG_METRICS["max_waiting"], _TG_METRICS["waiting"])
+    try:
+        if chat_id is not None:
+            await take_token(_tg_chat_bucket(chat_id))
+        await take_token(_TG_GLOBAL_BUCKET)
+    finally:
+        _TG_METRICS["waiting"] -= 1
+    waited = loop.time() - started
+    _TG_METRICS["requests"] += 1
+    _TG_METRICS["wait_total"] += waited
+    _TG_METRICS["wait_max"] = max(_TG_METRICS["wait_max"], waited)
+
+async def telegram_rate_limiter(make_request, bot_instance: Bot, method):
+    """aiogram request middleware: limit + TelegramRetryAfter'da qayta urinish."""
+    api_method = getattr(method, "__api_method__", "") or ""
+    chat_id = getattr(method, "chat_id", None)
+    limited = api_method.startswith(TG_LIMITED_PREFIXES)
+    attempt = 0
+    while True:
+        if limited:
+            await _tg_acquire(chat_id)
+        try:
+            return await make_request(bot_instance, method)
+        except TelegramRetryAfter as e:
+            _TG_METRICS["retry_after"] += 1
+            attempt += 1
+            if attempt > TG_MAX_RETRIES:
+                raise
+            logger.warning(f"Flood limit on {api_method} (chat {chat_id}), retrying after {e.retry_after}s")
+            if limited:
+                # Keyingi so'rovlar ham shu vaqtgacha kutadi
+                bucket = _tg_chat_bucket(chat_id) if chat_id is not None else _TG_GLOBAL_BUCKET
+                block_token_bucket(bucket, e.retry_after)
+            else:
+                await asyncio.sleep(e.retry_after)
+
+def rate_limiter_stats() -> dict:
+    """Limiter metrikalari (queue depth va kutish vaqti)."""
+    requests = _TG_METRICS["requests"]
+    return {
+        **_TG_METRICS,
+        "wait_avg": _TG_METRICS["wait_total"] / requests if requests else 0.0,
+        "chats": len(_TG_CHAT_BUCKETS),
+    }
+
+bot.session.middleware(telegram_rate_limiter)
+
+@dp.message(Command("limits"))
+async def cmd_limits(m: Message):
+    """Telegram rate limiter metrikalari (faqat super admin)."""
+    if not is_super_admin(m.from_user.id):
+        return await m.answer(f"⛔ Bu buyruq faqat super adminlar uchun.\n\nSizning ID: {m.from_user.id}")
+    
+    st = rate_limiter_stats()
+    await m.answer(
+        f"🚦 <b>Telegram limiter</b>\n\n"
+        f"📨 So'rovlar: {st['requests']}\n"
+        f"⏳ Navbatda: {st['waiting']} (maks: {st['max_waiting']})\n"
+        f"⏱ O'rtacha kutish: {st['wait_avg']:.2f}s (maks: {st['wait_max']:.1f}s)\n"
+        f"🛑 RetryAfter: {st['retry_after']}\n"
+        f"💬 Chat bucket'lar: {st['chats']}",
+        parse_mode="HTML"
+    )
+
+@dp.message(Command("explain_expiry"))
+async def cmd_explain_expiry(m: Message):
+    """Muddat skanerlari EXPLAIN natijasi - index ishlatilayotganini tekshirish (faqat super admin)."""
+    if not is_super_admin(m.from_user.id):
+        return await m.answer(f"⛔ Bu buyruq faqat super adminlar uchun.\n\nSizning ID: {m.from_user.id}")
+    
+    try:
+        report = await explain_expiry_scans()
+        lines = ["🔎 <b>Muddat skanerlari (EXPLAIN ANALYZE)</b>\n"]
+        for name, r in report.items():
+            icon = "✅" if r['ok'] else "⚠️"
+            index = f" ({r['index']})" if r['index'] else ""
+            lines.append(f"{icon} <code>{name}</code>: {r['node']}{index}, {r['ms']:.2f} ms")
+        await m.answer("\n".join(lines), parse_mode="HTML")
+    except Exception as e:
+        logger.error(f"Error in cmd_explain_expiry: {e}")
+        await m.answer(f"Xatolik yuz berdi: {str(e)}")
+
+# ==================== BULK MEMBERSHIP VERIFIER ====================
+# Statistika va obunachilar ro'yxatlari uchun ko'plab get_chat_member tekshiruvlari:
+# cheklangan parallellik, umumiy rate limiter, RetryAfter backoff va natijalar oqimi.
+
+MEMBER_CHECK_WORKERS = int(os.getenv("MEMBER_CHECK_WORKERS", "10"))
+MEMBER_CHECK_RATE = float(os.getenv("MEMBER_CHECK_RATE", "25"))  # so'rov/soniya (barcha handlerlar uchun umumiy)
+MEMBER_CHECK_RETRIES = 3
+PROGRESS_EDIT_INTERVAL = 3.0  # progress xabarini tahrirlash oralig'i (soniya)
+
+_MEMBER_CHECK_BUCKET = new_token_bucket(MEMBER_CHECK_RATE)
+
+async def _check_member(group_id: int, user_id: int) -> Optional[str]:
+    """Bitta a'zolik tekshiruvi (rate limit + RetryAfter). Xato bo'lsa None."""
+    for attempt in range(MEMBER_CHECK_RETRIES):
+        await take_token(_MEMBER_CHECK_BUCKET)
+        try:
+            return await get_member_status(group_id, user_id)
+        except TelegramRetryAfter as e:
+            logger.warning(f"get_chat_member flood limit, pausing {e.retry_after}s (attempt {attempt + 1})")
+            block_token_bucket(_MEMBER_CHECK_BUCKET, e.retry_after)
+        except Exception as e:
+            logger.debug(f"Membership check failed for user {user_id} in group {group_id}: {e}")
+            return None
+    return None
+
+async def verify_members(group_id: int, user_ids: list[int], progress_msg: Optional[Message] = None, label: str = ""):
+    """Guruh a'zoligini ko'plab userlar uchun parallel tekshirish.
+    
+    Natijalar tayyor bo'lishi bilan (user_id, status) ko'rinishida qaytariladi
+    (status None - tekshirib bo'lmadi). progress_msg berilsa, "⏳ tekshirilmoqda"
+    xabari vaqti-vaqti bilan yangilanadi.
+    """
+    total = len(user_ids)
+    if not total:
+        return
+    
+    results: asyncio.Queue = asyncio.Queue()
+    pending: list[int] = []
+    
+    # Cache'dagi natijalar Telegram'ga so'rovsiz darhol qaytadi
+    now = time.monotonic()
+    for uid in user_ids:
+        cached = _MEMBER_CACHE.get((group_id, uid))
+        if cached and cached[0] > now:
+            results.put_nowait((uid, cached[1]))
+        else:
+            pending.append(uid)
+    
+    async def check(uid: int):
+        status = None
+        try:
+            status = await _check_member(group_id, uid)
+        finally:
+            results.put_nowait((uid, status))
+    
+    runner = asyncio.create_task(run_bounded(pending, check, MEMBER_CHECK_WORKERS))
+    loop = asyncio.get_running_loop()
+    last_edit = loop.time()
+    try:
+        for done in range(1, total + 1):
+            yield await results.get()
+            if progress_msg and pending and loop.time() - last_edit >= PROGRESS_EDIT_INTERVAL:
+                last_edit = loop.time()
+                try:
+                    text = f"⏳ {label} — tekshirilmoqda: {done}/{total}" if label else f"⏳ Tekshirilmoqda: {done}/{total}"
+                    await progress_msg.edit_text(text)
+                except Exception:
+                    pass
+    finally:
+        runner.cancel()
+
+async def filter_real_members(group_id: int, rows: list, progress_msg: Optional[Message] = None, label: str = "") -> list:
+    """Faqat guruhda haqiqatan turgan userlarning qatorlarini qaytarish (tartib saqlanadi).
+    
+    Args:
+        rows: birinchi elementi user_id bo'lgan tuple'lar (all_members_of_group formati)
+    """
+    statuses = {}
+    async for uid, status in verify_members(group_id, [row[0] for row in rows], progress_msg, label):
+        statuses[uid] = status
+    return [row for row in rows if statuses.get(row[0]) in ACTIVE_MEMBER_STATUSES]
 
 async def is_member_of_any_group(uid: int) -> bool:
     """Foydalanuvchi kamida bitta guruhda ekanligini tekshirish."""
     for group_id in GROUP_IDS:
-        try:
-            member = await bot.get_chat_member(group_id, uid)
-            if member.status in ["member", "administrator", "creator"]:
-                return True
-        except Exception:
-            continue
+        if await is_group_member(group_id, uid):
+            return True
     return False
 
 async def fetch_user_profile(uid: int) -> tuple[str, str]:
@@ -1086,34 +2601,245 @@ def human_left(expires_at: int) -> tuple[str, int]:
     days_left = (dt_loc.date() - (datetime.utcnow() + TZ_OFFSET).date()).days
     return dt_loc.strftime("%Y-%m-%d"), days_left
 
+# ==================== EXPORT ====================
+# Obunachilar va to'lovlar ro'yxati o'nlab 4000 belgili xabar o'rniga bitta fayl
+# bo'lib yuboriladi. Qatorlar server-side cursor orqali o'qiladi va to'g'ridan-to'g'ri
+# vaqtinchalik faylga yoziladi - xotira guruh hajmiga bog'liq emas.
+
+EXPORT_PREFETCH = int(os.getenv("EXPORT_PREFETCH", "500"))  # cursor har safar oladigan qatorlar
+
+SUBSCRIBER_EXPORT_COLUMNS = ["user_id", "username", "full_name", "phone", "group_id", "group", "expires_at", "days_left", "status"]
+PAYMENT_EXPORT_COLUMNS = ["payment_id", "user_id", "username", "full_name", "phone", "group_id", "payment_type", "status", "created_at", "admin_id"]
+
+def _export_time(ts: Optional[int]) -> str:
+    """Timestamp'ni mahalliy vaqt satriga aylantirish (bo'sh bo'lsa "")."""
+    return (datetime.utcfromtimestamp(ts) + TZ_OFFSET).strftime("%Y-%m-%d %H:%M") if ts else ""
+
+def subscriber_export_row(gid: int, title: str, uid: int, username, full_name, phone, exp) -> list:
+    """Bitta obuna uchun eksport qatori (SUBSCRIBER_EXPORT_COLUMNS tartibida)."""
+    _, left = human_left(exp)
+    now = int(datetime.utcnow().timestamp())
+    status = "none" if not exp else ("active" if exp > now else "expired")
+    return [uid, username or "", full_name or "", phone or "", gid, title,
+            _export_time(exp), max(left, 0), status]
+
+async def iter_subscriber_rows(group_ids: list[int]):
+    """Guruhlar obunachilarini server-side cursor bilan qatorma-qator berish."""
+    titles = dict(await resolve_group_titles(group_ids))
+    # subscriber_export view - API eksporti bilan bir xil so'rov (migratsiya 13)
+    sql = """
+        SELECT group_id, user_id, username, full_name, phone, expires_at
+        FROM subscriber_export
+        WHERE group_id = ANY($1::BIGINT[])
+        ORDER BY group_id, user_id
+    """
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            async for r in conn.cursor(sql, list(group_ids), prefetch=EXPORT_PREFETCH):
+                gid = r['group_id']
+                yield subscriber_export_row(gid, titles.get(gid, str(gid)), r['user_id'], r['username'],
+                                            r['full_name'], r['phone'], r['expires_at'])
+
+async def iter_payment_rows(group_ids: Optional[list[int]]):
+    """To'lovlarni server-side cursor bilan qatorma-qator berish.
+    
+    Args:
+        group_ids: Faqat shu guruhlar a'zolarining to'lovlari; None - barcha to'lovlar
+    """
+    sql = """
+        SELECT p.id, p.user_id, u.username, u.full_name, u.phone, u.group_id,
+               COALESCE(p.payment_type, 'initial') AS payment_type, p.status, p.created_at, p.admin_id
+        FROM payments p
+        LEFT JOIN users u ON u.user_id = p.user_id
+        WHERE $1::BIGINT[] IS NULL
+           OR u.group_id = ANY($1::BIGINT[])
+           OR EXISTS (SELECT 1 FROM user_groups ug WHERE ug.user_id = p.user_id AND ug.group_id = ANY($1::BIGINT[]))
+        ORDER BY p.id
+    """
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            async for r in conn.cursor(sql, group_ids, prefetch=EXPORT_PREFETCH):
+                yield [r['id'], r['user_id'], r['username'] or "", r['full_name'] or "", r['phone'] or "",
+                       r['group_id'] or "", r['payment_type'], r['status'] or "",
+                       _export_time(r['created_at']), r['admin_id'] or ""]
+
+async def iter_list(rows):
+    """Xotiradagi ro'yxatni write_export uchun async iterator'ga aylantirish."""
+    for row in rows:
+        yield row
+
+async def write_export(rows, columns: list[str], fmt: str = "csv") -> tuple[str, str, int]:
+    """Qatorlarni (async generator) vaqtinchalik CSV yoki XLSX faylga yozish.
+    
+    CSV UTF-8 BOM bilan yoziladi (Excel kirill/o'zbek harflarini to'g'ri ochadi).
+    XLSX openpyxl'ning write_only rejimida yoziladi.
+    
+    Returns:
+        (fayl yo'li, haqiqiy format, qatorlar soni)
+    """
+    if fmt == "xlsx":
+        from openpyxl import Workbook
+    
+    fd, path = tempfile.mkstemp(prefix="export_", suffix=f".{fmt}")
+    count = 0
+    try:
+        async with aclosing(rows):
+            if fmt == "xlsx":
+                os.close(fd)
+                wb = Workbook(write_only=True)
+                ws = wb.create_sheet()
+                ws.append(columns)
+                async for row in rows:
+                    ws.append(row)
+                    count += 1
+                await asyncio.get_running_loop().run_in_executor(None, wb.save, path)
+            else:
+                with open(fd, "w", encoding="utf-8-sig", newline="") as f:
+                    writer = csv.writer(f)
+                    writer.writerow(columns)
+                    async for row in rows:
+                        writer.writerow(row)
+                        count += 1
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path, fmt, count
+
+async def send_export(chat_id: int, rows, columns: list[str], filename: str, fmt: str = "csv", caption: str = "") -> int:
+    """Eksport faylini yozib, bitta hujjat sifatida yuborish. Yuborilgan qatorlar sonini qaytaradi."""
+    path, fmt, count = await write_export(rows, columns, fmt)
+    try:
+        caption = f"{caption}\n📄 Qatorlar: {count}".strip()
+        await bot.send_document(chat_id, FSInputFile(path, filename=f"{filename}.{fmt}"), caption=caption, parse_mode="HTML")
+    finally:
+        os.unlink(path)
+    return count
+
+# ==================== CONTRACT RENDERER ====================
+# PDF endi event loop'da chizilmaydi: reportlab alohida thread pool'da ishlaydi.
+# Shartnoma matni har bir versiya uchun bir marta sahifalarga chiziladi (tayyor PDF
+# text object'lari, cache), har bir userga faqat imzo bloki (stamp) qo'shiladi.
+
+CONTRACT_RENDER_WORKERS = int(os.getenv("CONTRACT_RENDER_WORKERS", "2"))
+CONTRACT_FONT = "Helvetica"
+CONTRACT_FONT_SIZE = 12
+CONTRACT_LEADING = 14
+CONTRACT_MARGIN = 40
+CONTRACT_LAYOUT_CACHE = 4  # xotirada saqlanadigan shablon versiyalari soni
+
+_CONTRACT_EXECUTOR = ThreadPoolExecutor(max_workers=CONTRACT_RENDER_WORKERS, thread_name_prefix="contract-pdf")
+_CONTRACT_LAYOUTS: dict[int, tuple[list, float]] = {}  # template version -> (sahifalar, oxirgi y)
+_CONTRACT_LAYOUTS_LOCK = threading.Lock()  # cache thread pool'dan o'qiladi va yoziladi
+
+def _wrap_contract_text(text: str) -> list[str]:
+    """Matnni sahifa kengligiga so'zlar bo'yicha bo'lish (bo'sh qatorlar saqlanadi)."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.utils import simpleSplit
+    max_width = A4[0] - 2 * CONTRACT_MARGIN
+    lines: list[str] = []
+    for line in text.splitlines():
+        lines.extend(simpleSplit(line, CONTRACT_FONT, CONTRACT_FONT_SIZE, max_width) or [""])
+    return lines
+
+def _draw_contract_lines(c, lines: list[str], y: float, pages: Optional[list] = None) -> float:
+    """Qatorlarni text object'larga chizish; to'lgan sahifa pages'ga qo'shiladi yoki canvas'ga chiziladi.
+    
+    Returns:
+        Oxirgi (to'lmagan) sahifa text object'i chizilgandan keyingi y
+    """
+    from reportlab.lib.pagesizes import A4
+    top = A4[1] - CONTRACT_MARGIN
+    
+    def flush(text):
+        if pages is not None:
+            pages.append(text)
+        else:
+            c.drawText(text)
+    
+    text = c.beginText(CONTRACT_MARGIN, y)
+    text.setLeading(CONTRACT_LEADING)
+    for line in lines:
+        text.textLine(line)
+        y -= CONTRACT_LEADING
+        if y < CONTRACT_MARGIN:
+            flush(text)
+            if pages is None:
+                c.showPage()
+                c.setFont(CONTRACT_FONT, CONTRACT_FONT_SIZE)
+            y = top
+            text = c.beginText(CONTRACT_MARGIN, y)
+            text.setLeading(CONTRACT_LEADING)
+    flush(text)
+    return y
+
+def _contract_layout(version: int, template_text: str) -> tuple[list, float]:
+    """Shablon sahifalari - tayyor text object'lar (har bir versiya uchun bir marta chiziladi)."""
+    with _CONTRACT_LAYOUTS_LOCK:
+        layout = _CONTRACT_LAYOUTS.get(version)
+        if layout is None:
+            from reportlab.lib.pagesizes import A4
+            from reportlab.pdfgen import canvas
+            scratch = canvas.Canvas(io.BytesIO(), pagesize=A4)
+            scratch.setFont(CONTRACT_FONT, CONTRACT_FONT_SIZE)
+            pages: list = []
+            y = _draw_contract_lines(scratch, _wrap_contract_text(template_text), A4[1] - CONTRACT_MARGIN, pages)
+            layout = (pages, y)
+            if len(_CONTRACT_LAYOUTS) >= CONTRACT_LAYOUT_CACHE:
+                _CONTRACT_LAYOUTS.pop(min(_CONTRACT_LAYOUTS), None)
+            _CONTRACT_LAYOUTS[version] = layout
+    return layout
+
+def _render_contract_pdf(version: int, template_text: str, stamp: str) -> bytes:
+    """PDF yig'ish (thread pool ichida): tayyor shablon sahifalari + userning imzo bloki."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    pages, y = _contract_layout(version, template_text)
+    pdf_buf = io.BytesIO()
+    c = canvas.Canvas(pdf_buf, pagesize=A4)
+    for i, page in enumerate(pages):
+        if i:
+            c.showPage()
+        c.setFont(CONTRACT_FONT, CONTRACT_FONT_SIZE)
+        c.drawText(page)
+    _draw_contract_lines(c, _wrap_contract_text(stamp), y)
+    c.save()
+    return pdf_buf.getvalue()
+
+async def render_contract_pdf(version: int, template_text: str, stamp: str) -> Optional[bytes]:
+    """Shartnoma PDF'ini event loop'ni bloklamasdan yaratish.
+    
+    Returns:
+        PDF bytes yoki None (reportlab xatosi)
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_CONTRACT_EXECUTOR, _render_contract_pdf, version, template_text, stamp)
+    except Exception as e:
+        logger.warning(f"Failed to create PDF contract: {e}")
+        return None
+
+async def warm_contract_layout():
+    """Joriy shablon qatorlarini oldindan tayyorlash (startup va shablon o'zgarganda)."""
+    try:
+        version, template_text = await get_contract_template_version()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(_CONTRACT_EXECUTOR, _contract_layout, version, template_text)
+    except Exception as e:
+        logger.warning(f"Failed to pre-render contract template: {e}")
+
 async def build_contract_files(user_fullname: str, user_phone: Optional[str]):
     """Database'dan shartnoma matnini olib, PDF va TXT yaratish."""
     # Database'dan shartnoma matnini olish
-    contract_text = await get_contract_template()
+    version, contract_text = await get_contract_template_version()
     
-    stamped = f"{contract_text}\n\n---\nO'quvchi: {user_fullname}\nTelefon: {user_phone or '-'}\nSana: {(datetime.utcnow()+TZ_OFFSET).strftime('%Y-%m-%d %H:%M')}\n"
-    txt_buf = io.BytesIO(stamped.encode("utf-8"))
+    stamp = f"\n---\nO'quvchi: {user_fullname}\nTelefon: {user_phone or '-'}\nSana: {(datetime.utcnow()+TZ_OFFSET).strftime('%Y-%m-%d %H:%M')}\n"
+    txt_buf = io.BytesIO(f"{contract_text}\n{stamp}".encode("utf-8"))
     txt_buf.name = "shartnoma.txt"
     pdf_buf = None
-    try:
-        from reportlab.lib.pagesizes import A4
-        from reportlab.pdfgen import canvas
-        pdf_buf = io.BytesIO()
+    pdf_bytes = await render_contract_pdf(version, contract_text, stamp)
+    if pdf_bytes:
+        pdf_buf = io.BytesIO(pdf_bytes)
         pdf_buf.name = "shartnoma.pdf"
-        c = canvas.Canvas(pdf_buf, pagesize=A4)
-        width, height = A4
-        y = height - 40
-        for line in stamped.splitlines():
-            c.drawString(40, y, line[:110])
-            y -= 14
-            if y < 40:
-                c.showPage()
-                y = height - 40
-        c.save()
-        pdf_buf.seek(0)
-    except Exception as e:
-        logger.warning(f"Failed to create PDF contract: {e}")
-        pdf_buf = None
     txt_buf.seek(0)
     return txt_buf, pdf_buf
 
@@ -1128,6 +2854,9 @@ async def on_chat_member_updated(event: ChatMemberUpdated):
         if event.chat.type not in ("group", "supergroup", "channel"):
             return
         
+        # A'zolik cache'ini event'dan yangilash
+        set_member_status(event.chat.id, event.new_chat_member.user.id, event.new_chat_member.status, MEMBER_EVENT_TTL)
+        
         # Faqat yangi a'zolar/obunachilar uchun (member bo'lmagandan member bo'lganda)
         if event.new_chat_member.status == "member" and event.old_chat_member.status not in ("member", "administrator", "creator"):
             user = event.new_chat_member.user
@@ -1139,30 +2868,23 @@ async def on_chat_member_updated(event: ChatMemberUpdated):
             # Database'da user'ni tekshirish - payment approved bo'lganmi?
             user_row = await get_user(user.id)
             
-            # Payment'ni tekshirish
-            payment_row = None
+            # Payment'ni tekshirish (oxirgi tasdiqlangan to'lov - bitta index lookup)
+            approved_pid = None
             if user_row:
                 try:
-                    async with db_pool.acquire() as conn:
-                        payment_row = await conn.fetchrow(
-                            "SELECT id, status FROM payments WHERE user_id = $1 ORDER BY id DESC LIMIT 1",
-                            user.id
-                        )
+                    approved_pid = await latest_approved_payment(user.id)
                 except Exception:
                     pass
             
             # Agar payment approved bo'lsa - 30 kunlik subscription boshlanadi
-            if payment_row and payment_row['status'] == 'approved':
+            if approved_pid is not None:
                 now = int(datetime.utcnow().timestamp())
                 expires_at = now + SUBSCRIPTION_DAYS * 86400
                 
                 # Subscription boshlanadi
                 username = user.username or ""
                 full_name = user.full_name or user.first_name or "Nomsiz"
-                phone = user_row[5] if user_row and len(user_row) > 5 else None
-                
-                await upsert_user(user.id, username, full_name, event.chat.id, expires_at, phone)
-                await add_user_group(user.id, event.chat.id, expires_at)
+                phone = user_row.phone if user_row else None
                 
                 # User'ga xabar yuborish (guruh/kanal farqi bilan)
                 expiry_date = (datetime.utcfromtimestamp(expires_at) + TZ_OFFSET).strftime("%Y-%m-%d")
@@ -1177,20 +2899,21 @@ async def on_chat_member_updated(event: ChatMemberUpdated):
                     emoji = "👥"
                     type_name = "Guruh"
                 
-                try:
-                    await bot.send_message(
-                        chat_id=user.id,
-                        text=(
+                # Obuna va xabar - bitta tranzaksiyada (xabar outbox orqali yuboriladi)
+                async with db_pool.acquire() as conn:
+                    async with db_transaction(conn):
+                        await upsert_user(user.id, username, full_name, event.chat.id, expires_at, phone, conn=conn)
+                        await add_user_group(user.id, event.chat.id, expires_at, conn=conn)
+                        await enqueue_notification(
+                            conn, user.id,
                             f"🎉 *Tabriklayman!*\n\n"
                             f"✅ Siz {join_text} va obuna boshlanadi!\n\n"
                             f"📅 Obuna tugashi: {expiry_date}\n"
                             f"⏰ Muddat: {SUBSCRIPTION_DAYS} kun\n\n"
-                            f"{emoji} {type_name}: {event.chat.title or type_name}"
-                        ),
-                        parse_mode="Markdown"
-                    )
-                except Exception as e:
-                    logger.warning(f"Failed to send subscription start message to user {user.id}: {e}")
+                            f"{emoji} {type_name}: {event.chat.title or type_name}",
+                            parse_mode="Markdown"
+                        )
+                notify_outbox()
                 
                 logger.info(f"Subscription started for user {user.id} in {event.chat.type} {event.chat.id} - expires at {expiry_date}")
             else:
@@ -1200,28 +2923,29 @@ async def on_chat_member_updated(event: ChatMemberUpdated):
                 
                 logger.warning(f"User {user.id} joined group {event.chat.id} without approved payment - waiting for admin approval")
                 
-                # Payment statusini aniqlash
+                # Payment statusini aniqlash (oxirgi to'lov hodisasi bo'yicha)
+                last_event = None
+                if user_row:
+                    try:
+                        last_event = await latest_payment_event(user.id)
+                    except Exception:
+                        pass
                 payment_status_text = "❌ To'lov topilmadi"
-                if payment_row:
-                    if payment_row['status'] == 'pending':
-                        payment_status_text = "⏳ To'lov kutilmoqda"
-                    elif payment_row['status'] == 'rejected':
-                        payment_status_text = "❌ To'lov rad etilgan"
-                    elif payment_row['status'] == 'removed':
-                        payment_status_text = "🗑 To'lov o'chirilgan"
-                else:
-                    payment_status_text = "❌ To'lov topilmadi"
+                if last_event == 'submitted':
+                    payment_status_text = "⏳ To'lov kutilmoqda"
+                elif last_event == 'rejected':
+                    payment_status_text = "❌ To'lov rad etilgan"
+                elif last_event == 'removed':
+                    payment_status_text = "🗑 To'lov o'chirilgan"
                 
-                # User profilini olish
-                try:
-                    profile = await fetch_user_profile(user.id)
-                    user_full_name = profile['full_name']
-                    user_username = profile['username']
-                    chat_link = profile['chat_link']
-                except Exception:
+                # User profilini olish (fetch_user_profile xatoda ham (username, full_name) qaytaradi)
+                username, user_full_name = await fetch_user_profile(user.id)
+                username = username or user.username
+                if user_full_name == str(user.id):
                     user_full_name = user.full_name or user.first_name or "Nomsiz"
-                    user_username = f"@{user.username}" if user.username else "Username yo'q"
-                    chat_link = f"[{user_full_name}](tg://user?id={user.id})"
+                user_username = f"@{username}" if username else "Username yo'q"
+                safe_name = user_full_name.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+                chat_link = f'<a href="tg://user?id={user.id}">{safe_name}</a>'
                 
                 # Guruh nomini olish
                 group_title = event.chat.title or f"Guruh {event.chat.id}"
@@ -1249,58 +2973,18 @@ async def on_chat_member_updated(event: ChatMemberUpdated):
                     ]
                 ])
                 
-                # Barcha adminlarga yuborish (guruh bo'yicha filter qilib)
+                # Barcha adminlarga yuborish (guruh bo'yicha filter qilib) - outbox orqali
                 try:
-                    admins_sent = 0
-                    
-                    # Super adminlarga yuborish (barcha guruhlarga ruxsat)
-                    for aid in ADMIN_IDS:
-                        try:
-                            await bot.send_message(
-                                chat_id=aid,
-                                text=admin_notification,
-                                parse_mode="HTML",
-                                reply_markup=keyboard
-                            )
-                            admins_sent += 1
-                        except Exception as send_err:
-                            logger.warning(f"Failed to send unauthorized join notification to super admin {aid}: {send_err}")
-                    
-                    # Database adminlarga yuborish (guruh bo'yicha filter qilib)
-                    try:
-                        async with db_pool.acquire() as conn:
-                            db_admins = await conn.fetch(
-                                "SELECT user_id, managed_groups FROM admins WHERE active = true AND (expires_at IS NULL OR expires_at > $1)",
-                                int(datetime.utcnow().timestamp())
-                            )
-                            
-                            for admin_row in db_admins:
-                                admin_id = admin_row['user_id']
-                                
-                                # Super admin'ga yubormadikmi?
-                                if admin_id in ADMIN_IDS:
-                                    continue
-                                
-                                # Guruh ruxsati bormi?
-                                managed_groups = admin_row['managed_groups'] or []
-                                if event.chat.id not in managed_groups:
-                                    continue
-                                
-                                try:
-                                    await bot.send_message(
-                                        chat_id=admin_id,
-                                        text=admin_notification,
-                                        parse_mode="HTML",
-                                        reply_markup=keyboard
-                                    )
-                                    admins_sent += 1
-                                except Exception as send_err:
-                                    logger.warning(f"Failed to send unauthorized join notification to admin {admin_id}: {send_err}")
-                    
-                    except Exception as db_err:
-                        logger.error(f"Failed to fetch admins for unauthorized join notification: {db_err}")
+                    # Super adminlar (barcha guruhlarga ruxsat) + guruhga ruxsati bor database adminlar
+                    recipients = await group_admin_ids(event.chat.id)
+                    async with db_pool.acquire() as conn:
+                        async with conn.transaction():
+                            for admin_id in recipients:
+                                await enqueue_notification(conn, admin_id, admin_notification,
+                                                           parse_mode="HTML", reply_markup=keyboard)
+                    notify_outbox()
                     
-                    logger.info(f"Sent unauthorized join notification for user {user.id} in group {event.chat.id} to {admins_sent} admins")
+                    logger.info(f"Queued unauthorized join notification for user {user.id} in group {event.chat.id} to {len(recipients)} admins")
                     
                 except Exception as notification_err:
                     logger.error(f"Failed to send unauthorized join notifications: {notification_err}")
@@ -1347,7 +3031,8 @@ async def cmd_start(m: Message):
         
         if user_row:
             # Foydalanuvchi database'da bor - obuna holatini tekshirish
-            user_id, group_id, expires_at, username, full_name, phone, agreed_at = user_row
+            group_id, expires_at = user_row.group_id, user_row.expires_at
+            full_name, phone = user_row.full_name, user_row.phone
             now = int(datetime.utcnow().timestamp())
             
             # Barcha guruhlar bo'yicha obuna holatini olish
@@ -1367,8 +3052,7 @@ async def cmd_start(m: Message):
             if expires_at and group_id:
                 # Telegram'dan guruh a'zoligini tekshirish
                 try:
-                    member = await bot.get_chat_member(group_id, m.from_user.id)
-                    if member.status in ("member", "administrator", "creator"):
+                    if await get_member_status(group_id, m.from_user.id) in ACTIVE_MEMBER_STATUSES:
                         if expires_at > now:
                             exp_str, days_left = human_left(expires_at)
                             group_name = titles.get(group_id, f"Guruh {group_id}")
@@ -1390,8 +3074,7 @@ async def cmd_start(m: Message):
                 
                 # Telegram'dan guruh a'zoligini tekshirish
                 try:
-                    member = await bot.get_chat_member(gid, m.from_user.id)
-                    if member.status in ("member", "administrator", "creator"):
+                    if await get_member_status(gid, m.from_user.id) in ACTIVE_MEMBER_STATUSES:
                         if exp > now:
                             exp_str, days_left = human_left(exp)
                             group_name = titles.get(gid, f"Guruh {gid}")
@@ -1487,7 +3170,8 @@ async def cmd_start(m: Message):
                 return
         
         # Yangi foydalanuvchi - ro'yxatdan o'tish jarayoni
-        WAIT_FULLNAME_FOR.add(m.from_user.id)
+        state_set(WAIT_FULLNAME_FOR, m.from_user.id)
+        await state_commit()
         
         await m.answer(
             "👋 <b>Xush kelibsiz!</b>\n\n"
@@ -1526,7 +3210,8 @@ async def cb_renew_payment(c: CallbackQuery):
     """Qayta to'lov qilish - mavjud userlar uchun."""
     try:
         # User'ni to'lov kutish rejimiga qo'shish
-        WAIT_PAYMENT_PHOTO.add(c.from_user.id)
+        state_set(WAIT_PAYMENT_PHOTO, c.from_user.id)
+        await state_commit()
         
         # To'lov ma'lumotlarini olish
         payment_settings = await get_payment_settings()
@@ -1575,7 +3260,8 @@ async def cb_course_select(c: CallbackQuery):
         # Database'ga kurs nomini saqlash
         await update_user_course(c.from_user.id, course_name)
         
-        WAIT_CONTACT_FOR.add(c.from_user.id)
+        state_set(WAIT_CONTACT_FOR, c.from_user.id)
+        await state_commit()
         await c.message.answer(
             f"✅ Kurs tanlandi: *{course_name}*\n\n"
             "📞 Endi telefon raqamingizni yuboring:",
@@ -1642,7 +3328,8 @@ async def cmd_renew(m: Message):
         await m.answer(msg, parse_mode="HTML")
         
         # 4. State'ni o'rnatish
-        WAIT_RENEWAL_RECEIPT.add(uid)
+        state_set(WAIT_RENEWAL_RECEIPT, uid)
+        await state_commit()
         logger.info(f"User {uid} started renewal process")
         
     except Exception as e:
@@ -1690,7 +3377,8 @@ async def btn_payment(m: Message):
         await m.answer(msg, parse_mode="HTML", reply_markup=user_reply_keyboard())
         
         # State'ni o'rnatish - initial payment
-        WAIT_PAYMENT_PHOTO.add(uid)
+        state_set(WAIT_PAYMENT_PHOTO, uid)
+        await state_commit()
         logger.info(f"User {uid} started initial payment via button")
         
     except Exception as e:
@@ -1753,7 +3441,8 @@ async def btn_renew(m: Message):
         await m.answer(msg, parse_mode="HTML", reply_markup=user_reply_keyboard())
         
         # 4. State'ni o'rnatish - renewal payment
-        WAIT_RENEWAL_RECEIPT.add(uid)
+        state_set(WAIT_RENEWAL_RECEIPT, uid)
+        await state_commit()
         logger.info(f"User {uid} started renewal via button")
         
     except Exception as e:
@@ -1821,7 +3510,8 @@ async def cb_start_renewal(c: CallbackQuery):
         await c.message.answer(msg, parse_mode="HTML")
         
         # 4. State'ni o'rnatish
-        WAIT_RENEWAL_RECEIPT.add(uid)
+        state_set(WAIT_RENEWAL_RECEIPT, uid)
+        await state_commit()
         logger.info(f"User {uid} started renewal via button")
         
         # Tugmani o'chirish (ikkinchi marta bosilmasligi uchun)
@@ -1847,14 +3537,14 @@ async def cmd_expiring(m: Message):
         for uid, gid, exp_at in await soon_expiring_users(REMIND_DAYS):
             row = await get_user(uid)
             if row:
-                _uid, _gid, _exp, username, full_name, phone, _ag = row
+                username, full_name = row.username, row.full_name
                 exp_str, left = human_left(exp_at)
                 soon_users.append((uid, gid, exp_at, username, full_name, left))
         
         for uid, gid, exp_at in await soon_expiring_user_groups(REMIND_DAYS):
             row = await get_user(uid)
             if row:
-                _uid, _gid, _exp, username, full_name, phone, _ag = row
+                username, full_name = row.username, row.full_name
                 exp_str, left = human_left(exp_at)
                 soon_users.append((uid, gid, exp_at, username, full_name, left))
         
@@ -1881,6 +3571,211 @@ async def cmd_expiring(m: Message):
         logger.error(f"Error in cmd_expiring: {e}")
         await m.answer("Xatolik yuz berdi.")
 
+# ==================== DASHBOARD SNAPSHOT ====================
+# /dashboard endi har safar yettita so'rov bajarmaydi: barcha guruhlar uchun
+# to'lovlar va obunalar bitta so'rovda xotiraga yuklanadi. Payment/obuna
+# o'zgarganda faqat o'sha userlar qayta o'qiladi (dashboard_touch), har bir
+# admin uchun ko'rinish xotiradagi snapshot'dan filtrlanadi. dashboard_touch
+# commit'dan keyin chaqiriladi (after_commit); API va boshqa replica'lardagi
+# o'zgarishlar trigger yuborgan NOTIFY orqali keladi, xabar yo'qolsa ham
+# snapshot DASHBOARD_REFRESH soniyadan eski bo'lmaydi.
+
+DASHBOARD_WINDOW_DAYS = 3  # oxirgi 3 kun to'lovlari va 3 kun ichida tugaydigan obunalar
+DASHBOARD_REFRESH = int(os.getenv("DASHBOARD_REFRESH", "300"))  # to'liq yangilash oralig'i (soniya)
+DASHBOARD_EXPIRED_DAYS = int(os.getenv("DASHBOARD_EXPIRED_DAYS", "7"))  # "obunasi tugagan" bo'limi: oxirgi N kun
+DASHBOARD_CHANNEL = "dashboard_changed"
+
+DASHBOARD_SNAPSHOT_SQL = """
+WITH recent AS (
+    SELECT id, user_id, created_at, status, COALESCE(payment_type, 'initial') AS payment_type
+    FROM payments
+    WHERE created_at >= $1 AND status IN ('pending', 'approved'){user_filter}
+),
+subs AS (
+    SELECT user_id, group_id, MAX(COALESCE(expires_at, 0)) AS expires_at
+    FROM {source} src
+    WHERE (expires_at >= $3 AND expires_at <= $2 OR user_id IN (SELECT user_id FROM recent)){user_filter}
+    GROUP BY user_id, group_id
+),
+dash_rows AS (
+    SELECT 'payment' AS kind, r.id AS payment_id, r.user_id, NULL::BIGINT AS group_id,
+           r.created_at AS ts, r.status, r.payment_type
+    FROM recent r
+    UNION ALL
+    SELECT 'sub', NULL, s.user_id, s.group_id, s.expires_at, NULL, NULL
+    FROM subs s
+)
+SELECT dash_rows.*, u.username, u.full_name, u.phone,
+       u.group_id AS primary_group, u.expires_at AS user_expires_at
+FROM dash_rows
+LEFT JOIN users u ON u.user_id = dash_rows.user_id
+"""
+
+_DASH_PAYMENTS: dict[int, dict[int, dict]] = {}  # user_id -> {payment_id: payment}
+_DASH_SUBS: dict[int, dict[int, int]] = {}  # user_id -> {group_id: expires_at}
+_DASH_USERS: dict[int, dict] = {}  # user_id -> username, full_name, phone, group_id, expires_at
+_DASH_DIRTY: set[int] = set()  # qayta o'qilishi kerak bo'lgan userlar
+_DASH_LOCK = asyncio.Lock()
+_DASH_LOADED = False
+_DASH_HORIZON = 0  # snapshot shu vaqtgacha tugaydigan obunalarni o'z ichiga oladi
+
+def dashboard_touch(*user_ids: int):
+    """Payment yoki obuna o'zgardi - keyingi ko'rishda shu userlarni qayta o'qish."""
+    _DASH_DIRTY.update(user_ids)
+
+def dashboard_invalidate():
+    """Butun snapshot'ni keyingi ko'rishda qayta yuklash (masalan, guruh o'chirilganda)."""
+    global _DASH_LOADED
+    _DASH_LOADED = False
+
+def _on_dashboard_notify(_conn, _pid, _channel, payload: str):
+    """NOTIFY payload: o'zgargan user_id."""
+    try:
+        dashboard_touch(int(payload))
+    except ValueError:
+        dashboard_invalidate()
+
+async def _dashboard_invalidate_async():
+    # LISTEN qayta ulanganda uzilish paytidagi xabarlar yo'qolgan bo'lishi mumkin
+    dashboard_invalidate()
+
+async def dashboard_listener_loop():
+    """LISTEN dashboard_changed - API va boshqa replica'lardagi to'lov/obuna o'zgarishlari."""
+    await pg_listen_loop(DASHBOARD_CHANNEL, _on_dashboard_notify, _dashboard_invalidate_async)
+
+def _dashboard_apply(rows, user_ids: Optional[set[int]] = None):
+    """So'rov natijasini snapshot'ga yozish (user_ids berilsa - faqat shu userlar almashtiriladi)."""
+    if user_ids is None:
+        _DASH_PAYMENTS.clear()
+        _DASH_SUBS.clear()
+        _DASH_USERS.clear()
+    else:
+        for uid in user_ids:
+            _DASH_PAYMENTS.pop(uid, None)
+            _DASH_SUBS.pop(uid, None)
+            _DASH_USERS.pop(uid, None)
+    
+    for row in rows:
+        uid = row['user_id']
+        if row['kind'] == 'payment':
+            _DASH_PAYMENTS.setdefault(uid, {})[row['payment_id']] = {
+                'created_at': row['ts'],
+                'status': row['status'],
+                'payment_type': row['payment_type'],
+            }
+        else:
+            _DASH_SUBS.setdefault(uid, {})[row['group_id']] = row['ts']
+        if uid not in _DASH_USERS:
+            _DASH_USERS[uid] = {
+                'username': row['username'],
+                'full_name': row['full_name'],
+                'phone': row['phone'],
+                'group_id': row['primary_group'],
+                'expires_at': row['user_expires_at'],
+            }
+
+async def _fetch_dashboard_rows(now: int, horizon: int, user_ids: Optional[list[int]] = None):
+    user_filter = " AND user_id = ANY($4::BIGINT[])" if user_ids is not None else ""
+    sql = DASHBOARD_SNAPSHOT_SQL.format(source=subscriptions_source(), user_filter=user_filter)
+    # Tugagan obunalar faqat oxirgi DASHBOARD_EXPIRED_DAYS kun - snapshot butun tarixni saqlamaydi
+    args = [now - DASHBOARD_WINDOW_DAYS * 86400, horizon, max(now - DASHBOARD_EXPIRED_DAYS * 86400, 1)]
+    if user_ids is not None:
+        args.append(user_ids)
+    async with db_pool.acquire() as conn:
+        return await conn.fetch(sql, *args)
+
+async def refresh_dashboard_snapshot():
+    """Barcha guruhlar uchun snapshot'ni bitta so'rovda qayta yuklash."""
+    global _DASH_LOADED, _DASH_HORIZON
+    now = int(datetime.utcnow().timestamp())
+    # Keyingi to'liq yangilashgacha "3 kun ichida tugaydiganlar" oynasi snapshot ichida qolsin
+    horizon = now + DASHBOARD_WINDOW_DAYS * 86400 + 2 * DASHBOARD_REFRESH
+    _DASH_DIRTY.clear()
+    rows = await _fetch_dashboard_rows(now, horizon)
+    _dashboard_apply(rows)
+    _DASH_HORIZON = horizon
+    _DASH_LOADED = True
+
+async def ensure_dashboard_snapshot():
+    """Snapshot'ni ko'rishdan oldin tayyorlash: kerak bo'lsa to'liq, aks holda faqat o'zgargan userlar."""
+    async with _DASH_LOCK:
+        now = int(datetime.utcnow().timestamp())
+        if not _DASH_LOADED or now + DASHBOARD_WINDOW_DAYS * 86400 > _DASH_HORIZON:
+            await refresh_dashboard_snapshot()
+        elif _DASH_DIRTY:
+            user_ids = set(_DASH_DIRTY)
+            _DASH_DIRTY.difference_update(user_ids)
+            try:
+                rows = await _fetch_dashboard_rows(now, _DASH_HORIZON, list(user_ids))
+            except Exception:
+                _DASH_DIRTY.update(user_ids)
+                raise
+            _dashboard_apply(rows, user_ids)
+
+async def dashboard_refresh_loop():
+    """Snapshot'ni fonda davriy to'liq yangilash (vaqt oynasi siljishi uchun)."""
+    while True:
+        try:
+            async with _DASH_LOCK:
+                await refresh_dashboard_snapshot()
+        except Exception as e:
+            logger.warning(f"Failed to refresh dashboard snapshot: {e}")
+        await asyncio.sleep(DASHBOARD_REFRESH)
+
+def dashboard_view(allowed_groups: Optional[list[int]] = None) -> dict[str, list[dict]]:
+    """Snapshot'dan admin ko'rinishini yig'ish (allowed_groups=None - super admin, barcha guruhlar).
+    
+    Returns:
+        {'pending_initial', 'pending_renewal', 'approved_initial', 'soon_expiring', 'expired'}
+    """
+    now = int(datetime.utcnow().timestamp())
+    since = now - DASHBOARD_WINDOW_DAYS * 86400
+    soon_until = now + DASHBOARD_WINDOW_DAYS * 86400
+    expired_since = now - DASHBOARD_EXPIRED_DAYS * 86400
+    allowed = set(allowed_groups) if allowed_groups is not None else None
+    
+    def user_item(uid: int, **extra) -> dict:
+        info = _DASH_USERS.get(uid) or {}
+        return {
+            'user_id': uid,
+            'fullname': info.get('full_name') or "Nomsiz",
+            'phone': info.get('phone') or "N/A",
+            **extra,
+        }
+    
+    view = {key: [] for key in ('pending_initial', 'pending_renewal', 'approved_initial', 'soon_expiring', 'expired')}
+    
+    for uid, payments in _DASH_PAYMENTS.items():
+        info = _DASH_USERS.get(uid) or {}
+        if allowed is not None and not (allowed & set(_DASH_SUBS.get(uid, ())) or info.get('group_id') in allowed):
+            continue
+        for payment in payments.values():
+            if payment['created_at'] < since:
+                continue
+            if payment['status'] == 'pending':
+                # Yangi (initial) to'lovlar faqat super adminlarga ko'rsatiladi
+                if payment['payment_type'] == 'renewal':
+                    view['pending_renewal'].append(user_item(uid, created_at=payment['created_at']))
+                elif allowed is None:
+                    view['pending_initial'].append(user_item(uid, created_at=payment['created_at']))
+            elif payment['payment_type'] != 'renewal' and (info.get('expires_at') is None or info['expires_at'] > now):
+                view['approved_initial'].append(user_item(uid, created_at=payment['created_at'], group_id=info.get('group_id')))
+    
+    for uid, groups in _DASH_SUBS.items():
+        for gid, expires_at in groups.items():
+            if allowed is not None and gid not in allowed:
+                continue
+            if 0 < expires_at < now and expires_at >= expired_since:
+                view['expired'].append(user_item(uid, group_id=gid, expires_at=expires_at))
+            elif now <= expires_at <= soon_until:
+                view['soon_expiring'].append(user_item(uid, group_id=gid, expires_at=expires_at))
+    
+    for key in ('pending_initial', 'pending_renewal', 'approved_initial'):
+        view[key].sort(key=lambda item: item['created_at'], reverse=True)
+    view['soon_expiring'].sort(key=lambda item: item['expires_at'])
+    view['expired'].sort(key=lambda item: item['expires_at'], reverse=True)
+    return view
+
 @dp.message(Command("dashboard"))
 async def cmd_dashboard(m: Message):
     """Admin panel - barcha holat va statistika (alohida initial/renewal)."""
@@ -1895,156 +3790,14 @@ async def cmd_dashboard(m: Message):
         if not is_super and not allowed_groups:
             return await m.answer("❌ Sizga hech qanday guruh tayinlanmagan!")
         
-        now = int(datetime.utcnow().timestamp())
-        three_days_ago = now - (3 * 24 * 60 * 60)
-        three_days_later = now + (3 * 24 * 60 * 60)
-        
-        async with db_pool.acquire() as conn:
-            if is_super:
-                pending_initial = await conn.fetch("""
-                    SELECT p.id, p.user_id, p.created_at,
-                           u.username, u.full_name, u.phone
-                    FROM payments p
-                    LEFT JOIN users u ON p.user_id = u.user_id
-                    WHERE p.status = 'pending' 
-                          AND p.created_at >= $1
-                          AND (p.payment_type = 'initial' OR p.payment_type IS NULL)
-                    ORDER BY p.created_at DESC
-                """, three_days_ago)
-                
-                pending_renewal = await conn.fetch("""
-                    SELECT p.id, p.user_id, p.created_at,
-                           u.username, u.full_name, u.phone
-                    FROM payments p
-                    LEFT JOIN users u ON p.user_id = u.user_id
-                    WHERE p.status = 'pending' 
-                          AND p.created_at >= $1
-                          AND p.payment_type = 'renewal'
-                    ORDER BY p.created_at DESC
-                """, three_days_ago)
-                
-                approved_initial = await conn.fetch("""
-                    SELECT p.id, p.user_id, p.created_at,
-                           u.username, u.full_name, u.phone, u.group_id
-                    FROM payments p
-                    LEFT JOIN users u ON p.user_id = u.user_id
-                    WHERE p.status = 'approved' 
-                          AND p.created_at >= $1
-                          AND (p.payment_type = 'initial' OR p.payment_type IS NULL)
-                          AND (u.expires_at IS NULL OR u.expires_at > $2)
-                    ORDER BY p.created_at DESC
-                """, three_days_ago, now)
-                
-                expired_users = await conn.fetch("""
-                    SELECT user_id, username, full_name, phone, group_id, expires_at
-                    FROM users
-                    WHERE expires_at IS NOT NULL AND expires_at < $1
-                    ORDER BY expires_at DESC
-                    LIMIT 50
-                """, now)
-                
-                expired_user_groups = await conn.fetch("""
-                    SELECT ug.user_id, ug.group_id, ug.expires_at,
-                           u.username, u.full_name, u.phone
-                    FROM user_groups ug
-                    LEFT JOIN users u ON ug.user_id = u.user_id
-                    WHERE ug.expires_at < $1
-                    ORDER BY ug.expires_at DESC
-                    LIMIT 50
-                """, now)
-                
-                soon_expiring = await conn.fetch("""
-                    SELECT user_id, username, full_name, phone, group_id, expires_at
-                    FROM users
-                    WHERE expires_at IS NOT NULL 
-                          AND expires_at >= $1 
-                          AND expires_at <= $2
-                    ORDER BY expires_at ASC
-                """, now, three_days_later)
-                
-                soon_expiring_groups = await conn.fetch("""
-                    SELECT ug.user_id, ug.group_id, ug.expires_at,
-                           u.username, u.full_name, u.phone
-                    FROM user_groups ug
-                    LEFT JOIN users u ON ug.user_id = u.user_id
-                    WHERE ug.expires_at >= $1 AND ug.expires_at <= $2
-                    ORDER BY ug.expires_at ASC
-                """, now, three_days_later)
-            else:
-                pending_initial = []
-                
-                pending_renewal = await conn.fetch("""
-                    SELECT p.id, p.user_id, p.created_at,
-                           u.username, u.full_name, u.phone
-                    FROM payments p
-                    LEFT JOIN users u ON p.user_id = u.user_id
-                    WHERE p.status = 'pending' 
-                          AND p.created_at >= $1 
-                          AND p.payment_type = 'renewal'
-                          AND (
-                              EXISTS (SELECT 1 FROM users WHERE user_id = p.user_id AND group_id = ANY($2))
-                              OR EXISTS (SELECT 1 FROM user_groups WHERE user_id = p.user_id AND group_id = ANY($2))
-                          )
-                    ORDER BY p.created_at DESC
-                """, three_days_ago, allowed_groups)
-                
-                approved_initial = await conn.fetch("""
-                    SELECT p.id, p.user_id, p.created_at,
-                           u.username, u.full_name, u.phone, u.group_id
-                    FROM payments p
-                    LEFT JOIN users u ON p.user_id = u.user_id
-                    WHERE p.status = 'approved' 
-                          AND p.created_at >= $1
-                          AND (p.payment_type = 'initial' OR p.payment_type IS NULL)
-                          AND (u.expires_at IS NULL OR u.expires_at > $2)
-                          AND (
-                              u.group_id = ANY($3)
-                              OR EXISTS (SELECT 1 FROM user_groups WHERE user_id = p.user_id AND group_id = ANY($3))
-                          )
-                    ORDER BY p.created_at DESC
-                """, three_days_ago, now, allowed_groups)
-                
-                expired_users = await conn.fetch("""
-                    SELECT user_id, username, full_name, phone, group_id, expires_at
-                    FROM users
-                    WHERE expires_at IS NOT NULL 
-                          AND expires_at < $1
-                          AND group_id = ANY($2)
-                    ORDER BY expires_at DESC
-                    LIMIT 50
-                """, now, allowed_groups)
-                
-                expired_user_groups = await conn.fetch("""
-                    SELECT ug.user_id, ug.group_id, ug.expires_at,
-                           u.username, u.full_name, u.phone
-                    FROM user_groups ug
-                    LEFT JOIN users u ON ug.user_id = u.user_id
-                    WHERE ug.expires_at < $1
-                          AND ug.group_id = ANY($2)
-                    ORDER BY ug.expires_at DESC
-                    LIMIT 50
-                """, now, allowed_groups)
-                
-                soon_expiring = await conn.fetch("""
-                    SELECT user_id, username, full_name, phone, group_id, expires_at
-                    FROM users
-                    WHERE expires_at IS NOT NULL 
-                          AND expires_at >= $1 
-                          AND expires_at <= $2
-                          AND group_id = ANY($3)
-                    ORDER BY expires_at ASC
-                """, now, three_days_later, allowed_groups)
-                
-                soon_expiring_groups = await conn.fetch("""
-                    SELECT ug.user_id, ug.group_id, ug.expires_at,
-                           u.username, u.full_name, u.phone
-                    FROM user_groups ug
-                    LEFT JOIN users u ON ug.user_id = u.user_id
-                    WHERE ug.expires_at >= $1 
-                          AND ug.expires_at <= $2
-                          AND ug.group_id = ANY($3)
-                    ORDER BY ug.expires_at ASC
-                """, now, three_days_later, allowed_groups)
+        # Snapshot xotiradan - faqat o'zgargan userlar qayta o'qiladi
+        await ensure_dashboard_snapshot()
+        view = dashboard_view(None if is_super else allowed_groups)
+        pending_initial = view['pending_initial']
+        pending_renewal = view['pending_renewal']
+        approved_initial = view['approved_initial']
+        all_soon_expiring = view['soon_expiring']
+        all_expired = view['expired']
         
         titles = dict(await resolve_group_titles())
         
@@ -2052,15 +3805,12 @@ async def cmd_dashboard(m: Message):
         
         if pending_initial:
             lines.append(f"🆕 *Yangi to'lovlar (guruhga qo'shilish)* - tasdiq kutmoqda: {len(pending_initial)} ta\n")
-            for row in pending_initial[:10]:
-                uid = row['user_id']
-                fullname = row['full_name'] or "Nomsiz"
-                phone = row['phone'] or "N/A"
-                created_str = (datetime.utcfromtimestamp(row['created_at']) + TZ_OFFSET).strftime("%Y-%m-%d %H:%M")
-                user_link = f"[{fullname}](tg://user?id={uid})"
+            for item in pending_initial[:10]:
+                created_str = (datetime.utcfromtimestamp(item['created_at']) + TZ_OFFSET).strftime("%Y-%m-%d %H:%M")
+                user_link = f"[{item['fullname']}](tg://user?id={item['user_id']})"
                 
                 lines.append(f"• {user_link}")
-                lines.append(f"  📞 {phone}")
+                lines.append(f"  📞 {item['phone']}")
                 lines.append(f"  📅 {created_str}\n")
             
             if len(pending_initial) > 10:
@@ -2072,15 +3822,12 @@ async def cmd_dashboard(m: Message):
         
         if pending_renewal:
             lines.append(f"🔄 *Obuna yangilash to'lovlari* - tasdiq kutmoqda: {len(pending_renewal)} ta\n")
-            for row in pending_renewal[:10]:
-                uid = row['user_id']
-                fullname = row['full_name'] or "Nomsiz"
-                phone = row['phone'] or "N/A"
-                created_str = (datetime.utcfromtimestamp(row['created_at']) + TZ_OFFSET).strftime("%Y-%m-%d %H:%M")
-                user_link = f"[{fullname}](tg://user?id={uid})"
+            for item in pending_renewal[:10]:
+                created_str = (datetime.utcfromtimestamp(item['created_at']) + TZ_OFFSET).strftime("%Y-%m-%d %H:%M")
+                user_link = f"[{item['fullname']}](tg://user?id={item['user_id']})"
                 
                 lines.append(f"• {user_link}")
-                lines.append(f"  📞 {phone}")
+                lines.append(f"  📞 {item['phone']}")
                 lines.append(f"  📅 {created_str}\n")
             
             if len(pending_renewal) > 10:
@@ -2092,16 +3839,13 @@ async def cmd_dashboard(m: Message):
         
         if approved_initial:
             lines.append(f"✅ *Tasdiqlangan, guruhga qo'shilish kutilayotgan*: {len(approved_initial)} ta\n")
-            for row in approved_initial[:10]:
-                uid = row['user_id']
-                fullname = row['full_name'] or "Nomsiz"
-                phone = row['phone'] or "N/A"
-                gid = row['group_id']
+            for item in approved_initial[:10]:
+                gid = item['group_id']
                 gtitle = titles.get(gid, str(gid)) if gid else "Guruh tanlanmagan"
-                user_link = f"[{fullname}](tg://user?id={uid})"
+                user_link = f"[{item['fullname']}](tg://user?id={item['user_id']})"
                 
                 lines.append(f"• {user_link}")
-                lines.append(f"  📞 {phone}")
+                lines.append(f"  📞 {item['phone']}")
                 lines.append(f"  👥 {gtitle}\n")
             
             if len(approved_initial) > 10:
@@ -2111,50 +3855,16 @@ async def cmd_dashboard(m: Message):
         
         lines.append("─" * 30 + "\n")
         
-        seen_users = set()
-        all_soon_expiring = []
-        
-        for row in soon_expiring:
-            key = (row['user_id'], row['group_id'])
-            if key not in seen_users:
-                seen_users.add(key)
-                all_soon_expiring.append({
-                    'uid': row['user_id'],
-                    'gid': row['group_id'],
-                    'expires_at': row['expires_at'],
-                    'fullname': row['full_name'] or "Nomsiz",
-                    'phone': row['phone'] or "N/A"
-                })
-        
-        for row in soon_expiring_groups:
-            key = (row['user_id'], row['group_id'])
-            if key not in seen_users:
-                seen_users.add(key)
-                all_soon_expiring.append({
-                    'uid': row['user_id'],
-                    'gid': row['group_id'],
-                    'expires_at': row['expires_at'],
-                    'fullname': row['full_name'] or "Nomsiz",
-                    'phone': row['phone'] or "N/A"
-                })
-        
-        all_soon_expiring.sort(key=lambda x: x['expires_at'])
-        
         if all_soon_expiring:
             lines.append(f"⏰ *3 kun ichida obunasi tugaydiganlar*: {len(all_soon_expiring)} ta\n")
             for item in all_soon_expiring[:10]:
-                uid = item['uid']
-                gid = item['gid']
-                expires_at = item['expires_at']
-                fullname = item['fullname']
-                phone = item['phone']
-                
-                exp_str, left_days = human_left(expires_at)
+                gid = item['group_id']
+                exp_str, left_days = human_left(item['expires_at'])
                 gtitle = titles.get(gid, str(gid)) if gid else "N/A"
-                user_link = f"[{fullname}](tg://user?id={uid})"
+                user_link = f"[{item['fullname']}](tg://user?id={item['user_id']})"
                 
                 lines.append(f"• {user_link}")
-                lines.append(f"  📞 {phone}")
+                lines.append(f"  📞 {item['phone']}")
                 lines.append(f"  👥 {gtitle}")
                 lines.append(f"  ⏳ {exp_str} ({left_days} kun)\n")
             
@@ -2165,50 +3875,16 @@ async def cmd_dashboard(m: Message):
         
         lines.append("─" * 30 + "\n")
         
-        seen_expired = set()
-        all_expired = []
-        
-        for row in expired_users:
-            key = (row['user_id'], row['group_id'])
-            if key not in seen_expired:
-                seen_expired.add(key)
-                all_expired.append({
-                    'uid': row['user_id'],
-                    'gid': row['group_id'],
-                    'expires_at': row['expires_at'],
-                    'fullname': row['full_name'] or "Nomsiz",
-                    'phone': row['phone'] or "N/A"
-                })
-        
-        for row in expired_user_groups:
-            key = (row['user_id'], row['group_id'])
-            if key not in seen_expired:
-                seen_expired.add(key)
-                all_expired.append({
-                    'uid': row['user_id'],
-                    'gid': row['group_id'],
-                    'expires_at': row['expires_at'],
-                    'fullname': row['full_name'] or "Nomsiz",
-                    'phone': row['phone'] or "N/A"
-                })
-        
-        all_expired.sort(key=lambda x: x['expires_at'], reverse=True)
-        
         if all_expired:
-            lines.append(f"❌ *Obunasi tugagan o'quvchilar*: {len(all_expired)} ta\n")
+            lines.append(f"❌ *Obunasi tugagan o'quvchilar* (oxirgi {DASHBOARD_EXPIRED_DAYS} kun): {len(all_expired)} ta\n")
             for item in all_expired[:10]:
-                uid = item['uid']
-                gid = item['gid']
-                expires_at = item['expires_at']
-                fullname = item['fullname']
-                phone = item['phone']
-                
-                exp_str, _ = human_left(expires_at)
+                gid = item['group_id']
+                exp_str, _ = human_left(item['expires_at'])
                 gtitle = titles.get(gid, str(gid)) if gid else "N/A"
-                user_link = f"[{fullname}](tg://user?id={uid})"
+                user_link = f"[{item['fullname']}](tg://user?id={item['user_id']})"
                 
                 lines.append(f"• {user_link}")
-                lines.append(f"  📞 {phone}")
+                lines.append(f"  📞 {item['phone']}")
                 lines.append(f"  👥 {gtitle}")
                 lines.append(f"  📅 {exp_str}\n")
             
@@ -2241,85 +3917,265 @@ async def cmd_payments(m: Message):
         parse_mode="Markdown"
     )
 
-@dp.callback_query(F.data == "pay_pending_initial")
-async def cb_pending_initial(callback: CallbackQuery):
-    """Yangi userlar - guruhga qo'shilish kutilmoqda (faqat Super Admin) - cheki rasm bilan."""
-    admin_id = callback.from_user.id
-    is_super = is_super_admin(admin_id)
+# ==================== PAYMENT BROWSER ====================
+# To'lovlar ro'yxati endi har bir qator uchun alohida xabar yubormaydi: bitta
+# xabarda PAYMENT_PAGE_SIZE tadan sahifa, (created_at, id) bo'yicha keyset
+# pagination va ⬅️/➡️ tugmalari. Chek rasmi faqat tugma bosilganda yuboriladi.
+
+PAYMENT_PAGE_SIZE = int(os.getenv("PAYMENT_PAGE_SIZE", "10"))
+
+# kind -> ko'rinish sozlamalari (callback_data qisqa bo'lishi uchun 2 harfli kalit)
+PAYMENT_VIEWS = {
+    "pi": {
+        "title": "🆕 Guruhga qo'shilish kutilayotganlar",
+        "empty": "✅ Oxirgi 3 kun ichida guruhga qo'shilish kutilayotgan to'lovlar yo'q.",
+        "status": "pending", "types": ["initial"], "days": 3, "super_only": True,
+    },
+    "pp": {
+        "title": "⏳ Kutilayotgan to'lovlar",
+        "empty": "⏳ Hozircha kutilayotgan to'lovlar yo'q.",
+        "status": "pending", "types": None, "days": None, "super_only": False,
+    },
+    "pa": {
+        "title": "✅ Tasdiqlangan to'lovlar",
+        "empty": "✅ Hozircha tasdiqlangan to'lovlar yo'q.",
+        "status": "approved", "types": None, "days": None, "super_only": False,
+    },
+}
+
+async def fetch_payment_page(kind: str, allowed_groups: Optional[list[int]], cursor: Optional[tuple[int, int]] = None, backward: bool = False) -> tuple[list, bool]:
+    """Bir sahifa to'lovlarni keyset bo'yicha olish (yangidan eskiga).
+    
+    Args:
+        allowed_groups: None - super admin (barcha guruhlar)
+        cursor: (created_at, id) - shu to'lovdan keyingi (yoki backward=True bo'lsa oldingi) sahifa
+    
+    Returns:
+        (rows, has_more) - has_more: shu yo'nalishda yana to'lovlar bormi
+    """
+    view = PAYMENT_VIEWS[kind]
+    args: list = [view["status"]]
+    where = ["p.status = $1", "p.created_at IS NOT NULL"]
+    if view["types"]:
+        args.append(view["types"])
+        where.append(f"COALESCE(p.payment_type, 'initial') = ANY(${len(args)}::TEXT[])")
+    if view["days"]:
+        args.append(int(datetime.utcnow().timestamp()) - view["days"] * 86400)
+        where.append(f"p.created_at >= ${len(args)}")
+    if allowed_groups is not None:
+        args.append(allowed_groups)
+        where.append(
+            f"(u.group_id = ANY(${len(args)}::BIGINT[]) OR EXISTS ("
+            f"SELECT 1 FROM user_groups ug WHERE ug.user_id = p.user_id AND ug.group_id = ANY(${len(args)}::BIGINT[])))"
+        )
+    if cursor:
+        args += list(cursor)
+        op = ">" if backward else "<"
+        where.append(f"(p.created_at, p.id) {op} (${len(args) - 1}, ${len(args)})")
+    order = "ASC" if backward else "DESC"
+    args.append(PAYMENT_PAGE_SIZE + 1)
+    
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(f"""
+            SELECT p.id, p.user_id, p.created_at, p.payment_type,
+                   u.username, u.full_name, u.phone, u.group_id
+            FROM payments p
+            LEFT JOIN users u ON p.user_id = u.user_id
+            WHERE {' AND '.join(where)}
+            ORDER BY p.created_at {order}, p.id {order}
+            LIMIT ${len(args)}
+        """, *args)
+    
+    has_more = len(rows) > PAYMENT_PAGE_SIZE
+    rows = rows[:PAYMENT_PAGE_SIZE]
+    if backward:
+        rows.reverse()
+    return rows, has_more
+
+async def render_payment_page(kind: str, admin_id: int, cursor: Optional[tuple[int, int]] = None, backward: bool = False) -> tuple[str, Optional[InlineKeyboardMarkup]]:
+    """To'lovlar sahifasi matni va tugmalari (chek, ⬅️ Oldingi / Keyingi ➡️)."""
+    view = PAYMENT_VIEWS[kind]
+    allowed_groups = None if is_super_admin(admin_id) else await get_allowed_groups(admin_id)
+    if allowed_groups is not None and not allowed_groups:
+        return "❌ Sizga hech qanday guruh tayinlanmagan!", None
+    
+    rows, has_more = await fetch_payment_page(kind, allowed_groups, cursor, backward)
+    if not rows:
+        if cursor is None:
+            return view["empty"], None
+        # Sahifa orasida to'lovlar o'zgargan bo'lsa - boshidan ko'rsatish
+        rows, has_more = await fetch_payment_page(kind, allowed_groups)
+        cursor, backward = None, False
+        if not rows:
+            return view["empty"], None
     
-    if not is_super:
-        return await callback.answer("⛔ Faqat Super Admin yangi userlarni ko'rishi mumkin!", show_alert=True)
+    has_prev = has_more if backward else cursor is not None
+    has_next = True if backward else has_more
+    
+    titles = dict(await resolve_group_titles())
+    lines = [f"<b>{view['title']}</b>\n"]
+    for row in rows:
+        uid = row['user_id']
+        name = (row['full_name'] or row['username'] or "Nomsiz").replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        gid = row['group_id']
+        gtitle = (titles.get(gid, str(gid)) if gid else "Guruh tanlanmagan").replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        phone = (row['phone'] or 'N/A').replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        created_str = (datetime.utcfromtimestamp(row['created_at']) + TZ_OFFSET).strftime("%Y-%m-%d %H:%M")
+        kind_icon = "🔄" if row['payment_type'] == 'renewal' else "🆕"
+        lines.append(
+            f"{kind_icon} <a href=\"tg://user?id={uid}\">{name}</a> (ID: <code>{uid}</code>)\n"
+            f"   📞 {phone} · 👥 {gtitle}\n"
+            f"   📅 {created_str} · 💳 #{row['id']}\n"
+        )
+    
+    buttons = [
+        InlineKeyboardButton(text=f"🧾 #{row['id']}", callback_data=f"pbp:{row['id']}")
+        for row in rows
+    ]
+    keyboard = [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+    nav = []
+    if has_prev:
+        first = rows[0]
+        nav.append(InlineKeyboardButton(text="⬅️ Oldingi", callback_data=f"pb:{kind}:p:{first['created_at']}:{first['id']}"))
+    if has_next:
+        last = rows[-1]
+        nav.append(InlineKeyboardButton(text="Keyingi ➡️", callback_data=f"pb:{kind}:n:{last['created_at']}:{last['id']}"))
+    if nav:
+        keyboard.append(nav)
+    
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+async def show_payment_page(c: CallbackQuery, kind: str, cursor: Optional[tuple[int, int]] = None, backward: bool = False):
+    """Sahifani joriy xabar o'rniga ko'rsatish (tahrirlab bo'lmasa - yangi xabar)."""
+    if not await is_active_admin(c.from_user.id):
+        return await c.answer("Faqat adminlar uchun", show_alert=True)
+    if PAYMENT_VIEWS[kind]["super_only"] and not is_super_admin(c.from_user.id):
+        return await c.answer("⛔ Faqat Super Admin yangi userlarni ko'rishi mumkin!", show_alert=True)
     
     try:
-        await callback.message.delete()
-        three_days_ago = int(datetime.utcnow().timestamp()) - (3 * 24 * 60 * 60)
-        
-        async with db_pool.acquire() as conn:
-            payments = await conn.fetch("""
-                SELECT p.id, p.user_id, p.photo_file, p.created_at,
-                       u.username, u.full_name, u.phone, u.agreed_at, u.group_id
-                FROM payments p
-                LEFT JOIN users u ON p.user_id = u.user_id
-                WHERE p.status = 'pending' 
-                      AND p.created_at >= $1
-                      AND (p.payment_type = 'initial' OR p.payment_type IS NULL)
-                ORDER BY p.created_at DESC
-                LIMIT 10
-            """, three_days_ago)
-        
-        if not payments:
-            return await callback.message.answer(
-                "✅ *Guruhga qo'shilish kutilayotgan to'lovlar yo'q*\n\n"
-                "Oxirgi 3 kun ichida yangi to'lovlar topilmadi.",
-                parse_mode="Markdown"
-            )
-        
-        titles = dict(await resolve_group_titles())
-        
-        await callback.message.answer(f"🆕 *Guruhga qo'shilish kutilayotganlar*: {len(payments)} ta\n", parse_mode="Markdown")
-        
-        for row in payments:
-            pid = row['id']
-            uid = row['user_id']
-            username = row['username']
-            full_name = row['full_name'] or "Nomsiz"
-            phone = row['phone'] or "N/A"
-            photo_file_id = row['photo_file']
-            agreed_at = row['agreed_at']
-            gid = row['group_id']
-            
-            if isinstance(agreed_at, str):
-                try:
-                    agreed_at = int(agreed_at)
-                except ValueError:
-                    agreed_at = None
-            contract_date = (datetime.utcfromtimestamp(agreed_at) + TZ_OFFSET).strftime("%Y-%m-%d") if agreed_at and isinstance(agreed_at, int) else "yo'q"
-            
-            gtitle = titles.get(gid, str(gid)) if gid else "Guruh tanlanmagan"
-            kb = approve_keyboard(pid)
-            chat_link = f"📧 [{username}](tg://user?id={uid})" if username else f"📧 [Chat ochish](tg://user?id={uid})"
-            
-            caption = (
-                f"⏳ *Kutilayotgan to'lov*\n\n"
-                f"👤 {full_name}\n"
-                f"{chat_link}\n"
-                f"📞 {phone}\n"
-                f"👥 {gtitle}\n"
-                f"📄 Shartnoma: {contract_date}\n"
-                f"🆔 User ID: `{uid}`\n"
-                f"💳 Payment ID: `{pid}`"
-            )
-            
-            if photo_file_id:
-                await callback.message.answer_photo(photo_file_id, caption=caption, reply_markup=kb, parse_mode="Markdown")
-            else:
-                await callback.message.answer(caption, reply_markup=kb, parse_mode="Markdown")
-        
-        await callback.answer()
+        text, kb = await render_payment_page(kind, c.from_user.id, cursor, backward)
+        try:
+            await c.message.edit_text(text, reply_markup=kb, parse_mode="HTML", disable_web_page_preview=True)
+        except TelegramBadRequest as e:
+            # Matnning o'zi xato bo'lsa (HTML parse) yangi xabar ham xuddi shunday rad etiladi
+            if "can't parse entities" in str(e):
+                raise
+            if "message is not modified" not in str(e):
+                await c.message.answer(text, reply_markup=kb, parse_mode="HTML", disable_web_page_preview=True)
+        await c.answer()
+    except Exception as e:
+        logger.error(f"Error in payment browser ({kind}): {e}")
+        await c.answer("❌ Xatolik yuz berdi!", show_alert=True)
+
+async def admin_can_see_user(admin_id: int, user_id: int, user_row: Optional[UserRecord] = None) -> bool:
+    """Admin shu userning to'lovlarini ko'ra oladimi (super admin yoki umumiy guruh)."""
+    if is_super_admin(admin_id):
+        return True
+    allowed = set(await get_allowed_groups(admin_id))
+    async with db_pool.acquire() as conn:
+        user_groups = {r['group_id'] for r in await conn.fetch(
+            "SELECT group_id FROM user_groups WHERE user_id = $1", user_id
+        )}
+    if user_row and user_row.group_id:
+        user_groups.add(user_row.group_id)
+    return bool(allowed & user_groups)
+
+@dp.callback_query(F.data.startswith("pb:"))
+async def cb_payment_page(c: CallbackQuery):
+    """To'lovlar sahifasi: pb:{kind}:{n|p}:{created_at}:{id}."""
+    try:
+        _, kind, direction, created_at, pid = c.data.split(":")
+        cursor = (int(created_at), int(pid))
+    except ValueError:
+        return await c.answer("❌ Noto'g'ri so'rov", show_alert=True)
+    if kind not in PAYMENT_VIEWS:
+        return await c.answer("❌ Noto'g'ri so'rov", show_alert=True)
+    await show_payment_page(c, kind, cursor, backward=direction == "p")
+
+@dp.callback_query(F.data.startswith("pbp:"))
+async def cb_payment_photo(c: CallbackQuery):
+    """Bitta to'lov chekini (rasm) so'rov bo'yicha yuborish."""
+    admin_id = c.from_user.id
+    if not await is_active_admin(admin_id):
+        return await c.answer("Faqat adminlar uchun", show_alert=True)
+    
+    try:
+        pid = int(c.data.split(":")[1])
+        payment = await get_payment(pid)
+        if not payment:
+            return await c.answer("❌ To'lov topilmadi", show_alert=True)
+        
+        user_row = await get_user(payment.user_id)
+        if not await admin_can_see_user(admin_id, payment.user_id, user_row):
+            return await c.answer("⛔ Bu to'lov sizning guruhlaringizga tegishli emas", show_alert=True)
+        
+        uid = payment.user_id
+        full_name = (user_row.full_name if user_row else None) or "Nomsiz"
+        phone = (user_row.phone if user_row else None) or "N/A"
+        status_str = {"pending": "⏳ Kutilmoqda", "approved": "✅ Tasdiqlangan", "rejected": "❌ Rad etilgan"}.get(payment.status, payment.status)
+        caption = (
+            f"💳 *To'lov #{pid}* - {status_str}\n\n"
+            f"👤 [{full_name}](tg://user?id={uid})\n"
+            f"📞 {phone}\n"
+            f"🆔 User ID: `{uid}`"
+        )
+        kb = approve_keyboard(pid) if payment.status == "pending" else None
         
+        if payment.photo_file:
+            await c.message.answer_photo(payment.photo_file, caption=caption, reply_markup=kb, parse_mode="Markdown")
+        else:
+            await c.message.answer(caption + "\n\n⚠️ Chek rasmi yo'q", reply_markup=kb, parse_mode="Markdown")
+        await c.answer()
     except Exception as e:
-        logger.error(f"Error in cb_pending_initial: {e}")
-        await callback.answer("❌ Xatolik yuz berdi!", show_alert=True)
+        logger.error(f"Error in cb_payment_photo: {e}")
+        await c.answer("❌ Xatolik yuz berdi!", show_alert=True)
+
+@dp.message(Command("payment_history"))
+async def cmd_payment_history(m: Message):
+    """User'ning to'lovlar tarixi (hodisalar jurnali).
+    
+    Foydalanish: /payment_history USER_ID
+    """
+    if not await is_active_admin(m.from_user.id):
+        return await m.answer(f"⛔ Bu buyruq faqat adminlar uchun.\n\nSizning ID: {m.from_user.id}")
+    
+    parts = (m.text or "").split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        return await m.answer("❗ Foydalanish: /payment_history USER_ID")
+    
+    try:
+        uid = int(parts[1])
+        user_row = await get_user(uid)
+        if not await admin_can_see_user(m.from_user.id, uid, user_row):
+            return await m.answer("⛔ Bu user sizning guruhlaringizga tegishli emas")
+        
+        events = await payment_history(uid)
+        if not events:
+            return await m.answer("📜 Bu user uchun to'lov hodisalari topilmadi.")
+        
+        labels = {
+            "submitted": "📤 Yuborildi",
+            "approved": "✅ Tasdiqlandi",
+            "rejected": "❌ Rad etildi",
+            "removed": "🗑 O'chirildi",
+        }
+        name = ((user_row.full_name if user_row else None) or str(uid)).replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        lines = [f"📜 <b>To'lovlar tarixi</b>: {name} (<code>{uid}</code>)\n"]
+        for row in events:
+            when = (datetime.utcfromtimestamp(row['created_at']) + TZ_OFFSET).strftime("%Y-%m-%d %H:%M") if row['created_at'] else "—"
+            kind = "🔄" if row['payment_type'] == 'renewal' else "🆕"
+            admin = f" · admin <code>{row['admin_id']}</code>" if row['admin_id'] else ""
+            lines.append(f"{when} · {kind} #{row['payment_id']} · {labels.get(row['event'], row['event'])}{admin}")
+        await m.answer("\n".join(lines), parse_mode="HTML")
+    
+    except Exception as e:
+        logger.error(f"Error in cmd_payment_history: {e}")
+        await m.answer(f"Xatolik yuz berdi: {str(e)}")
+
+@dp.callback_query(F.data == "pay_pending_initial")
+async def cb_pending_initial(callback: CallbackQuery):
+    """Yangi userlar - guruhga qo'shilish kutilmoqda (faqat Super Admin), sahifalab."""
+    await show_payment_page(callback, "pi")
 
 @dp.callback_query(F.data == "pay_pending_renewal")
 async def cb_pending_renewal(callback: CallbackQuery):
@@ -2521,6 +4377,7 @@ async def cmd_groups(m: Message):
                         "UPDATE groups SET name = $1 WHERE group_id = $2",
                         name, gid
                     )
+                set_group_title(gid, name)
                 logger.info(f"Updated group name for {gid}: {name}")
             except Exception as e:
                 logger.warning(f"Failed to get chat title for {gid}: {e}")
@@ -3149,6 +5006,7 @@ async def cmd_assign_groups(m: Message):
             max_groups=max_groups,
             tariff=admin_info.get('tariff', 'custom')
         )
+        invalidate_admin_cache(admin_id)
         
         await m.answer(
             f"✅ <b>Guruhlar muvaffaqiyatli tayinlandi!</b>\n\n"
@@ -3226,7 +5084,7 @@ async def cmd_edit_payment(m: Message):
         )
         
         # Yangi to'lov ma'lumotlarini kutish
-        WAIT_PAYMENT_EDIT.add(m.from_user.id)
+        state_set(WAIT_PAYMENT_EDIT, m.from_user.id)
         logger.info(f"Admin {m.from_user.id} started payment info editing")
         
     except Exception as e:
@@ -3260,13 +5118,55 @@ async def cmd_edit_contract(m: Message):
         )
         
         # Yangi shartnoma matnini kutish
-        WAIT_CONTRACT_EDIT.add(m.from_user.id)
+        state_set(WAIT_CONTRACT_EDIT, m.from_user.id)
         logger.info(f"Admin {m.from_user.id} started contract editing")
         
     except Exception as e:
         logger.error(f"Error in cmd_edit_contract: {e}")
         await m.answer(f"Xatolik yuz berdi: {str(e)}")
 
+@dp.message(Command("contract_history"))
+async def cmd_contract_history(m: Message):
+    """Shartnoma versiyalari tarixi (audit).
+    
+    Foydalanish:
+    - /contract_history - oxirgi 10 ta versiya
+    - /contract_history VERSIYA - shu versiya matni (.txt)
+    """
+    if not is_admin(m.from_user.id):
+        return await m.answer(f"⛔ Bu buyruq faqat adminlar uchun.\n\nSizning ID: {m.from_user.id}")
+    
+    try:
+        parts = (m.text or "").split()
+        if len(parts) > 1:
+            if not parts[1].isdigit():
+                return await m.answer("❗ Foydalanish: /contract_history [VERSIYA]")
+            version = int(parts[1])
+            text = await get_contract_template_by_version(version)
+            if text is None:
+                return await m.answer(f"❌ {version}-versiya topilmadi.")
+            return await m.answer_document(
+                BufferedInputFile(text.encode("utf-8"), filename=f"shartnoma_v{version}.txt"),
+                caption=f"📄 Shartnoma, {version}-versiya"
+            )
+        
+        current, _text = await get_contract_template_version()
+        versions = await list_contract_versions()
+        if not versions:
+            return await m.answer("📄 Shartnoma tarixi bo'sh (standart matn ishlatilmoqda).")
+        
+        lines = ["📄 <b>Shartnoma versiyalari</b>\n"]
+        for version, created_at, size in versions:
+            created_str = (datetime.utcfromtimestamp(created_at) + TZ_OFFSET).strftime("%Y-%m-%d %H:%M")
+            mark = " ✅ joriy" if version == current else ""
+            lines.append(f"• <code>{version}</code> - {created_str}, {size} belgi{mark}")
+        lines.append("\nMatnni olish: /contract_history VERSIYA")
+        await m.answer("\n".join(lines), parse_mode="HTML")
+    
+    except Exception as e:
+        logger.error(f"Error in cmd_contract_history: {e}")
+        await m.answer(f"Xatolik yuz berdi: {str(e)}")
+
 @dp.message(Command("bulk_add"))
 async def cmd_bulk_add(m: Message):
     """Guruhning barcha a'zolarini bir vaqtda ro'yxatdan o'tkazish.
@@ -3445,12 +5345,121 @@ async def cmd_add_user(m: Message):
         logger.error(f"Error in cmd_add_user: {e}")
         await m.answer(f"Xatolik yuz berdi: {str(e)}")
 
+# ==================== BULK USER IMPORT ====================
+# /add_users uchun: minglab ID (matn yoki CSV/TXT fayl), profillar parallel olinadi,
+# barcha qatorlar COPY orqali vaqtinchalik jadvalga yozilib bitta so'rov bilan
+# users'ga qo'shiladi, xabarlar esa outbox orqali (rate limit bilan) yuboriladi.
+
+IMPORT_MAX_USERS = int(os.getenv("IMPORT_MAX_USERS", "10000"))
+IMPORT_MAX_FILE_BYTES = 2 * 1024 * 1024
+IMPORT_PROFILE_WORKERS = int(os.getenv("IMPORT_PROFILE_WORKERS", "10"))
+IMPORT_PROFILE_RATE = float(os.getenv("IMPORT_PROFILE_RATE", "25"))  # get_chat/soniya
+
+_IMPORT_PROFILE_BUCKET = new_token_bucket(IMPORT_PROFILE_RATE)
+
+def parse_import_ids(content: str) -> tuple[list[int], int]:
+    """CSV/TXT fayldan user ID'larni ajratish.
+    
+    Har bir qatordagi birinchi raqamli ustun ID hisoblanadi (sarlavha va bo'sh
+    qatorlar o'tkazib yuboriladi). Takrorlangan ID'lar bir marta olinadi.
+    
+    Returns:
+        (user_ids, skipped_lines)
+    """
+    user_ids: dict[int, None] = {}
+    skipped = 0
+    for line in content.splitlines():
+        cells = [cell.strip().strip('"') for cell in re.split(r"[,;\t ]+", line.strip())]
+        uid = next((int(cell) for cell in cells if cell.isdigit()), None)
+        if uid is None:
+            if line.strip():
+                skipped += 1
+            continue
+        user_ids[uid] = None
+    return list(user_ids), skipped
+
+async def fetch_profiles_bulk(user_ids: list[int], progress_msg: Optional[Message] = None) -> list[tuple[int, str, str]]:
+    """Profillarni parallel olish (IMPORT_PROFILE_WORKERS ta worker, umumiy rate limit).
+    
+    Returns:
+        [(user_id, username, full_name)] - user_ids tartibida
+    """
+    total = len(user_ids)
+    done = 0
+    loop = asyncio.get_running_loop()
+    last_edit = loop.time()
+    
+    async def fetch(uid: int) -> tuple[int, str, str]:
+        nonlocal done, last_edit
+        await take_token(_IMPORT_PROFILE_BUCKET)
+        username, full_name = await fetch_user_profile(uid)
+        done += 1
+        if progress_msg and loop.time() - last_edit >= PROGRESS_EDIT_INTERVAL:
+            last_edit = loop.time()
+            try:
+                await progress_msg.edit_text(f"⏳ Profillar olinmoqda: {done}/{total}")
+            except Exception:
+                pass
+        return uid, username, full_name
+    
+    results = await run_bounded(user_ids, fetch, IMPORT_PROFILE_WORKERS)
+    # Xato bo'lgan (None) profillar uchun fallback - fetch_user_profile bilan bir xil
+    return [res or (uid, "", str(uid)) for uid, res in zip(user_ids, results)]
+
+async def import_users_bulk(rows: list[tuple[int, str, str]], group_id: int, expires_at: int, notify_text: Optional[str] = None) -> int:
+    """Userlarni bitta tranzaksiyada qo'shish/yangilash (COPY + merge) va xabarlarni navbatga qo'yish.
+    
+    users (asosiy guruh) va user_groups (a'zolik) bitta so'rovda yoziladi - add_user/approve
+    yo'li bilan bir xil natija.
+    
+    Returns:
+        Yozilgan userlar soni
+    """
+    async with db_pool.acquire() as conn:
+        async with db_transaction(conn):
+            await conn.execute("""
+                CREATE TEMP TABLE import_users(
+                    user_id BIGINT PRIMARY KEY,
+                    username TEXT,
+                    full_name TEXT
+                ) ON COMMIT DROP
+            """)
+            await conn.copy_records_to_table("import_users", records=rows, columns=["user_id", "username", "full_name"])
+            written = await conn.fetchval("""
+                WITH merged AS (
+                    INSERT INTO users(user_id, username, full_name, group_id, expires_at)
+                    SELECT user_id, username, full_name, $1, $2 FROM import_users
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username=EXCLUDED.username,
+                        full_name=EXCLUDED.full_name,
+                        group_id=EXCLUDED.group_id,
+                        expires_at=EXCLUDED.expires_at
+                    RETURNING user_id
+                ), membership AS (
+                    INSERT INTO user_groups(user_id, group_id, expires_at)
+                    SELECT user_id, $1, $2 FROM merged
+                    ON CONFLICT(user_id, group_id) DO UPDATE SET expires_at=EXCLUDED.expires_at
+                )
+                SELECT COUNT(*) FROM merged
+            """, group_id, expires_at)
+            if notify_text:
+                await enqueue_notifications(conn, [row[0] for row in rows], notify_text, parse_mode="Markdown")
+            if rows:
+                # Barcha qatorlar bir xil muddatda - scheduler'ga har bir jadval uchun bitta yozuv yetarli
+                after_commit(conn, rearm_expiry, "users", rows[0][0], group_id, expires_at)
+                after_commit(conn, rearm_expiry, "user_groups", rows[0][0], group_id, expires_at)
+                after_commit(conn, dashboard_touch, *(row[0] for row in rows))
+    if notify_text:
+        notify_outbox()
+    return written
+
 @dp.message(Command("add_users"))
 async def cmd_add_users(m: Message):
     """Bir nechta foydalanuvchini bir vaqtda bir xil sana bilan qo'shish.
     
     Foydalanish:
     - /add_users USER_ID1 USER_ID2 USER_ID3 ... [SANA]
+    - CSV/TXT fayl, izohi (caption): /add_users [SANA] - har qatorda bitta ID
     
     Misol:
     - /add_users 123456789 987654321 555111222 now
@@ -3466,22 +5475,23 @@ async def cmd_add_users(m: Message):
         return await m.answer("❌ Sizga hech qanday guruhga ruxsat yo'q!")
     
     try:
-        # Parametrlarni parsing qilish
-        parts = m.text.split()
+        # Parametrlarni parsing qilish (fayl bilan yuborilsa buyruq caption'da bo'ladi)
+        parts = (m.text or m.caption or "").split()
         
-        if len(parts) < 3:
+        if len(parts) < 3 and not m.document:
             return await m.answer(
                 "❗ *Foydalanish:*\n\n"
                 "`/add_users USER_ID1 USER_ID2 ... [SANA]`\n\n"
                 "*Misollar:*\n"
                 "• `/add_users 123456789 987654321 now` - 2 ta user, bugundan\n"
                 "• `/add_users 111 222 333 2025-11-15` - 3 ta user, belgilangan sanadan\n"
-                "• `/add_users 111 222 333 444 555` - 5 ta user, bugundan",
+                "• `/add_users 111 222 333 444 555` - 5 ta user, bugundan\n\n"
+                "📎 Ko'p userlar uchun CSV/TXT faylni `/add_users [SANA]` izohi bilan yuboring.",
                 parse_mode="Markdown"
             )
         
         # Oxirgi element sana yoki "now" yoki user ID ekanligini aniqlash
-        last_part = parts[-1].strip().lower()
+        last_part = parts[-1].strip().lower() if len(parts) > 1 else ""
         
         # Sana parametrini ajratish
         start_date = datetime.utcnow()
@@ -3509,8 +5519,20 @@ async def cmd_add_users(m: Message):
             except ValueError:
                 return await m.answer(f"❗ '{part}' user ID emas. Faqat raqamlar kiriting.")
         
+        # Fayldagi ID'lar
+        skipped_lines = 0
+        if m.document:
+            if m.document.file_size and m.document.file_size > IMPORT_MAX_FILE_BYTES:
+                return await m.answer("❗ Fayl juda katta (maksimal 2 MB).")
+            buf = await bot.download(m.document, destination=io.BytesIO())
+            file_ids, skipped_lines = parse_import_ids(buf.getvalue().decode("utf-8-sig", errors="replace"))
+            user_ids.extend(file_ids)
+        
+        user_ids = list(dict.fromkeys(user_ids))
         if not user_ids:
             return await m.answer("❗ Kamida 1 ta user ID kiriting.")
+        if len(user_ids) > IMPORT_MAX_USERS:
+            return await m.answer(f"❗ Bir martada ko'pi bilan {IMPORT_MAX_USERS} ta user qo'shish mumkin.")
         
         # Obuna tugash sanasini hisoblash
         expires_at = int((start_date + timedelta(days=SUBSCRIPTION_DAYS)).timestamp())
@@ -3523,37 +5545,35 @@ async def cmd_add_users(m: Message):
         # Jarayonni boshlash
         processing_msg = await m.answer(f"⏳ {len(user_ids)} ta foydalanuvchi qo'shilmoqda...")
         
-        # Barcha userlarni qo'shish
+        # 1. Profillarni parallel olish
+        rows = await fetch_profiles_bulk(user_ids, processing_msg)
+        
+        # 2. Bitta tranzaksiyada yozish + userlarga xabarlarni navbatga qo'yish
+        try:
+            await processing_msg.edit_text(f"💾 {len(rows)} ta foydalanuvchi database'ga yozilmoqda...")
+        except Exception:
+            pass
+        
         added_users = []
         failed_users = []
-        
-        for user_id in user_ids:
-            try:
-                # Foydalanuvchi ma'lumotlarini olish
-                username, fullname = await fetch_user_profile(user_id)
-                
-                # Database'ga qo'shish
-                await upsert_user(uid=user_id, username=username, full_name=fullname, group_id=primary_gid, expires_at=expires_at)
-                
-                # User'ga xabar yuborish (agar mumkin bo'lsa)
-                try:
-                    await bot.send_message(
-                        user_id,
-                        f"✅ *Tabriklaymiz! Obuna faollashtirildi!*\n\n"
-                        f"📅 Obuna: {human_start} dan {SUBSCRIPTION_DAYS} kun\n"
-                        f"⏳ Tugash sanasi: {human_exp}\n\n"
-                        f"🎓 Darslarni yaxshi o'zlashtirishingizni tilaymiz!",
-                        parse_mode="Markdown"
-                    )
-                except Exception:
-                    pass  # Xabar yuborilmasa ham davom etamiz
-                
-                added_users.append((user_id, fullname))
-                logger.info(f"User {user_id} added via bulk add by admin {m.from_user.id}")
-                
-            except Exception as e:
-                logger.error(f"Failed to add user {user_id}: {e}")
-                failed_users.append((user_id, str(e)))
+        try:
+            await import_users_bulk(
+                rows, primary_gid, expires_at,
+                notify_text=(
+                    f"✅ *Tabriklaymiz! Obuna faollashtirildi!*\n\n"
+                    f"📅 Obuna: {human_start} dan {SUBSCRIPTION_DAYS} kun\n"
+                    f"⏳ Tugash sanasi: {human_exp}\n\n"
+                    f"🎓 Darslarni yaxshi o'zlashtirishingizni tilaymiz!"
+                )
+            )
+            added_users = [(uid, fullname) for uid, _username, fullname in rows]
+            logger.info(f"{len(added_users)} users added via bulk add by admin {m.from_user.id}")
+        except Exception as e:
+            logger.error(f"Bulk import failed for admin {m.from_user.id}: {e}")
+            failed_users = [(uid, str(e)) for uid in user_ids]
+        
+        if skipped_lines:
+            await m.answer(f"ℹ️ Fayldagi {skipped_lines} ta qatorda user ID topilmadi - o'tkazib yuborildi.")
         
         # Natijani ko'rsatish
         await processing_msg.delete()
@@ -3592,6 +5612,60 @@ async def cmd_add_users(m: Message):
         logger.error(f"Error in cmd_add_users: {e}")
         await m.answer(f"Xatolik yuz berdi: {str(e)}")
 
+@dp.message(Command("renew_users"))
+async def cmd_renew_users(m: Message):
+    """Bir nechta userning barcha obunalarini bitta so'rovda uzaytirish (faqat super admin).
+    
+    Masalan, butun sinf uchun homiy to'lagan holatda.
+    
+    Foydalanish:
+    - /renew_users USER_ID1 USER_ID2 ...
+    - CSV/TXT fayl, izohi (caption): /renew_users - har qatorda bitta ID
+    """
+    if not is_super_admin(m.from_user.id):
+        return await m.answer(f"⛔ Bu buyruq faqat super adminlar uchun.\n\nSizning ID: {m.from_user.id}")
+    
+    try:
+        parts = (m.text or m.caption or "").split()
+        user_ids = [int(p) for p in parts[1:] if p.isdigit()]
+        if m.document:
+            if m.document.file_size and m.document.file_size > IMPORT_MAX_FILE_BYTES:
+                return await m.answer("❗ Fayl juda katta (maksimal 2 MB).")
+            buf = await bot.download(m.document, destination=io.BytesIO())
+            file_ids, _skipped = parse_import_ids(buf.getvalue().decode("utf-8-sig", errors="replace"))
+            user_ids.extend(file_ids)
+        user_ids = list(dict.fromkeys(user_ids))
+        if len(user_ids) > IMPORT_MAX_USERS:
+            return await m.answer(f"❗ Bir martada ko'pi bilan {IMPORT_MAX_USERS} ta userni uzaytirish mumkin.")
+        
+        if not user_ids:
+            return await m.answer(
+                "❗ *Foydalanish:*\n\n"
+                "`/renew_users USER_ID1 USER_ID2 ...`\n\n"
+                "📎 Ko'p userlar uchun CSV/TXT faylni `/renew_users` izohi bilan yuboring.",
+                parse_mode="Markdown"
+            )
+        
+        async with db_pool.acquire() as conn:
+            async with db_transaction(conn):
+                renewed = await renew_subscriptions_bulk(user_ids, conn=conn)
+                await enqueue_notifications(
+                    conn, list(renewed),
+                    f"🎉 Obunalaringiz {SUBSCRIPTION_DAYS} kunga uzaytirildi!"
+                )
+        
+        missing = [uid for uid in user_ids if uid not in renewed]
+        lines = [f"✅ <b>{len(renewed)} ta user obunasi {SUBSCRIPTION_DAYS} kunga uzaytirildi</b>"]
+        if missing:
+            lines.append(f"\n⚠️ Obunasi topilmadi ({len(missing)}): " + ", ".join(f"<code>{uid}</code>" for uid in missing[:20]))
+            if len(missing) > 20:
+                lines.append(f"... va yana {len(missing) - 20} ta")
+        await m.answer("\n".join(lines), parse_mode="HTML")
+    
+    except Exception as e:
+        logger.error(f"Error in cmd_renew_users: {e}")
+        await m.answer(f"Xatolik yuz berdi: {str(e)}")
+
 @dp.message(Command("remove_user"))
 async def cmd_remove_user(m: Message):
     """Foydalanuvchini tizimdan butunlay o'chirish (confirmation bilan).
@@ -3837,7 +5911,8 @@ async def cmd_subscribers(m: Message):
         now = int(datetime.utcnow().timestamp())
         titles = dict(await resolve_group_titles(allowed_groups))
         
-        total_subscribers = 0
+        export_rows = []
+        group_lines = []
         
         for gid in allowed_groups:
             gtitle = titles.get(gid, f"Guruh {gid}")
@@ -3852,59 +5927,37 @@ async def cmd_subscribers(m: Message):
             
             # Telegram'dagi haqiqiy memberlar
             real_members = []
-            for uid in active_db_users.keys():
-                try:
-                    member = await bot.get_chat_member(gid, uid)
-                    if member.status in ["member", "administrator", "creator"]:
-                        username, full_name, exp, phone = active_db_users[uid]
-                        days_left = max(0, int((exp - now) / 86400))
-                        real_members.append({
-                            'uid': uid,
-                            'username': username,
-                            'fullname': full_name,
-                            'phone': phone,
-                            'exp': exp,
-                            'days_left': days_left
-                        })
-                except Exception:
-                    pass
-            
-            if not real_members:
-                await m.answer(f"🏷 <b>{gtitle}</b>\n\n❌ Aktiv obunachi yo'q", parse_mode="HTML")
-                continue
+            async for uid, status in verify_members(gid, list(active_db_users.keys()), processing_msg, gtitle):
+                if status in ACTIVE_MEMBER_STATUSES:
+                    username, full_name, exp, phone = active_db_users[uid]
+                    real_members.append((uid, username, full_name, exp, phone))
             
             # Sort by expiry (soonest first)
-            real_members.sort(key=lambda x: x['exp'])
-            
-            total_subscribers += len(real_members)
-            
-            lines = [f"🏷 <b>{gtitle}</b> — {len(real_members)} ta obunachi\n"]
-            
-            for i, sub in enumerate(real_members[:50], start=1):
-                name = sub['fullname'] or f"User{sub['uid']}"
-                safe_name = name.replace('<', '&lt;').replace('>', '&gt;')
-                username = sub['username']
-                user_tag = f"@{username}" if username else safe_name
-                phone_str = f" 📞 {sub['phone']}" if sub['phone'] else ""
-                days_str = f"{sub['days_left']} kun"
-                
-                lines.append(f"{i}. {user_tag}{phone_str}")
-                lines.append(f"   • ID: <code>{sub['uid']}</code>")
-                lines.append(f"   • ⏳ Qoldi: {days_str}\n")
-            
-            if len(real_members) > 50:
-                lines.append(f"... va yana {len(real_members) - 50} ta")
-            
-            await m.answer("\n".join(lines), parse_mode="HTML")
+            real_members.sort(key=lambda x: x[3])
+            export_rows.extend(
+                subscriber_export_row(gid, gtitle, uid, username, full_name, phone, exp)
+                for uid, username, full_name, exp, phone in real_members
+            )
+            safe_title = gtitle.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            group_lines.append(f"🏷 {safe_title} — {len(real_members)} ta")
         
-        await processing_msg.delete()
+        try:
+            await processing_msg.delete()
+        except Exception:
+            pass
         
+        total_subscribers = len(export_rows)
+        groups_text = "\n".join(group_lines)
         summary = (
             f"✅ <b>JAMI OBUNCHILAR: {total_subscribers} ta</b>\n\n"
+            f"{groups_text}\n\n"
             f"📚 Guruhlar soni: {len(allowed_groups)}\n"
             f"🔍 Faqat Telegram guruhda haqiqatan turgan va aktiv obunasi bor foydalanuvchilar ko'rsatildi."
         )
         await m.answer(summary, parse_mode="HTML")
+        if export_rows:
+            await send_export(m.chat.id, iter_list(export_rows), SUBSCRIBER_EXPORT_COLUMNS,
+                              "subscribers", caption="👥 Aktiv obunachilar")
         
         logger.info(f"Admin {m.from_user.id} checked subscribers: {total_subscribers} found")
         
@@ -3924,18 +5977,10 @@ async def cmd_stats(m: Message):
     
     now = int(datetime.utcnow().timestamp())
     
-    # Faqat ruxsat etilgan guruhlardagi unique userlarni yig'amiz
-    all_users = {}
-    for gid in allowed_groups:
-        members = await all_members_of_group(gid)
-        for uid, username, full_name, exp, phone in members:
-            if uid not in all_users or (all_users[uid] or 0) < (exp or 0):
-                all_users[uid] = exp
-    
-    # Statistika hisoblash
-    total = len(all_users)
-    active = sum(1 for exp in all_users.values() if exp and exp > now)
-    expired = sum(1 for exp in all_users.values() if exp and 0 < exp <= now)
+    # Statistika va a'zolar - barcha guruhlar uchun bir martada
+    stats = await subscription_stats(allowed_groups, now)
+    members_by_group = await members_of_groups(allowed_groups)
+    total, active, expired = stats["total"], stats["active"], stats["expired"]
     
     header = (
         "📊 Statistika (faqat guruhdagilar)\n"
@@ -3945,27 +5990,21 @@ async def cmd_stats(m: Message):
         f"📚 Guruhlar kesimi ({len(allowed_groups)} ta):"
     )
     await m.answer(header)
+    progress_msg = await m.answer("⏳ A'zolar tekshirilmoqda...")
     
     titles = dict(await resolve_group_titles(allowed_groups))
     for gid in allowed_groups:
-        users = await all_members_of_group(gid)
+        users = members_by_group.get(gid, [])
         # Faqat aktiv obunali foydalanuvchilarni qoldirish
         active_users = [(uid, username, full_name, exp, phone) 
                         for uid, username, full_name, exp, phone in users 
                         if exp and exp > now]
         
+        title = titles.get(gid, str(gid))
+        
         # Telegram API orqali guruhda turganlarni tekshirish
-        real_members = []
-        for uid, username, full_name, exp, phone in active_users:
-            try:
-                member = await bot.get_chat_member(gid, uid)
-                if member.status in ["member", "administrator", "creator"]:
-                    real_members.append((uid, username, full_name, exp, phone))
-            except Exception:
-                # Agar user topilmasa yoki xato bo'lsa, o'tkazib yuboramiz
-                pass
+        real_members = await filter_real_members(gid, active_users, progress_msg, title)
         
-        title = titles.get(gid, str(gid))
         if not real_members:
             await m.answer(f"🏷 {title} — 0 a'zo")
             continue
@@ -3984,6 +6023,11 @@ async def cmd_stats(m: Message):
             lines.append(f"... va yana {len(users_sorted)-MAX_SHOW} ta")
         
         await m.answer("\n".join(lines))
+    
+    try:
+        await progress_msg.delete()
+    except Exception:
+        pass
 
 @dp.message(Command("gstats"))
 async def cmd_gstats(m: Message):
@@ -3998,60 +6042,74 @@ async def cmd_gstats(m: Message):
     
     try:
         titles = dict(await resolve_group_titles(allowed_groups))
-        total_groups = len(allowed_groups)
-        
-        await m.answer(f"📊 *Guruhlar statistikasi*\n\n🏫 Jami guruhlar: {total_groups}\n", parse_mode="Markdown")
+        stats = await subscription_stats(allowed_groups, int(datetime.utcnow().timestamp()))
         
+        lines = [f"📊 <b>Guruhlar statistikasi</b>\n\n🏫 Jami guruhlar: {len(allowed_groups)}\n"]
         for idx, gid in enumerate(allowed_groups, start=1):
-            users = await all_members_of_group(gid)
-            title = titles.get(gid, f"Guruh {gid}")
-            
-            if not users:
-                await m.answer(f"🏷 {idx}. *{title}*\nID: `{gid}`\n👥 A'zolar: 0", parse_mode="Markdown")
-                continue
-            
-            header = f"🏷 {idx}. *{title}*\nID: `{gid}`\n👥 A'zolar: {len(users)}\n{'─' * 30}"
-            buf = [header]
-            
-            users_sorted = sorted(users, key=lambda r: (r[3] or 0), reverse=True)
-            
-            for i, (uid, username, full_name, exp, phone) in enumerate(users_sorted, start=1):
-                name = full_name or f"User{uid}"
-                username_s = f"@{username}" if username else "username yo'q"
-                exp_str, left = human_left(exp) if exp else ("belgilanmagan", 0)
-                phone_s = phone or "-"
-                
-                user_line = (
-                    f"{i}. 👤 {name}\n"
-                    f"   • Username: {username_s}\n"
-                    f"   • ID: `{uid}`\n"
-                    f"   • Telefon: {phone_s}\n"
-                    f"   • Obuna: {exp_str} ({left} kun qoldi)"
-                )
-                buf.append(user_line)
-            
-            message = "\n\n".join(buf)
-            
-            if len(message) > 4000:
-                parts = []
-                current_part = header
-                for line in buf[1:]:
-                    if len(current_part) + len(line) + 2 > 4000:
-                        parts.append(current_part)
-                        current_part = line
-                    else:
-                        current_part += "\n\n" + line
-                if current_part:
-                    parts.append(current_part)
-                
-                for part in parts:
-                    await m.answer(part, parse_mode="Markdown")
-            else:
-                await m.answer(message, parse_mode="Markdown")
+            title = titles.get(gid, f"Guruh {gid}").replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+            counts = stats["groups"].get(gid, {})
+            lines.append(f"🏷 {idx}. <b>{title}</b> (<code>{gid}</code>) — 👥 {counts.get('total', 0)}, ✅ {counts.get('active', 0)}")
+        await m.answer("\n".join(lines), parse_mode="HTML")
+        
+        # A'zolar ro'yxati - bitta fayl
+        await send_export(m.chat.id, iter_subscriber_rows(allowed_groups), SUBSCRIBER_EXPORT_COLUMNS,
+                          "gstats", caption="👥 Guruhlar a'zolari")
     except Exception as e:
         logger.error(f"Error in cmd_gstats: {e}")
         await m.answer(f"Xatolik yuz berdi: {e}")
 
+@dp.message(Command("export"))
+async def cmd_export(m: Message):
+    """Obunachilar yoki to'lovlarni CSV/XLSX fayl qilib yuklab olish.
+    
+    Foydalanish: /export subscribers|payments [GROUP_ID] [xlsx]
+    """
+    if not await is_active_admin(m.from_user.id):
+        return await m.answer(f"⛔ Bu buyruq faqat adminlar uchun.\n\nSizning ID: {m.from_user.id}")
+    
+    args = (m.text or "").split()[1:]
+    kind = args[0].lower() if args else ""
+    if kind not in ("subscribers", "payments"):
+        return await m.answer("❗ Foydalanish: /export subscribers|payments [GROUP_ID] [xlsx]")
+    fmt = "xlsx" if any(a.lower() == "xlsx" for a in args[1:]) else "csv"
+    group_arg = next((a for a in args[1:] if a.lstrip("-").isdigit()), None)
+    
+    try:
+        allowed_groups = await get_allowed_groups(m.from_user.id)
+        if group_arg:
+            group_id = int(group_arg)
+            if not await check_group_access(m.from_user.id, group_id):
+                return await m.answer("❌ Sizga bu guruhga ruxsat yo'q!")
+            group_ids = [group_id]
+        elif not allowed_groups:
+            return await m.answer("❌ Sizga hech qanday guruh tayinlanmagan!")
+        else:
+            group_ids = allowed_groups
+        
+        progress_msg = await m.answer("⏳ Fayl tayyorlanmoqda...")
+        if kind == "subscribers":
+            rows = iter_subscriber_rows(group_ids)
+            columns = SUBSCRIBER_EXPORT_COLUMNS
+            caption = "👥 Obunachilar"
+        else:
+            # Super admin guruh ko'rsatmasa - barcha to'lovlar (guruhsiz userlarniki ham)
+            rows = iter_payment_rows(None if is_super_admin(m.from_user.id) and not group_arg else group_ids)
+            columns = PAYMENT_EXPORT_COLUMNS
+            caption = "💳 To'lovlar"
+        
+        filename = f"{kind}_{group_arg}" if group_arg else kind
+        count = await send_export(m.chat.id, rows, columns, filename, fmt, caption)
+        try:
+            await progress_msg.delete()
+        except Exception:
+            pass
+        
+        logger.info(f"Admin {m.from_user.id} exported {kind} ({count} rows, {fmt})")
+    
+    except Exception as e:
+        logger.error(f"Error in cmd_export: {e}")
+        await m.answer(f"Xatolik yuz berdi: {str(e)}")
+
 @dp.message(F.text == "📊 Statistika")
 async def admin_stats_button(m: Message):
     """Admin Statistika tugmasi handleri."""
@@ -4066,18 +6124,10 @@ async def admin_stats_button(m: Message):
     
     now = int(datetime.utcnow().timestamp())
     
-    # Faqat ruxsat etilgan guruhlardagi unique userlarni yig'amiz
-    all_users = {}
-    for gid in allowed_groups:
-        members = await all_members_of_group(gid)
-        for uid, username, full_name, exp, phone in members:
-            if uid not in all_users or (all_users[uid] or 0) < (exp or 0):
-                all_users[uid] = exp
-    
-    # Statistika hisoblash
-    total = len(all_users)
-    active = sum(1 for exp in all_users.values() if exp and exp > now)
-    expired = sum(1 for exp in all_users.values() if exp and 0 < exp <= now)
+    # Statistika va a'zolar - barcha guruhlar uchun bir martada
+    stats = await subscription_stats(allowed_groups, now)
+    members_by_group = await members_of_groups(allowed_groups)
+    total, active, expired = stats["total"], stats["active"], stats["expired"]
     
     header = (
         "📊 Statistika (faqat guruhdagilar)\n"
@@ -4087,26 +6137,21 @@ async def admin_stats_button(m: Message):
         f"📚 Guruhlar kesimi ({len(allowed_groups)} ta):"
     )
     await m.answer(header)
+    progress_msg = await m.answer("⏳ A'zolar tekshirilmoqda...")
     
     titles = dict(await resolve_group_titles(allowed_groups))
     for gid in allowed_groups:
-        users = await all_members_of_group(gid)
+        users = members_by_group.get(gid, [])
         # Faqat aktiv obunali foydalanuvchilarni qoldirish
         active_users = [(uid, username, full_name, exp, phone) 
                         for uid, username, full_name, exp, phone in users 
                         if exp and exp > now]
         
+        title = titles.get(gid, str(gid))
+        
         # Telegram API orqali guruhda turganlarni tekshirish
-        real_members = []
-        for uid, username, full_name, exp, phone in active_users:
-            try:
-                member = await bot.get_chat_member(gid, uid)
-                if member.status in ["member", "administrator", "creator"]:
-                    real_members.append((uid, username, full_name, exp, phone))
-            except Exception:
-                pass
+        real_members = await filter_real_members(gid, active_users, progress_msg, title)
         
-        title = titles.get(gid, str(gid))
         if not real_members:
             await m.answer(f"🏷 {title} — 0 a'zo")
             continue
@@ -4122,6 +6167,11 @@ async def admin_stats_button(m: Message):
             lines.append(f"... +{len(real_members) - MAX_SHOW} ta ko'proq")
         
         await m.answer("\n".join(lines))
+    
+    try:
+        await progress_msg.delete()
+    except Exception:
+        pass
 
 @dp.message(F.text == "👥 Guruh o'quvchilari")
 async def admin_group_users_button(m: Message):
@@ -4154,198 +6204,35 @@ async def cmd_group_users(m: Message):
     # Guruhlar ro'yxatini ko'rsatish
     titles = dict(await resolve_group_titles())
     buttons = []
-    for gid in GROUP_IDS:
-        title = titles.get(gid, str(gid))
-        buttons.append([InlineKeyboardButton(text=f"📚 {title}", callback_data=f"gusers_{gid}")])
-    
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
-    await m.answer("👥 <b>Guruh tanlang</b>\n\nQaysi guruhdagi o'quvchilarni ko'rmoqchisiz?", reply_markup=kb, parse_mode="HTML")
-
-@dp.message(F.text == "✅ Tasdiqlangan to'lovlar")
-async def admin_approved_button(m: Message):
-    """Admin Tasdiqlangan to'lovlar tugmasi handleri."""
-    if not is_admin(m.from_user.id):
-        return
-    
-    # Tanlash tugmalarini ko'rsatish
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📋 Oxirgi 3 tasi", callback_data="approved_last3")],
-        [InlineKeyboardButton(text="📚 Hammasi", callback_data="approved_all")]
-    ])
-    
-    await m.answer("✅ *Tasdiqlangan to'lovlar*\n\nQaysi birini ko'rmoqchisiz?", reply_markup=kb, parse_mode="Markdown")
-
-@dp.callback_query(F.data == "approved_last3")
-async def cb_approved_last3(c: CallbackQuery):
-    """Oxirgi 3 ta tasdiqlangan to'lovni ko'rsatish."""
-    await c.answer()
-    
-    try:
-        approved_payments = await db_pool.fetch(
-            "SELECT id, user_id, photo_file, admin_id, created_at FROM payments WHERE status = 'approved' ORDER BY id DESC LIMIT 3"
-        )
-        
-        if not approved_payments:
-            await c.message.edit_text("✅ Hozircha tasdiqlangan to'lovlar yo'q.")
-            return
-        
-        await c.message.delete()
-        
-        titles = dict(await resolve_group_titles())
-        
-        for payment in approved_payments:
-            pid = payment['id']
-            uid = payment['user_id']
-            photo_file_id = payment['photo_file']
-            created_at = payment['created_at']
-            
-            user_row = await get_user(uid)
-            if not user_row:
-                continue
-            
-            # Telegram'dan profil nomini olish (har doim yangi)
-            username, full_name = await fetch_user_profile(uid)
-            primary_group_id = user_row[3] if len(user_row) > 3 else None
-            phone = user_row[5] if len(user_row) > 5 else "yo'q"
-            expires_at = user_row[6] if len(user_row) > 6 else None
-            
-            # Guruhlarni olish (user_groups + primary group)
-            groups_data = await db_pool.fetch(
-                "SELECT group_id FROM user_groups WHERE user_id = $1", uid
-            )
-            group_ids = set()
-            for row in groups_data:
-                group_ids.add(row['group_id'])
-            
-            # Primary group ham qo'shamiz (agar mavjud bo'lsa)
-            if primary_group_id:
-                group_ids.add(primary_group_id)
-            
-            # Kurs nomini olish
-            async with db_pool.acquire() as conn:
-                course_row = await conn.fetchrow("SELECT course_name FROM users WHERE user_id = $1", uid)
-            course_name = course_row['course_name'] if course_row and course_row.get('course_name') else "Kiritilmagan"
-            
-            group_names = [titles.get(gid, str(gid)) for gid in group_ids]
-            groups_str = ", ".join(group_names) if group_names else "yo'q"
-            expiry_date = (datetime.utcfromtimestamp(expires_at) + TZ_OFFSET).strftime("%Y-%m-%d") if expires_at else "yo'q"
-            payment_date = (datetime.utcfromtimestamp(created_at) + TZ_OFFSET).strftime("%Y-%m-%d %H:%M") if created_at else "yo'q"
-            
-            # Username bor bo'lsa username ko'rsatamiz, yo'qsa "Chat ochish" - ikkalasi ham link
-            chat_link = f"📧 [{username}](tg://user?id={uid})" if username else f"📧 [Chat ochish](tg://user?id={uid})"
-            caption = (
-                f"✅ *Tasdiqlangan to'lov*\n\n"
-                f"👤 {full_name}\n"
-                f"{chat_link}\n"
-                f"📞 Telefon: {phone}\n"
-                f"📚 Kurs: {course_name}\n"
-                f"🏫 Guruhlar: {groups_str}\n"
-                f"⏳ Obuna tugashi: {expiry_date}\n"
-                f"📅 To'lov sanasi: {payment_date}\n"
-                f"🆔 User ID: `{uid}`\n"
-                f"💳 Payment ID: `{pid}`"
-            )
-            
-            await bot.send_photo(c.from_user.id, photo_file_id, caption=caption, parse_mode="Markdown")
-    except Exception as e:
-        logger.error(f"Error in cb_approved_last3: {e}")
-        await c.message.answer("Xatolik yuz berdi")
-
-@dp.callback_query(F.data.startswith("gusers_"))
-async def cb_group_users(c: CallbackQuery):
-    """Tanlangan guruhdagi barcha o'quvchilarni ko'rsatish."""
-    await c.answer()
-    
-    try:
-        group_id = int(c.data.split("_")[1])
-        
-        # Guruh ruxsatini tekshirish
-        if not await check_group_access(c.from_user.id, group_id):
-            await c.message.answer("❌ Sizga bu guruhga ruxsat yo'q!")
-            return
-        
-        # Guruh nomini olish
-        allowed_groups = await get_allowed_groups(c.from_user.id)
-        titles = dict(await resolve_group_titles(allowed_groups))
-        group_name = titles.get(group_id, str(group_id))
-        
-        # Guruhdagi barcha o'quvchilarni olish
-        users = await all_members_of_group(group_id)
-        
-        if not users:
-            await c.message.edit_text(f"👥 <b>{group_name}</b>\n\n❌ Bu guruhda o'quvchilar yo'q.", parse_mode="HTML")
-            return
-        
-        # Telegram API orqali guruhda turganlarni tekshirish
-        real_members = []
-        for uid, username, full_name, exp, phone in users:
-            try:
-                member = await bot.get_chat_member(group_id, uid)
-                if member.status in ["member", "administrator", "creator"]:
-                    real_members.append((uid, username, full_name, exp, phone))
-            except Exception:
-                pass
-        
-        if not real_members:
-            await c.message.edit_text(f"👥 <b>{group_name}</b>\n\n❌ Bu guruhda hozirda o'quvchilar yo'q.", parse_mode="HTML")
-            return
-        
-        # O'quvchilarni saralash - obuna sanasi bo'yicha
-        users_sorted = sorted(real_members, key=lambda r: (r[3] or 0), reverse=True)
-        
-        # Xabarni shakllantirish
-        await c.message.delete()
-        
-        header = f"👥 <b>{group_name}</b>\n📊 Jami: {len(users_sorted)} ta o'quvchi\n\n"
-        await c.message.answer(header, parse_mode="HTML")
-        
-        # O'quvchilarni 20 tadan xabar yuborish
-        MAX_PER_MSG = 20
-        for i in range(0, len(users_sorted), MAX_PER_MSG):
-            batch = users_sorted[i:i+MAX_PER_MSG]
-            lines = []
-            
-            for j, (uid, username, full_name, exp, phone) in enumerate(batch, start=i+1):
-                # Profil linki
-                chat_link = f"<a href='tg://user?id={uid}'>{full_name or 'Nomsiz'}</a>"
-                
-                # Obuna sanasi
-                if exp:
-                    exp_date = (datetime.utcfromtimestamp(exp) + TZ_OFFSET).strftime("%Y-%m-%d")
-                    now = int(datetime.utcnow().timestamp())
-                    if exp > now:
-                        days_left = (datetime.utcfromtimestamp(exp) + TZ_OFFSET).date() - (datetime.utcnow() + TZ_OFFSET).date()
-                        status = f"✅ {exp_date} ({days_left.days} kun)"
-                    else:
-                        status = f"❌ {exp_date} (tugagan)"
-                else:
-                    status = "—"
-                
-                # Telefon
-                phone_str = phone if phone else "—"
-                
-                lines.append(
-                    f"{j}. {chat_link}\n"
-                    f"   🆔 ID: <code>{uid}</code>\n"
-                    f"   📞 Telefon: {phone_str}\n"
-                    f"   ⏳ Obuna: {status}\n"
-                )
-            
-            await c.message.answer("\n".join(lines), parse_mode="HTML")
-            await asyncio.sleep(0.3)  # Telegram limitidan qochish
-        
-    except Exception as e:
-        logger.error(f"Error in cb_group_users: {e}")
-        await c.message.answer(f"Xatolik yuz berdi: {e}")
+    for gid in GROUP_IDS:
+        title = titles.get(gid, str(gid))
+        buttons.append([InlineKeyboardButton(text=f"📚 {title}", callback_data=f"gusers_{gid}")])
+    
+    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
+    await m.answer("👥 <b>Guruh tanlang</b>\n\nQaysi guruhdagi o'quvchilarni ko'rmoqchisiz?", reply_markup=kb, parse_mode="HTML")
 
-@dp.callback_query(F.data == "approved_all")
-async def cb_approved_all(c: CallbackQuery):
-    """Barcha tasdiqlangan to'lovlarni ko'rsatish."""
+@dp.message(F.text == "✅ Tasdiqlangan to'lovlar")
+async def admin_approved_button(m: Message):
+    """Admin Tasdiqlangan to'lovlar tugmasi handleri."""
+    if not is_admin(m.from_user.id):
+        return
+    
+    # Tanlash tugmalarini ko'rsatish
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="📋 Oxirgi 3 tasi", callback_data="approved_last3")],
+        [InlineKeyboardButton(text="📚 Hammasi", callback_data="approved_all")]
+    ])
+    
+    await m.answer("✅ *Tasdiqlangan to'lovlar*\n\nQaysi birini ko'rmoqchisiz?", reply_markup=kb, parse_mode="Markdown")
+
+@dp.callback_query(F.data == "approved_last3")
+async def cb_approved_last3(c: CallbackQuery):
+    """Oxirgi 3 ta tasdiqlangan to'lovni ko'rsatish."""
     await c.answer()
     
     try:
         approved_payments = await db_pool.fetch(
-            "SELECT id, user_id, photo_file, admin_id, created_at FROM payments WHERE status = 'approved' ORDER BY id DESC"
+            "SELECT id, user_id, photo_file, admin_id, created_at FROM payments WHERE status = 'approved' ORDER BY id DESC LIMIT 3"
         )
         
         if not approved_payments:
@@ -4368,9 +6255,9 @@ async def cb_approved_all(c: CallbackQuery):
             
             # Telegram'dan profil nomini olish (har doim yangi)
             username, full_name = await fetch_user_profile(uid)
-            primary_group_id = user_row[3] if len(user_row) > 3 else None
-            phone = user_row[5] if len(user_row) > 5 else "yo'q"
-            expires_at = user_row[6] if len(user_row) > 6 else None
+            primary_group_id = user_row.group_id
+            phone = user_row.phone
+            expires_at = user_row.expires_at
             
             # Guruhlarni olish (user_groups + primary group)
             groups_data = await db_pool.fetch(
@@ -4411,9 +6298,63 @@ async def cb_approved_all(c: CallbackQuery):
             
             await bot.send_photo(c.from_user.id, photo_file_id, caption=caption, parse_mode="Markdown")
     except Exception as e:
-        logger.error(f"Error in cb_approved_all: {e}")
+        logger.error(f"Error in cb_approved_last3: {e}")
         await c.message.answer("Xatolik yuz berdi")
 
+@dp.callback_query(F.data.startswith("gusers_"))
+async def cb_group_users(c: CallbackQuery):
+    """Tanlangan guruhdagi barcha o'quvchilarni ko'rsatish."""
+    await c.answer()
+    
+    try:
+        group_id = int(c.data.split("_")[1])
+        
+        # Guruh ruxsatini tekshirish
+        if not await check_group_access(c.from_user.id, group_id):
+            await c.message.answer("❌ Sizga bu guruhga ruxsat yo'q!")
+            return
+        
+        # Guruh nomini olish
+        allowed_groups = await get_allowed_groups(c.from_user.id)
+        titles = dict(await resolve_group_titles(allowed_groups))
+        group_name = titles.get(group_id, str(group_id))
+        
+        # Guruhdagi barcha o'quvchilarni olish
+        users = await all_members_of_group(group_id)
+        
+        if not users:
+            await c.message.edit_text(f"👥 <b>{group_name}</b>\n\n❌ Bu guruhda o'quvchilar yo'q.", parse_mode="HTML")
+            return
+        
+        # Telegram API orqali guruhda turganlarni tekshirish
+        await c.message.edit_text(f"⏳ {group_name} tekshirilmoqda...")
+        real_members = await filter_real_members(group_id, users, c.message, group_name)
+        
+        if not real_members:
+            await c.message.edit_text(f"👥 <b>{group_name}</b>\n\n❌ Bu guruhda hozirda o'quvchilar yo'q.", parse_mode="HTML")
+            return
+        
+        # O'quvchilarni saralash - obuna sanasi bo'yicha
+        users_sorted = sorted(real_members, key=lambda r: (r[3] or 0), reverse=True)
+        
+        # Ro'yxat - bitta fayl
+        await c.message.delete()
+        
+        safe_name = group_name.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+        rows = (subscriber_export_row(group_id, group_name, uid, username, full_name, phone, exp)
+                for uid, username, full_name, exp, phone in users_sorted)
+        await send_export(c.message.chat.id, iter_list(rows), SUBSCRIBER_EXPORT_COLUMNS, f"group_{group_id}",
+                          caption=f"👥 <b>{safe_name}</b>\n📊 Jami: {len(users_sorted)} ta o'quvchi")
+        
+    except Exception as e:
+        logger.error(f"Error in cb_group_users: {e}")
+        await c.message.answer(f"Xatolik yuz berdi: {e}")
+
+@dp.callback_query(F.data == "approved_all")
+async def cb_approved_all(c: CallbackQuery):
+    """Barcha tasdiqlangan to'lovlarni ko'rsatish (sahifalab)."""
+    await show_payment_page(c, "pa")
+
 @dp.message(F.text == "⏳ Kutilayotgan to'lovlar")
 async def admin_pending_button(m: Message):
     """Admin Kutilayotgan to'lovlar tugmasi handleri."""
@@ -4443,7 +6384,7 @@ async def admin_pending_button(m: Message):
             
             # Telegram'dan profil nomini olish (har doim yangi)
             username, full_name = await fetch_user_profile(uid)
-            phone = user_row[5] if len(user_row) > 5 else "yo'q"
+            phone = user_row.phone
             
             # Kurs nomini olish
             async with db_pool.acquire() as conn:
@@ -4451,7 +6392,7 @@ async def admin_pending_button(m: Message):
             course_name = course_row['course_name'] if course_row and course_row.get('course_name') else "Kiritilmagan"
             
             # Shartnoma ma'lumotlarini olish (agar bor bo'lsa)
-            agreed_at = user_row[4] if len(user_row) > 4 else None
+            agreed_at = user_row.agreed_at
             # agreed_at ni int ga convert qilamiz (agar str bo'lsa)
             if agreed_at and isinstance(agreed_at, str):
                 try:
@@ -4500,169 +6441,13 @@ async def admin_payments_button(m: Message):
 
 @dp.callback_query(F.data == "payments_pending")
 async def cb_payments_pending(c: CallbackQuery):
-    """Kutilayotgan to'lovlarni ko'rsatish."""
-    if not await is_active_admin(c.from_user.id):
-        return await c.answer("Faqat adminlar uchun", show_alert=True)
-    
-    await c.answer()
-    
-    try:
-        # Admin'ning ruxsat etilgan guruhlarini olish
-        allowed_groups = await get_allowed_groups(c.from_user.id)
-        
-        if is_super_admin(c.from_user.id):
-            # Super admin barcha to'lovlarni ko'radi
-            pending_payments = await db_pool.fetch(
-                "SELECT id, user_id, photo_file, created_at FROM payments WHERE status = 'pending' ORDER BY id ASC"
-            )
-        else:
-            # Regular admin faqat o'z guruhlariga tegishli to'lovlarni ko'radi
-            if not allowed_groups:
-                await c.message.edit_text("❌ Sizga hech qanday guruh tayinlanmagan!")
-                return
-            
-            # User_groups jadvalidan user'lar ro'yxatini olish
-            user_ids_in_groups = await db_pool.fetch(
-                "SELECT DISTINCT user_id FROM user_groups WHERE group_id = ANY($1)", 
-                allowed_groups
-            )
-            user_ids = [row['user_id'] for row in user_ids_in_groups]
-            
-            if not user_ids:
-                await c.message.edit_text("⏳ Hozircha kutilayotgan to'lovlar yo'q.")
-                return
-            
-            pending_payments = await db_pool.fetch(
-                "SELECT id, user_id, photo_file, created_at FROM payments WHERE status = 'pending' AND user_id = ANY($1) ORDER BY id ASC",
-                user_ids
-            )
-        
-        if not pending_payments:
-            await c.message.edit_text("⏳ Hozircha kutilayotgan to'lovlar yo'q.")
-            return
-        
-        await c.message.delete()
-        
-        for payment in pending_payments:
-            pid = payment['id']
-            uid = payment['user_id']
-            photo_file_id = payment['photo_file']
-            created_at = payment['created_at']
-            
-            user_row = await get_user(uid)
-            if not user_row:
-                continue
-            
-            # Telegram'dan profil nomini olish (har doim yangi)
-            username, full_name = await fetch_user_profile(uid)
-            phone = user_row[5] if len(user_row) > 5 else "yo'q"
-            payment_date = (datetime.utcfromtimestamp(created_at) + TZ_OFFSET).strftime("%Y-%m-%d %H:%M") if created_at else "yo'q"
-            
-            # Username bor bo'lsa username ko'rsatamiz, yo'qsa "Chat ochish" - ikkalasi ham link
-            chat_link = f"📧 [{username}](tg://user?id={uid})" if username else f"📧 [Chat ochish](tg://user?id={uid})"
-            
-            kb = approve_keyboard(pid)
-            caption = (
-                f"⏳ *Kutilayotgan to'lov*\n\n"
-                f"👤 {full_name}\n"
-                f"{chat_link}\n"
-                f"📞 Telefon: {phone}\n"
-                f"🆔 User ID: `{uid}`\n"
-                f"💳 Payment ID: `{pid}`\n"
-                f"📅 Vaqt: {payment_date}"
-            )
-            
-            await bot.send_photo(c.from_user.id, photo_file_id, caption=caption, reply_markup=kb, parse_mode="Markdown")
-    except Exception as e:
-        logger.error(f"Error in cb_payments_pending: {e}")
-        await bot.send_message(c.from_user.id, f"Xatolik yuz berdi: {str(e)}")
+    """Kutilayotgan to'lovlarni ko'rsatish (sahifalab)."""
+    await show_payment_page(c, "pp")
 
 @dp.callback_query(F.data == "payments_approved")
 async def cb_payments_approved(c: CallbackQuery):
-    """Tasdiqlangan to'lovlarni ko'rsatish."""
-    if not await is_active_admin(c.from_user.id):
-        return await c.answer("Faqat adminlar uchun", show_alert=True)
-    
-    await c.answer()
-    
-    try:
-        # Admin'ning ruxsat etilgan guruhlarini olish
-        allowed_groups = await get_allowed_groups(c.from_user.id)
-        
-        if is_super_admin(c.from_user.id):
-            # Super admin barcha to'lovlarni ko'radi
-            approved_payments = await db_pool.fetch(
-                "SELECT id, user_id, photo_file, created_at FROM payments WHERE status = 'approved' ORDER BY id DESC LIMIT 10"
-            )
-        else:
-            # Regular admin faqat o'z guruhlariga tegishli to'lovlarni ko'radi
-            if not allowed_groups:
-                await c.message.edit_text("❌ Sizga hech qanday guruh tayinlanmagan!")
-                return
-            
-            # User_groups jadvalidan user'lar ro'yxatini olish
-            user_ids_in_groups = await db_pool.fetch(
-                "SELECT DISTINCT user_id FROM user_groups WHERE group_id = ANY($1)", 
-                allowed_groups
-            )
-            user_ids = [row['user_id'] for row in user_ids_in_groups]
-            
-            if not user_ids:
-                await c.message.edit_text("✅ Hozircha tasdiqlangan to'lovlar yo'q.")
-                return
-            
-            approved_payments = await db_pool.fetch(
-                "SELECT id, user_id, photo_file, created_at FROM payments WHERE status = 'approved' AND user_id = ANY($1) ORDER BY id DESC LIMIT 10",
-                user_ids
-            )
-        
-        if not approved_payments:
-            await c.message.edit_text("✅ Hozircha tasdiqlangan to'lovlar yo'q.")
-            return
-        
-        await c.message.delete()
-        
-        titles = dict(await resolve_group_titles())
-        
-        for payment in approved_payments:
-            pid = payment['id']
-            uid = payment['user_id']
-            photo_file_id = payment['photo_file']
-            created_at = payment['created_at']
-            
-            user_row = await get_user(uid)
-            if not user_row:
-                continue
-            
-            # Telegram'dan profil nomini olish (har doim yangi)
-            username, full_name = await fetch_user_profile(uid)
-            phone = user_row[5] if len(user_row) > 5 else "yo'q"
-            payment_date = (datetime.utcfromtimestamp(created_at) + TZ_OFFSET).strftime("%Y-%m-%d %H:%M") if created_at else "yo'q"
-            
-            # Guruhlarni olish
-            groups_data = await db_pool.fetch(
-                "SELECT group_id FROM user_groups WHERE user_id = $1", uid
-            )
-            group_names = [titles.get(row['group_id'], str(row['group_id'])) for row in groups_data]
-            groups_str = ", ".join(group_names) if group_names else "yo'q"
-            
-            # Username bor bo'lsa username ko'rsatamiz, yo'qsa "Chat ochish" - ikkalasi ham link
-            chat_link = f"📧 [{username}](tg://user?id={uid})" if username else f"📧 [Chat ochish](tg://user?id={uid})"
-            caption = (
-                f"✅ *Tasdiqlangan to'lov*\n\n"
-                f"👤 {full_name}\n"
-                f"{chat_link}\n"
-                f"📞 Telefon: {phone}\n"
-                f"🏫 Guruhlar: {groups_str}\n"
-                f"🆔 User ID: `{uid}`\n"
-                f"💳 Payment ID: `{pid}`\n"
-                f"📅 Vaqt: {payment_date}"
-            )
-            
-            await bot.send_photo(c.from_user.id, photo_file_id, caption=caption, parse_mode="Markdown")
-    except Exception as e:
-        logger.error(f"Error in cb_payments_approved: {e}")
-        await bot.send_message(c.from_user.id, f"Xatolik yuz berdi: {str(e)}")
+    """Tasdiqlangan to'lovlarni ko'rsatish (sahifalab)."""
+    await show_payment_page(c, "pa")
 
 @dp.message(F.text == "🧹 Tozalash")
 async def admin_cleanup_button(m: Message):
@@ -4863,7 +6648,7 @@ async def admin_edit_contract_button(m: Message):
         )
         
         # Tahrirlash rejimini yoqish
-        WAIT_CONTRACT_EDIT.add(m.from_user.id)
+        state_set(WAIT_CONTRACT_EDIT, m.from_user.id)
         
     except Exception as e:
         logger.error(f"Error in admin_edit_contract_button: {e}")
@@ -4872,7 +6657,7 @@ async def admin_edit_contract_button(m: Message):
 @dp.message(F.text)
 async def on_admin_date_handler(m: Message):
     # Sana kiritish (to'lov tasdiqlash yoki registration uchun) - OLDIN TEKSHIRILISHI KERAK!
-    if m.from_user.id in WAIT_DATE_FOR:
+    if state_has(WAIT_DATE_FOR, m.from_user.id):
         try:
             raw = (m.text or "").strip().replace("/", "-")
             if not DATE_RE.match(raw):
@@ -4882,7 +6667,8 @@ async def on_admin_date_handler(m: Message):
             except Exception:
                 return await m.answer("❗ Sana tushunilmadi. Misol: 2025-10-01")
             
-            id_value = WAIT_DATE_FOR.pop(m.from_user.id, None)
+            id_value = state_pop(WAIT_DATE_FOR, m.from_user.id)
+            await state_commit()
             if not id_value:
                 return await m.answer("Sessiya topilmadi.")
             
@@ -4891,7 +6677,7 @@ async def on_admin_date_handler(m: Message):
             
             if payment_row:
                 # payment_type ni olish
-                _pid, _uid, _status, _, payment_type = payment_row
+                payment_type = payment_row.payment_type
                 
                 # RENEWAL PAYMENT - sana tanlash kerak emas!
                 if payment_type == 'renewal':
@@ -4924,7 +6710,7 @@ async def on_admin_date_handler(m: Message):
         return
     
     # Shartnoma matnini tahrirlash (admin)
-    if m.from_user.id in WAIT_CONTRACT_EDIT:
+    if state_has(WAIT_CONTRACT_EDIT, m.from_user.id):
         try:
             new_contract_text = (m.text or "").strip()
             
@@ -4933,7 +6719,7 @@ async def on_admin_date_handler(m: Message):
             
             # Shartnoma matnini yangilash
             await update_contract_template(new_contract_text)
-            WAIT_CONTRACT_EDIT.discard(m.from_user.id)
+            state_pop(WAIT_CONTRACT_EDIT, m.from_user.id)
             
             await m.answer(
                 "✅ <b>Shartnoma matni yangilandi!</b>\n\n"
@@ -4950,7 +6736,7 @@ async def on_admin_date_handler(m: Message):
         return
     
     # To'lov ma'lumotlarini tahrirlash (admin)
-    if m.from_user.id in WAIT_PAYMENT_EDIT:
+    if state_has(WAIT_PAYMENT_EDIT, m.from_user.id):
         try:
             lines = (m.text or "").strip().split('\n')
             
@@ -4977,7 +6763,7 @@ async def on_admin_date_handler(m: Message):
             
             # To'lov ma'lumotlarini yangilash
             await update_payment_settings(bank_name, card_number, amount, additional_info, video_link, m.from_user.id)
-            WAIT_PAYMENT_EDIT.discard(m.from_user.id)
+            state_pop(WAIT_PAYMENT_EDIT, m.from_user.id)
             
             await m.answer(
                 "✅ <b>To'lov ma'lumotlari yangilandi!</b>\n\n"
@@ -4998,7 +6784,7 @@ async def on_admin_date_handler(m: Message):
         return
     
     # Ism-familiya qabul qilish (payment-first registration - guruh a'zoligi shart emas)
-    if m.from_user.id in WAIT_FULLNAME_FOR:
+    if state_has(WAIT_FULLNAME_FOR, m.from_user.id):
         try:
             fullname = (m.text or "").strip()
             if len(fullname) < 3:
@@ -5006,38 +6792,18 @@ async def on_admin_date_handler(m: Message):
             
             # Ism-familiyani saqlash
             await update_user_fullname(m.from_user.id, fullname)
-            WAIT_FULLNAME_FOR.discard(m.from_user.id)
-            WAIT_CONTRACT_CONFIRM.add(m.from_user.id)
+            state_pop(WAIT_FULLNAME_FOR, m.from_user.id)
+            state_set(WAIT_CONTRACT_CONFIRM, m.from_user.id)
+            await state_commit()
             
             # Shartnoma matnini olish va PDF yaratish
-            contract_text = await get_contract_template()
+            version, contract_text = await get_contract_template_version()
             now_str = (datetime.utcnow() + TZ_OFFSET).strftime("%Y-%m-%d")
             
-            # Shartnomaga ism va sanani qo'shish
-            stamped_contract = f"{contract_text}\n\n{'='*50}\nO'quvchi: {fullname}\nSana: {now_str}"
-            
-            # PDF yaratish
-            try:
-                from reportlab.lib.pagesizes import A4
-                from reportlab.pdfgen import canvas
-                pdf_buf = io.BytesIO()
-                pdf_buf.name = "shartnoma.pdf"
-                c = canvas.Canvas(pdf_buf, pagesize=A4)
-                width, height = A4
-                y = height - 40
-                for line in stamped_contract.splitlines():
-                    c.drawString(40, y, line[:110])
-                    y -= 14
-                    if y < 40:
-                        c.showPage()
-                        y = height - 40
-                c.save()
-                pdf_buf.seek(0)
-                
-                pdf_file = BufferedInputFile(pdf_buf.read(), filename="shartnoma.pdf")
-            except Exception as e:
-                logger.warning(f"Failed to create PDF contract: {e}")
-                pdf_file = None
+            # Shartnomaga ism va sanani qo'shish (PDF thread pool'da chiziladi)
+            stamp = f"\n{'='*50}\nO'quvchi: {fullname}\nSana: {now_str}"
+            pdf_bytes = await render_contract_pdf(version, contract_text, stamp)
+            pdf_file = BufferedInputFile(pdf_bytes, filename="shartnoma.pdf") if pdf_bytes else None
             
             # Shartnoma tasdiqlash tugmalari
             kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -5077,15 +6843,16 @@ async def on_admin_date_handler(m: Message):
             await m.answer("Xatolik yuz berdi. Iltimos, qaytadan urinib ko'ring.")
         return
     
-    if m.from_user.id in WAIT_CONTACT_FOR:
+    if state_has(WAIT_CONTACT_FOR, m.from_user.id):
         # Payment-first registration - guruh a'zoligi shart emas
         phone_pattern = re.compile(r"^\+?\d{9,15}$")
         if phone_pattern.match((m.text or "").strip()):
             try:
                 phone = m.text.strip()
                 await update_user_phone(m.from_user.id, phone)
-                WAIT_CONTACT_FOR.discard(m.from_user.id)
-                WAIT_PAYMENT_PHOTO.add(m.from_user.id)
+                state_pop(WAIT_CONTACT_FOR, m.from_user.id)
+                state_set(WAIT_PAYMENT_PHOTO, m.from_user.id)
+                await state_commit()
                 
                 # To'lov ma'lumotini database'dan olish
                 payment_settings = await get_payment_settings()
@@ -5138,14 +6905,15 @@ async def on_admin_date_handler(m: Message):
 
 @dp.message(F.contact)
 async def on_contact(m: Message):
-    if m.from_user.id not in WAIT_CONTACT_FOR:
+    if not state_has(WAIT_CONTACT_FOR, m.from_user.id):
         return
     try:
         contact = m.contact
         phone = contact.phone_number
         await update_user_phone(m.from_user.id, phone)
-        WAIT_CONTACT_FOR.discard(m.from_user.id)
-        WAIT_PAYMENT_PHOTO.add(m.from_user.id)
+        state_pop(WAIT_CONTACT_FOR, m.from_user.id)
+        state_set(WAIT_PAYMENT_PHOTO, m.from_user.id)
+        await state_commit()
         
         # To'lov ma'lumotini database'dan olish
         payment_settings = await get_payment_settings()
@@ -5200,7 +6968,7 @@ async def on_contact(m: Message):
 async def on_document(m: Message):
     """Document (fayl) qabul qilish - shartnoma matni uchun."""
     # Shartnoma matnini .txt file orqali qabul qilish
-    if m.from_user.id in WAIT_CONTRACT_EDIT:
+    if state_has(WAIT_CONTRACT_EDIT, m.from_user.id):
         try:
             document = m.document
             
@@ -5220,7 +6988,7 @@ async def on_document(m: Message):
             
             # Shartnoma matnini yangilash
             await update_contract_template(new_contract_text)
-            WAIT_CONTRACT_EDIT.discard(m.from_user.id)
+            state_pop(WAIT_CONTRACT_EDIT, m.from_user.id)
             
             await m.answer(
                 "✅ <b>Shartnoma matni yangilandi!</b>\n\n"
@@ -5256,28 +7024,20 @@ async def on_photo(m: Message):
     uid = m.from_user.id
     
     # 1. Yangilanish cheki (renewal receipt)
-    if uid in WAIT_RENEWAL_RECEIPT:
+    if state_has(WAIT_RENEWAL_RECEIPT, uid):
         try:
-            WAIT_RENEWAL_RECEIPT.discard(uid)
-            
-            # To'lovni database'ga qo'shish (renewal type)
-            pid = await add_payment(m, m.photo[-1].file_id, payment_type='renewal')
-            await m.answer(
-                "✅ <b>Yangilanish to'lovi qabul qilindi!</b>\n\n"
-                "⏳ Admin tekshiradi va tasdiqlashini kuting.\n"
-                "Tez orada xabar beramiz!",
-                parse_mode="HTML"
-            )
+            state_pop(WAIT_RENEWAL_RECEIPT, uid)
+            await state_commit()
             
             # Database'dan mavjud ma'lumotlarni olish
             user_row = await get_user(uid)
-            phone = user_row[5] if user_row and len(user_row) > 5 else "yo'q"
+            phone = user_row.phone if user_row else "yo'q"
             
             # Mavjud ma'lumotlarni saqlash (agar user mavjud bo'lsa)
-            existing_username = user_row[3] if user_row else None
-            existing_group_id = user_row[1] if user_row else None
-            existing_expires_at = user_row[2] if user_row else None
-            existing_fullname = user_row[4] if user_row else None
+            existing_username = user_row.username if user_row else None
+            existing_group_id = user_row.group_id if user_row else None
+            existing_expires_at = user_row.expires_at if user_row else None
+            existing_fullname = user_row.full_name if user_row else None
             
             # MAJBURIY: Telegram'dan user ma'lumotlarini olish (error-safe)
             try:
@@ -5291,43 +7051,51 @@ async def on_photo(m: Message):
                 username = None
                 telegram_fullname = None
             
-            # HAR DOIM ma'lumotni database'ga yangilash/yaratish
-            await upsert_user(
-                uid=uid,
-                username=username or existing_username,  # Telegram None/empty qaytarsa, mavjud username'ni saqlab qolish
-                full_name=telegram_fullname or existing_fullname or "Foydalanuvchi",  # Fallback chain
-                group_id=existing_group_id,  # Mavjud group_id
-                expires_at=existing_expires_at  # Mavjud expires_at
-            )
-            
             # Admin'ga ko'rsatish uchun final ma'lumotlar
             display_name = telegram_fullname or existing_fullname or "Noma'lum"
             # Chat link: constant label ishlatamiz (Markdown-safe)
             chat_link = f"📧 [Chat ochish](tg://user?id={uid})"
+            photo_id = m.photo[-1].file_id
             
-            kb = approve_keyboard(pid)
-            caption = (
-                f"🔄 *YANGILANISH TO'LOVI*\n\n"
-                f"👤 {display_name}\n"
-                f"{chat_link}\n"
-                f"📱 Telefon: {phone}\n"
-                f"🆔 ID: `{uid}`\n"
-                f"💳 Payment ID: `{pid}`\n"
-                f"📅 Vaqt: {(datetime.utcnow() + TZ_OFFSET).strftime('%Y-%m-%d %H:%M')}\n\n"
-                f"♻️ Bu obunani yangilash to'lovi"
-            )
-            
-            # Admin xabarlarini kuzatish
-            if pid not in ADMIN_MESSAGES:
-                ADMIN_MESSAGES[pid] = []
+            # To'lov (renewal type), user ma'lumotlari va adminlarga xabarlar - bitta tranzaksiyada
+            async with db_pool.acquire() as conn:
+                async with db_transaction(conn):
+                    pid = await add_payment(m, photo_id, payment_type='renewal', conn=conn)
+                    
+                    # HAR DOIM ma'lumotni database'ga yangilash/yaratish
+                    await upsert_user(
+                        uid=uid,
+                        username=username or existing_username,  # Telegram None/empty qaytarsa, mavjud username'ni saqlab qolish
+                        full_name=telegram_fullname or existing_fullname or "Foydalanuvchi",  # Fallback chain
+                        group_id=existing_group_id,  # Mavjud group_id
+                        expires_at=existing_expires_at,  # Mavjud expires_at
+                        conn=conn
+                    )
+                    
+                    kb = approve_keyboard(pid)
+                    caption = (
+                        f"🔄 *YANGILANISH TO'LOVI*\n\n"
+                        f"👤 {display_name}\n"
+                        f"{chat_link}\n"
+                        f"📱 Telefon: {phone}\n"
+                        f"🆔 ID: `{uid}`\n"
+                        f"💳 Payment ID: `{pid}`\n"
+                        f"📅 Vaqt: {(datetime.utcnow() + TZ_OFFSET).strftime('%Y-%m-%d %H:%M')}\n\n"
+                        f"♻️ Bu obunani yangilash to'lovi"
+                    )
+                    
+                    # Barcha adminlarga xabar (outbox orqali, ADMIN_MESSAGES dispatcher'da to'ldiriladi)
+                    for aid in ADMIN_IDS:
+                        await enqueue_notification(conn, aid, caption, photo=photo_id, parse_mode="Markdown",
+                                                   reply_markup=kb, payment_id=pid)
+            notify_outbox()
             
-            # Barcha adminlarga xabar yuborish
-            for aid in ADMIN_IDS:
-                try:
-                    msg = await bot.send_photo(aid, m.photo[-1].file_id, caption=caption, reply_markup=kb, parse_mode="Markdown")
-                    ADMIN_MESSAGES[pid].append(msg.message_id)
-                except Exception as e:
-                    logger.warning(f"Failed to send renewal payment notification to admin {aid}: {e}")
+            await m.answer(
+                "✅ <b>Yangilanish to'lovi qabul qilindi!</b>\n\n"
+                "⏳ Admin tekshiradi va tasdiqlashini kuting.\n"
+                "Tez orada xabar beramiz!",
+                parse_mode="HTML"
+            )
             
             logger.info(f"User {uid} uploaded renewal payment photo, payment ID: {pid}")
             return
@@ -5338,30 +7106,22 @@ async def on_photo(m: Message):
             return
     
     # 2. Dastlabki to'lov cheki (initial payment)
-    if uid not in WAIT_PAYMENT_PHOTO:
+    if not state_has(WAIT_PAYMENT_PHOTO, uid):
         return
     
     try:
-        WAIT_PAYMENT_PHOTO.discard(uid)
-        
-        # To'lovni database'ga qo'shish (initial type)
-        pid = await add_payment(m, m.photo[-1].file_id, payment_type='initial')
-        await m.answer(
-            "✅ <b>To'lov cheki qabul qilindi!</b>\n\n"
-            "⏳ Admin tekshiradi va tasdiqlashini kuting.\n"
-            "Tez orada xabar beramiz!",
-            parse_mode="HTML"
-        )
+        state_pop(WAIT_PAYMENT_PHOTO, uid)
+        await state_commit()
         
         # Database'dan mavjud ma'lumotlarni olish
         user_row = await get_user(m.from_user.id)
-        phone = user_row[5] if user_row and len(user_row) > 5 else "yo'q"
+        phone = user_row.phone if user_row else "yo'q"
         
         # Mavjud ma'lumotlarni saqlash (agar user mavjud bo'lsa)
-        existing_username = user_row[3] if user_row else None
-        existing_group_id = user_row[1] if user_row else None
-        existing_expires_at = user_row[2] if user_row else None
-        existing_fullname = user_row[4] if user_row else None
+        existing_username = user_row.username if user_row else None
+        existing_group_id = user_row.group_id if user_row else None
+        existing_expires_at = user_row.expires_at if user_row else None
+        existing_fullname = user_row.full_name if user_row else None
         
         # MAJBURIY: Telegram'dan user ma'lumotlarini olish (error-safe)
         try:
@@ -5375,42 +7135,50 @@ async def on_photo(m: Message):
             username = None
             telegram_fullname = None
         
-        # HAR DOIM ma'lumotni database'ga saqlash/yaratish, lekin mavjud ma'lumotlarni saqlab qolish
-        await upsert_user(
-            uid=m.from_user.id,
-            username=username or existing_username,  # Telegram None/empty qaytarsa, mavjud username'ni saqlab qolish
-            full_name=telegram_fullname or existing_fullname or "Foydalanuvchi",  # Fallback chain
-            group_id=existing_group_id,  # Mavjud group_id'ni saqlab qolish
-            expires_at=existing_expires_at  # Mavjud expires_at'ni saqlab qolish
-        )
-        
         # Admin'ga ko'rsatish uchun final ma'lumotlar
         display_name = telegram_fullname or existing_fullname or "Noma'lum"
         # Chat link: constant label ishlatamiz (Markdown-safe)
         chat_link = f"📧 [Chat ochish](tg://user?id={m.from_user.id})"
+        photo_id = m.photo[-1].file_id
         
-        kb = approve_keyboard(pid)
-        caption = (
-            f"🧾 *Yangi to'lov cheki*\n\n"
-            f"👤 {display_name}\n"
-            f"{chat_link}\n"
-            f"📱 Telefon: {phone}\n"
-            f"🆔 ID: `{m.from_user.id}`\n"
-            f"💳 Payment ID: `{pid}`\n"
-            f"📅 Vaqt: {(datetime.utcnow() + TZ_OFFSET).strftime('%Y-%m-%d %H:%M')}"
-        )
-        
-        # Admin xabarlarini kuzatish uchun
-        if pid not in ADMIN_MESSAGES:
-            ADMIN_MESSAGES[pid] = []
+        # To'lov (initial type), user ma'lumotlari va adminlarga xabarlar - bitta tranzaksiyada
+        async with db_pool.acquire() as conn:
+            async with db_transaction(conn):
+                pid = await add_payment(m, photo_id, payment_type='initial', conn=conn)
+                
+                # HAR DOIM ma'lumotni database'ga saqlash/yaratish, lekin mavjud ma'lumotlarni saqlab qolish
+                await upsert_user(
+                    uid=m.from_user.id,
+                    username=username or existing_username,  # Telegram None/empty qaytarsa, mavjud username'ni saqlab qolish
+                    full_name=telegram_fullname or existing_fullname or "Foydalanuvchi",  # Fallback chain
+                    group_id=existing_group_id,  # Mavjud group_id'ni saqlab qolish
+                    expires_at=existing_expires_at,  # Mavjud expires_at'ni saqlab qolish
+                    conn=conn
+                )
+                
+                kb = approve_keyboard(pid)
+                caption = (
+                    f"🧾 *Yangi to'lov cheki*\n\n"
+                    f"👤 {display_name}\n"
+                    f"{chat_link}\n"
+                    f"📱 Telefon: {phone}\n"
+                    f"🆔 ID: `{m.from_user.id}`\n"
+                    f"💳 Payment ID: `{pid}`\n"
+                    f"📅 Vaqt: {(datetime.utcnow() + TZ_OFFSET).strftime('%Y-%m-%d %H:%M')}"
+                )
+                
+                # Barcha adminlarga xabar (outbox orqali, ADMIN_MESSAGES dispatcher'da to'ldiriladi)
+                for aid in ADMIN_IDS:
+                    await enqueue_notification(conn, aid, caption, photo=photo_id, parse_mode="Markdown",
+                                               reply_markup=kb, payment_id=pid)
+        notify_outbox()
         
-        # Barcha adminlarga xabar yuborish
-        for aid in ADMIN_IDS:
-            try:
-                msg = await bot.send_photo(aid, m.photo[-1].file_id, caption=caption, reply_markup=kb, parse_mode="Markdown")
-                ADMIN_MESSAGES[pid].append(msg.message_id)
-            except Exception as e:
-                logger.warning(f"Failed to send payment notification to admin {aid}: {e}")
+        await m.answer(
+            "✅ <b>To'lov cheki qabul qilindi!</b>\n\n"
+            "⏳ Admin tekshiradi va tasdiqlashini kuting.\n"
+            "Tez orada xabar beramiz!",
+            parse_mode="HTML"
+        )
         
         logger.info(f"User {m.from_user.id} uploaded payment photo, payment ID: {pid}")
         
@@ -5427,42 +7195,47 @@ async def cb_approve_now(c: CallbackQuery):
         row = await get_payment(pid)
         if not row:
             return await c.answer("Payment topilmadi", show_alert=True)
-        _pid, _uid, _status, _, payment_type = row
+        _uid, _status, payment_type = row.user_id, row.status, row.payment_type
         if _status == "approved":
             return await c.answer("Bu to'lov allaqachon tasdiqlangan.", show_alert=True)
         
         # RENEWAL PAYMENT - barcha obunalarni uzaytirish, guruh tanlash KERAK EMAS
         if payment_type == 'renewal':
-            updated_groups = await approve_renewal_payment(pid, _uid, c.from_user.id)
+            titles = dict(await resolve_group_titles())
+            
+            # Uzaytirish, payment holati va user'ga xabar - bitta tranzaksiyada
+            try:
+                async with db_transaction() as conn:
+                    updated_groups = await approve_renewal_payment(pid, _uid, c.from_user.id, conn=conn)
+                    
+                    group_list = []
+                    for gid, final_exp in updated_groups or []:
+                        exp_str, _ = human_left(final_exp)
+                        group_name = titles.get(gid, f"Guruh {gid}")
+                        group_list.append(f"🏷 {group_name} - {exp_str}")
+                    
+                    if updated_groups:
+                        await enqueue_notification(
+                            conn, _uid,
+                            f"✅ <b>Obuna yangilandi!</b>\n\n"
+                            f"Admin to'lovingizni tasdiqladi va obunalaringiz uzaytirildi:\n\n" +
+                            "\n".join(group_list) +
+                            f"\n\n💰 +{SUBSCRIPTION_DAYS} kun qo'shildi!\n"
+                            f"🎓 Darslarni yaxshi o'zlashtirishingizni tilaymiz!",
+                            parse_mode="HTML",
+                            reply_markup=user_reply_keyboard()
+                        )
+            except ApprovalInProgress:
+                return await c.answer("⏳ Bu to'lov hozir tasdiqlanmoqda.", show_alert=True)
+            notify_outbox()
             
+            if updated_groups is None:
+                return await c.answer("Bu to'lov allaqachon tasdiqlangan.", show_alert=True)
             if not updated_groups:
                 return await c.answer("⚠️ User'ning hech qanday obunasi topilmadi!", show_alert=True)
             
-            # User'ga xabar yuborish
-            user_row = await get_user(_uid)
             username, full_name = await fetch_user_profile(_uid)
             
-            titles = dict(await resolve_group_titles())
-            group_list = []
-            for gid, final_exp in updated_groups:
-                exp_str, _ = human_left(final_exp)
-                group_name = titles.get(gid, f"Guruh {gid}")
-                group_list.append(f"🏷 {group_name} - {exp_str}")
-            
-            try:
-                await bot.send_message(
-                    _uid,
-                    f"✅ <b>Obuna yangilandi!</b>\n\n"
-                    f"Admin to'lovingizni tasdiqladi va obunalaringiz uzaytirildi:\n\n" +
-                    "\n".join(group_list) +
-                    f"\n\n💰 +{SUBSCRIPTION_DAYS} kun qo'shildi!\n"
-                    f"🎓 Darslarni yaxshi o'zlashtirishingizni tilaymiz!",
-                    parse_mode="HTML",
-                    reply_markup=user_reply_keyboard()
-                )
-            except Exception as e:
-                logger.warning(f"Failed to notify user {_uid}: {e}")
-            
             # Admin'ga xabar yuborish
             await c.message.answer(
                 f"✅ <b>Obuna yangilandi!</b>\n\n"
@@ -5509,18 +7282,10 @@ async def cb_admin_stats(c: CallbackQuery):
     
     now = int(datetime.utcnow().timestamp())
     
-    # Barcha guruhlardagi unique userlarni yig'amiz
-    all_users = {}
-    for gid in GROUP_IDS:
-        members = await all_members_of_group(gid)
-        for uid, username, full_name, exp, phone in members:
-            if uid not in all_users or (all_users[uid] or 0) < (exp or 0):
-                all_users[uid] = exp
-    
-    # Statistika hisoblash
-    total = len(all_users)
-    active = sum(1 for exp in all_users.values() if exp and exp > now)
-    expired = sum(1 for exp in all_users.values() if exp and 0 < exp <= now)
+    # Statistika va a'zolar - barcha guruhlar uchun bir martada
+    stats = await subscription_stats(GROUP_IDS, now)
+    members_by_group = await members_of_groups(GROUP_IDS)
+    total, active, expired = stats["total"], stats["active"], stats["expired"]
     
     header = (
         "📊 Statistika (faqat guruhdagilar)\n"
@@ -5530,26 +7295,21 @@ async def cb_admin_stats(c: CallbackQuery):
         "📚 Guruhlar kesimi:"
     )
     await c.message.answer(header)
+    progress_msg = await c.message.answer("⏳ A'zolar tekshirilmoqda...")
     
     titles = dict(await resolve_group_titles())
     for gid in GROUP_IDS:
-        users = await all_members_of_group(gid)
+        users = members_by_group.get(gid, [])
         # Faqat aktiv obunali foydalanuvchilarni qoldirish
         active_users = [(uid, username, full_name, exp, phone) 
                         for uid, username, full_name, exp, phone in users 
                         if exp and exp > now]
         
+        title = titles.get(gid, str(gid))
+        
         # Telegram API orqali guruhda turganlarni tekshirish
-        real_members = []
-        for uid, username, full_name, exp, phone in active_users:
-            try:
-                member = await bot.get_chat_member(gid, uid)
-                if member.status in ["member", "administrator", "creator"]:
-                    real_members.append((uid, username, full_name, exp, phone))
-            except Exception:
-                pass
+        real_members = await filter_real_members(gid, active_users, progress_msg, title)
         
-        title = titles.get(gid, str(gid))
         if not real_members:
             await c.message.answer(f"🏷 {title} — 0 a'zo")
             continue
@@ -5566,6 +7326,11 @@ async def cb_admin_stats(c: CallbackQuery):
         
         await c.message.answer("\n".join(lines))
     
+    try:
+        await progress_msg.delete()
+    except Exception:
+        pass
+    
     await c.answer()
 
 @dp.callback_query(F.data == "admin_payments_approved")
@@ -5601,9 +7366,9 @@ async def cb_admin_payments_approved(c: CallbackQuery):
             
             # Telegram'dan profil nomini olish (har doim yangi)
             username, full_name = await fetch_user_profile(uid)
-            group_id = user_row[3] if len(user_row) > 3 else None
-            phone = user_row[5] if len(user_row) > 5 else "yo'q"
-            expires_at = user_row[6] if len(user_row) > 6 else None
+            group_id = user_row.group_id
+            phone = user_row.phone
+            expires_at = user_row.expires_at
             
             # Kurs nomini olish
             async with db_pool.acquire() as conn:
@@ -5670,7 +7435,7 @@ async def cb_admin_payments_pending(c: CallbackQuery):
             
             # Telegram'dan profil nomini olish (har doim yangi)
             username, full_name = await fetch_user_profile(uid)
-            phone = user_row[5] if len(user_row) > 5 else "yo'q"
+            phone = user_row.phone
             
             # Kurs nomini olish
             async with db_pool.acquire() as conn:
@@ -5678,7 +7443,7 @@ async def cb_admin_payments_pending(c: CallbackQuery):
             course_name = course_row['course_name'] if course_row and course_row.get('course_name') else "Kiritilmagan"
             
             # Shartnoma ma'lumotlarini olish (agar bor bo'lsa)
-            agreed_at = user_row[4] if len(user_row) > 4 else None
+            agreed_at = user_row.agreed_at
             # agreed_at ni int ga convert qilamiz (agar str bo'lsa)
             if agreed_at and isinstance(agreed_at, str):
                 try:
@@ -5717,7 +7482,7 @@ async def cb_approve_date(c: CallbackQuery):
         row = await get_payment(pid)
         if not row:
             return await c.answer("Payment topilmadi", show_alert=True)
-        _pid, _uid, _status, _, payment_type = row
+        _uid, _status, payment_type = row.user_id, row.status, row.payment_type
         if _status == "approved":
             return await c.answer("Bu to'lov allaqachon tasdiqlangan.", show_alert=True)
         
@@ -5730,7 +7495,8 @@ async def cb_approve_date(c: CallbackQuery):
             )
         
         # INITIAL PAYMENT - sana tanlash
-        WAIT_DATE_FOR[c.from_user.id] = pid
+        state_set(WAIT_DATE_FOR, c.from_user.id, pid)
+        await state_commit()
         msg = await c.message.answer("🗓 Boshlanish sanasini kiriting: YYYY-MM-DD (masalan 2025-10-01)")
         if pid in ADMIN_MESSAGES:
             ADMIN_MESSAGES[pid].append(msg.message_id)
@@ -5782,7 +7548,8 @@ async def cb_ms_open(c: CallbackQuery):
         allowed_groups = await get_allowed_groups(c.from_user.id)
         groups = await resolve_group_titles(allowed_groups)
         
-        MULTI_PICK[c.from_user.id] = {"pid": pid, "start_iso": with_date_iso, "selected": set()}
+        state_set(MULTI_PICK, c.from_user.id, {"pid": pid, "start_iso": with_date_iso, "selected": []})
+        await state_commit()
         kb = multi_select_kb(pid, groups, set(), with_date_iso)
         msg = await c.message.answer("🧭 Bir necha guruhni tanlang (✅ belgilab, so'ng Tasdiqlash):", reply_markup=kb)
         if pid in ADMIN_MESSAGES:
@@ -5804,14 +7571,17 @@ async def cb_ms_toggle(c: CallbackQuery):
         if not await check_group_access(c.from_user.id, gid):
             return await c.answer("❌ Sizga bu guruhga ruxsat yo'q!", show_alert=True)
         
-        state = MULTI_PICK.get(c.from_user.id)
+        state = state_get(MULTI_PICK, c.from_user.id)
         if not state or state.get("pid") != pid:
             return await c.answer("Sessiya topilmadi. Qaytadan oching.", show_alert=True)
-        sel: set = state["selected"]
+        sel = set(state["selected"])
         if gid in sel:
             sel.remove(gid)
         else:
             sel.add(gid)
+        state["selected"] = sorted(sel)
+        state_set(MULTI_PICK, c.from_user.id, state)
+        await state_commit()
         
         # Faqat ruxsat etilgan guruhlarni olish
         allowed_groups = await get_allowed_groups(c.from_user.id)
@@ -5839,7 +7609,7 @@ async def cb_ms_confirm(c: CallbackQuery):
         row = await get_payment(pid)
         if not row:
             return await c.answer("Payment topilmadi", show_alert=True)
-        _pid, user_id, status, photo_file_id, payment_type = row
+        user_id, status, photo_file_id, payment_type = row.user_id, row.status, row.photo_file, row.payment_type
         if status == "approved":
             return await c.answer("Bu to'lov allaqachon tasdiqlangan.", show_alert=True)
         
@@ -5847,52 +7617,39 @@ async def cb_ms_confirm(c: CallbackQuery):
         
         # RENEWAL LOGIC: Yangilanish to'lovi uchun alohida flow
         if payment_type == 'renewal':
-            # User'ning hozirgi barcha guruhlarini olish
             user_row = await get_user(user_id)
             if not user_row:
                 return await c.answer("User topilmadi!", show_alert=True)
-            
-            current_expires_at = user_row[2]  # expires_at
-            now = int(datetime.utcnow().timestamp())
-            
-            # Yangi expires_at: hozirgi muddatdan yoki hozirgi vaqtdan +30 kun
-            # (agar erta yangilasa, kunlar saqlanadi)
-            base_time = max(current_expires_at if current_expires_at else now, now)
-            new_expires_at = base_time + (SUBSCRIPTION_DAYS * 86400)
-            
-            # Database'ni yangilash
-            await update_user_expiry(user_id, new_expires_at)
-            await set_payment_status(pid, "approved", c.from_user.id)
-            
-            # User'ning barcha guruhlaridagi muddatni uzaytirish
-            async with db_pool.acquire() as conn:
-                await conn.execute(
-                    "UPDATE user_groups SET expires_at = $1 WHERE user_id = $2",
-                    new_expires_at, user_id
-                )
-            
-            human_exp = (datetime.utcfromtimestamp(new_expires_at) + TZ_OFFSET).strftime("%Y-%m-%d")
-            
-            # User'ga xabar yuborish (linklar YO'Q - allaqachon guruhda)
+            # Barcha obunalarni uzaytirish, payment holati va user'ga xabar - bitta tranzaksiyada
             try:
-                await bot.send_message(
-                    user_id,
-                    "✅ *Yangilanish to'lovi tasdiqlandi!*\n\n"
-                    f"♻️ Obunangiz yangilandi!\n"
-                    f"⏳ Yangi tugash sanasi: *{human_exp}*\n\n"
-                    f"📚 Barcha guruhlaringizda davom eting!",
-                    parse_mode="Markdown"
-                )
-            except Exception as e:
-                logger.warning(f"Failed to send renewal approval message to user {user_id}: {e}")
+                async with db_transaction() as conn:
+                    updated_groups = await approve_renewal_payment(pid, user_id, c.from_user.id, conn=conn)
+                    if updated_groups:
+                        human_exp = (datetime.utcfromtimestamp(max(exp for _g, exp in updated_groups)) + TZ_OFFSET).strftime("%Y-%m-%d")
+                        # User'ga xabar (linklar YO'Q - allaqachon guruhda)
+                        await enqueue_notification(
+                            conn, user_id,
+                            "✅ *Yangilanish to'lovi tasdiqlandi!*\n\n"
+                            f"♻️ Obunangiz yangilandi!\n"
+                            f"⏳ Yangi tugash sanasi: *{human_exp}*\n\n"
+                            f"📚 Barcha guruhlaringizda davom eting!",
+                            parse_mode="Markdown"
+                        )
+            except ApprovalInProgress:
+                return await c.answer("⏳ Bu to'lov hozir tasdiqlanmoqda.", show_alert=True)
+            
+            if updated_groups is None:
+                return await c.answer("Bu to'lov allaqachon tasdiqlangan.", show_alert=True)
+            if not updated_groups:
+                return await c.answer("⚠️ User'ning hech qanday obunasi topilmadi!", show_alert=True)
+            notify_outbox()
             
             # Admin'ga xulosa
             try:
                 titles = dict(await resolve_group_titles())
-                user_groups = await conn.fetch("SELECT group_id FROM user_groups WHERE user_id = $1", user_id)
-                group_names = ", ".join([titles.get(r['group_id'], str(r['group_id'])) for r in user_groups])
+                group_names = ", ".join([titles.get(gid, str(gid)) for gid, _exp in updated_groups])
                 
-                phone = user_row[5] if user_row and len(user_row) > 5 else "yo'q"
+                phone = user_row.phone
                 chat_link = f"📧 [{username}](tg://user?id={user_id})" if username else f"📧 [Chat ochish](tg://user?id={user_id})"
                 
                 final_caption = (
@@ -5917,7 +7674,8 @@ async def cb_ms_confirm(c: CallbackQuery):
                         pass
                 del ADMIN_MESSAGES[pid]
             
-            MULTI_PICK.pop(c.from_user.id, None)
+            state_pop(MULTI_PICK, c.from_user.id)
+            await state_commit()
             logger.info(f"Renewal payment {pid} approved for user {user_id}, new expiry: {human_exp}")
             return await c.answer("✅ Yangilanish tasdiqlandi!")
         
@@ -5929,10 +7687,10 @@ async def cb_ms_confirm(c: CallbackQuery):
             except Exception:
                 pass
         expires_at = int((start_dt + timedelta(days=SUBSCRIPTION_DAYS)).timestamp())
-        state = MULTI_PICK.get(c.from_user.id)
+        state = state_get(MULTI_PICK, c.from_user.id)
         if not state or state.get("pid") != pid:
             return await c.answer("Sessiya topilmadi.", show_alert=True)
-        selected: set[int] = set(state.get("selected", set()))
+        selected: set[int] = set(state.get("selected", []))
         if not selected:
             return await c.answer("Hech bo'lmaganda bitta guruhni tanlang.", show_alert=True)
         
@@ -5943,39 +7701,36 @@ async def cb_ms_confirm(c: CallbackQuery):
                 return await c.answer(f"❌ Sizga guruh {gid}ga ruxsat yo'q!", show_alert=True)
         
         primary_gid = list(selected)[0]
-        await upsert_user(uid=user_id, username=username, full_name=full_name, group_id=primary_gid, expires_at=expires_at)
-        await set_payment_status(pid, "approved", c.from_user.id)
         extra_gids = [g for g in selected if g != primary_gid]
-        for g in extra_gids:
-            await add_user_group(user_id, g, expires_at)
-        links_out = []
         titles = dict(await resolve_group_titles())
-        try:
-            link = await send_one_time_link(primary_gid, user_id)
-            links_out.append(f"• {titles.get(primary_gid, primary_gid)}: {link}")
-        except Exception as e:
-            links_out.append(f"• {titles.get(primary_gid, primary_gid)}: link yaratishda xato ({e})")
-        for g in extra_gids:
-            try:
-                link = await send_one_time_link(g, user_id)
-                links_out.append(f"• {titles.get(g, g)}: {link}")
-            except Exception as e:
-                links_out.append(f"• {titles.get(g, g)}: link yaratishda xato ({e})")
         human_exp = (datetime.utcfromtimestamp(expires_at) + TZ_OFFSET).strftime("%Y-%m-%d")
         
-        # User'ga linklar yuborish
-        try:
-            await bot.send_message(
-                user_id,
+        async def make_notify() -> str:
+            # Linklar faqat payment bloklangandan keyin yaratiladi (ikki admin bossa ham bir marta)
+            links_out = []
+            for g in [primary_gid] + extra_gids:
+                try:
+                    link = await send_one_time_link(g, user_id)
+                    links_out.append(f"• {titles.get(g, g)}: {link}")
+                except Exception as e:
+                    links_out.append(f"• {titles.get(g, g)}: link yaratishda xato ({e})")
+            return (
                 "✅ *To'lovingiz tasdiqlandi!*\n\n"
                 f"📚 Quyidagi guruhlarga kirish havolalari (har biri *1 martalik* bo'lib, boshqalarga ulashmang):\n\n"
                 + "\n".join(links_out) +
                 f"\n\n💡 *Eslatma:* Bu guruhga kirish linki bo'lib, guruhga kirgach siz doimiy *OBUNA REJANGIZGA* ko'ra foydalanasiz.\n\n"
-                f"⏳ Obuna tugash sanasi: *{human_exp}*",
-                parse_mode="Markdown"
+                f"⏳ Obuna tugash sanasi: *{human_exp}*"
             )
-        except Exception as e:
-            logger.warning(f"Failed to send approval message to user {user_id}: {e}")
+        
+        # Obuna, to'lov holati va user'ga linklar - bitta tranzaksiyada
+        try:
+            approved = await approve_initial_payment(
+                pid, c.from_user.id, user_id, username, full_name, [primary_gid] + extra_gids, expires_at, make_notify
+            )
+        except ApprovalInProgress:
+            return await c.answer("⏳ Bu to'lov hozir tasdiqlanmoqda.", show_alert=True)
+        if not approved:
+            return await c.answer("Bu to'lov allaqachon tasdiqlangan.", show_alert=True)
         
         # Barcha admin xabarlarni o'chirish
         if pid in ADMIN_MESSAGES:
@@ -5990,7 +7745,7 @@ async def cb_ms_confirm(c: CallbackQuery):
         try:
             group_names = ", ".join([titles.get(g, str(g)) for g in selected])
             user_row = await get_user(user_id)
-            phone = user_row[5] if user_row and len(user_row) > 5 else "yo'q"
+            phone = user_row.phone if user_row else "yo'q"
             # Username bor bo'lsa username ko'rsatamiz, yo'qsa "Chat ochish" - ikkalasi ham link
             chat_link = f"📧 [{username}](tg://user?id={user_id})" if username else f"📧 [Chat ochish](tg://user?id={user_id})"
             
@@ -6022,7 +7777,8 @@ async def cb_ms_confirm(c: CallbackQuery):
         except Exception as e:
             logger.warning(f"Failed to send final summary: {e}")
         
-        MULTI_PICK.pop(c.from_user.id, None)
+        state_pop(MULTI_PICK, c.from_user.id)
+        await state_commit()
         await c.answer("✅ Havolalar yuborildi, barcha xabarlar tozalandi")
     except Exception as e:
         logger.error(f"Error in cb_ms_confirm: {e}")
@@ -6047,7 +7803,7 @@ async def cb_pick_group(c: CallbackQuery):
         row = await get_payment(pid)
         if not row:
             return await c.answer("Payment topilmadi", show_alert=True)
-        _pid, user_id, status, photo_file_id, _ = row  # payment_type ignored
+        user_id, status, photo_file_id = row.user_id, row.status, row.photo_file
         if status == "approved":
             return await c.answer("Bu to'lov allaqachon tasdiqlangan.", show_alert=True)
         start_dt = datetime.utcnow()
@@ -6058,34 +7814,36 @@ async def cb_pick_group(c: CallbackQuery):
                 pass
         expires_at = int((start_dt + timedelta(days=SUBSCRIPTION_DAYS)).timestamp())
         username, full_name = await fetch_user_profile(user_id)
-        await upsert_user(uid=user_id, username=username, full_name=full_name, group_id=gid, expires_at=expires_at)
-        await set_payment_status(pid, "approved", c.from_user.id)
         
         # Guruh nomini olish
         titles = dict(await resolve_group_titles())
         group_name = titles.get(gid, str(gid))
         
-        try:
-            link = await send_one_time_link(gid, user_id)
-        except Exception as e:
-            await c.message.answer(f"Link yaratishda xato: {e}")
-            return await c.answer()
-        
         human_exp = (datetime.utcfromtimestamp(expires_at) + TZ_OFFSET).strftime("%Y-%m-%d")
         
-        # User'ga link yuborish
-        try:
-            await bot.send_message(
-                user_id,
+        async def make_notify() -> str:
+            # Link faqat payment bloklangandan keyin yaratiladi; xato bo'lsa tasdiqlash bekor qilinadi
+            link = await send_one_time_link(gid, user_id)
+            return (
                 "✅ *To'lovingiz tasdiqlandi!*\n\n"
                 f"📚 Guruhga kirish havolasi (*1 martalik* bo'lib, boshqalarga ulashmang):\n\n"
                 f"• {group_name}: {link}\n\n"
                 f"💡 *Eslatma:* Bu guruhga kirish linki bo'lib, guruhga kirgach siz doimiy *OBUNA REJANGIZGA* ko'ra foydalanasiz.\n\n"
-                f"⏳ Obuna tugash sanasi: *{human_exp}*",
-                parse_mode="Markdown"
+                f"⏳ Obuna tugash sanasi: *{human_exp}*"
             )
-        except Exception as e:
-            logger.warning(f"Failed to send approval message to user {user_id}: {e}")
+        
+        # Obuna, to'lov holati va user'ga link - bitta tranzaksiyada
+        try:
+            approved = await approve_initial_payment(
+                pid, c.from_user.id, user_id, username, full_name, [gid], expires_at, make_notify
+            )
+        except ApprovalInProgress:
+            return await c.answer("⏳ Bu to'lov hozir tasdiqlanmoqda.", show_alert=True)
+        except TelegramBadRequest as e:
+            await c.message.answer(f"Link yaratishda xato: {e}")
+            return await c.answer()
+        if not approved:
+            return await c.answer("Bu to'lov allaqachon tasdiqlangan.", show_alert=True)
         
         # Barcha admin xabarlarni o'chirish
         if pid in ADMIN_MESSAGES:
@@ -6099,7 +7857,7 @@ async def cb_pick_group(c: CallbackQuery):
         # Yakuniy xulosa yuborish (chek rasmi bilan)
         try:
             user_row = await get_user(user_id)
-            phone = user_row[5] if user_row and len(user_row) > 5 else "yo'q"
+            phone = user_row.phone if user_row else "yo'q"
             # Username bor bo'lsa username ko'rsatamiz, yo'qsa "Chat ochish" - ikkalasi ham link
             chat_link = f"📧 [{username}](tg://user?id={user_id})" if username else f"📧 [Chat ochish](tg://user?id={user_id})"
             
@@ -6332,6 +8090,7 @@ async def cb_unauthorized_join_remove(c: CallbackQuery):
         try:
             await bot.ban_chat_member(chat_id, user_id)
             await bot.unban_chat_member(chat_id, user_id)
+            invalidate_member_status(chat_id, user_id)
             
             logger.info(f"Admin {c.from_user.id} removed unauthorized user {user_id} from group {chat_id}")
             
@@ -6397,10 +8156,10 @@ async def cb_reject(c: CallbackQuery):
         pid = int(c.data.split(":")[1])
         row = await get_payment(pid)
         if row:
-            _pid, user_id, _status, _, _ = row  # payment_type ignored
+            user_id = row.user_id
             user_row = await get_user(user_id)
             username, full_name = await fetch_user_profile(user_id)
-            phone = user_row[5] if user_row and len(user_row) > 5 else "yo'q"
+            phone = user_row.phone if user_row else "yo'q"
             
             await set_payment_status(pid, "rejected", c.from_user.id)
             
@@ -6584,6 +8343,9 @@ async def cb_group_delete_confirm(c: CallbackQuery):
         # GROUP_IDS global cache'ni yangilash
         global GROUP_IDS
         GROUP_IDS = new_group_ids
+        invalidate_admin_cache()  # managed_groups o'zgardi
+        dashboard_invalidate()
+        forget_group_title(gid)
         logger.info(f"GROUP_IDS refreshed after deletion: {GROUP_IDS}")
         
         await c.message.edit_text(
@@ -6674,6 +8436,9 @@ async def cb_missing_delete(c: CallbackQuery):
         # Global cache yangilash
         global GROUP_IDS
         GROUP_IDS = new_group_ids
+        invalidate_admin_cache()  # managed_groups o'zgardi
+        dashboard_invalidate()
+        forget_group_title(gid)
         logger.info(f"GROUP_IDS refreshed after missing group deletion: {GROUP_IDS}")
         
         await c.message.edit_text(
@@ -6743,41 +8508,141 @@ async def handle_missing_chat(group_id: int, reason: str = "chat not found"):
     except Exception as e:
         logger.error(f"Error in handle_missing_chat for group {group_id}: {e}")
 
-async def _warn_and_buttons(uid: int, gid: int, exp_at: int, reason: str):
+# ==================== RATE-LIMITED FAN-OUT ====================
+# Eslatmalar parallel yuboriladi; Telegram limitlari (global ~30 msg/s, har bir chat
+# uchun 1 msg/s) TELEGRAM RATE LIMITER middleware'ida ta'minlanadi.
+
+WARN_WORKERS = int(os.getenv("WARN_WORKERS", "8"))
+
+async def run_bounded(items: list, handler, concurrency: int = WARN_WORKERS) -> list:
+    """Elementlarni cheklangan worker pool bilan parallel ishlash.
+    
+    Returns:
+        handler natijalari (items tartibida, xatolik bo'lsa None)
+    """
+    results = [None] * len(items)
+    queue: asyncio.Queue = asyncio.Queue()
+    for idx, item in enumerate(items):
+        queue.put_nowait((idx, item))
+    
+    async def worker():
+        while True:
+            try:
+                idx, item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                results[idx] = await handler(item)
+            except Exception:
+                logger.exception(f"Worker failed on item {item}")
+    
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(items)))))
+    return results
+
+async def _warning_admin_ids(gid: int) -> list[int]:
+    """Guruhga access bo'lgan faol adminlar (database super_admin'lar + guruh adminlari)."""
+    return await group_admin_ids(gid, include_env_admins=False)
+
+async def fan_out_warnings(items: list[tuple[int, int, int, str]]) -> int:
+    """Eslatmalar partiyasini parallel yuborish.
+    
+    Avval o'quvchilarga eslatmalar yuboriladi, keyin adminlarga xabarlar -
+    admin chatidagi 1 msg/s limit o'quvchilar eslatmasini kechiktirmasligi uchun.
+    
+    Args:
+        items: (uid, gid, exp_at, reason) ro'yxati
+    
+    Returns:
+        Vaqtinchalik xatolik tufayli ishlanmagan (qayta urinish kerak) qatorlar soni
+    """
+    # users va user_groups'dan bir xil (uid, gid, reason) kelishi mumkin
+    unique = list({(uid, gid, reason): (uid, gid, exp_at, reason) for uid, gid, exp_at, reason in items}.values())
+    if not unique:
+        return 0
+    
+    admin_outbox: list[tuple[int, str, InlineKeyboardMarkup]] = []
+    results = await run_bounded(
+        unique,
+        lambda item: _warn_and_buttons(*item[:3], reason=item[3], admin_outbox=admin_outbox)
+    )
+    
+    # Adminlarga xabarlar (har bir guruh uchun adminlar ro'yxati bir marta olinadi)
+    admins_by_group: dict[int, list[int]] = {}
+    for gid in {gid for gid, _msg, _kb in admin_outbox}:
+        try:
+            admins_by_group[gid] = await _warning_admin_ids(gid)
+        except Exception as e:
+            logger.warning(f"Failed to load admins for group {gid}: {e}")
+            admins_by_group[gid] = []
+    
+    sends = [(aid, msg, kb) for gid, msg, kb in admin_outbox for aid in admins_by_group[gid]]
+    
+    async def send_admin(item):
+        aid, msg, kb = item
+        try:
+            await bot.send_message(aid, msg, reply_markup=kb, parse_mode="Markdown")
+        except Exception as e:
+            logger.warning(f"Failed to send warning to admin {aid}: {e}")
+    
+    await run_bounded(sends, send_admin)
+    failed = sum(1 for handled in results if not handled)
+    logger.info(f"Expiry warnings processed: {len(unique)} rows ({failed} to retry), {len(sends)} admin messages")
+    return failed
+
+async def mark_warning_handled(uid: int, gid: int, now: Optional[int] = None):
+    """Qator ishlanganini belgilash - keyingi tekshiruv 24 soatdan keyin.
+    
+    Qator bo'lmasa UPDATE hech narsa qilmaydi - oldindan tekshirish shart emas.
+    """
+    now = now or int(datetime.utcnow().timestamp())
+    async with db_pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE users SET last_warning_sent_at = $1 WHERE user_id = $2 AND group_id = $3",
+            now, uid, gid
+        )
+        await conn.execute(
+            "UPDATE user_groups SET last_warning_sent_at = $1 WHERE user_id = $2 AND group_id = $3",
+            now, uid, gid
+        )
+
+async def _warn_and_buttons(uid: int, gid: int, exp_at: int, reason: str, admin_outbox: Optional[list] = None) -> bool:
+    """Bitta qator uchun eslatma. Returns: qator ishlandi (False - vaqtinchalik xatolik, qayta urinish)."""
     now_ts = int(datetime.utcnow().timestamp())
     key = (uid, gid or 0, reason)
     last = _WARNED_CACHE.get(key, 0)
     if now_ts - last < 3600:
-        return
+        return True
     
     # 1. User guruhda hozir borligini tekshirish
     try:
-        member = await bot.get_chat_member(gid, uid)
-        if member.status not in ("member", "administrator", "creator"):
-            # User guruhda emas - eslatma yubormaymiz
-            logger.info(f"User {uid} is not in group {gid} (status: {member.status}), skipping warning")
-            return
+        status = await get_member_status(gid, uid)
+        if status not in ACTIVE_MEMBER_STATUSES:
+            # User guruhda emas - eslatma yubormaymiz, lekin qatorni ishlangan deb belgilaymiz
+            logger.info(f"User {uid} is not in group {gid} (status: {status}), skipping warning")
+            await mark_warning_handled(uid, gid, now_ts)
+            return True
         
         # 2. User admin yoki creator bo'lsa, eslatma yubormaymiz
-        if member.status in ("administrator", "creator"):
+        if status in ("administrator", "creator"):
             logger.info(f"User {uid} is admin/creator in group {gid}, skipping warning")
-            return
+            await mark_warning_handled(uid, gid, now_ts)
+            return True
     except Exception as e:
         error_msg = str(e)
         # Agar guruh topilmasa, database'dan avtomatik o'chirish
         if "chat not found" in error_msg.lower() or "chat_not_found" in error_msg.lower():
             await handle_missing_chat(gid, error_msg)
-            return
+            return True
         # Boshqa xatoliklar uchun - eslatma yubormaymiz
         logger.warning(f"Failed to check membership for user {uid} in group {gid}: {e}")
-        return
+        return False
     
     _WARNED_CACHE[key] = now_ts
     row = await get_user(uid)
     _username = ""
     _full = str(uid)
     if row:
-        _uid, _gid, _exp, _username, _full, _phone, _ag = row
+        _username, _full = row.username, row.full_name
     exp_str, left = human_left(exp_at)
     if reason == "soon":
         user_text = (
@@ -6800,56 +8665,33 @@ async def _warn_and_buttons(uid: int, gid: int, exp_at: int, reason: str):
     
     try:
         await bot.send_message(uid, user_text, reply_markup=renewal_kb)
-        
-        # WARNING YUBORILGANINI DATABASE'GA YOZISH - kuniga 1 marta uchun
-        now = int(datetime.utcnow().timestamp())
-        async with db_pool.acquire() as conn:
-            # users jadvalida bor-yo'qligini tekshirish
-            user_in_users = await conn.fetchval(
-                "SELECT 1 FROM users WHERE user_id = $1 AND group_id = $2", uid, gid
-            )
-            if user_in_users:
-                await conn.execute(
-                    "UPDATE users SET last_warning_sent_at = $1 WHERE user_id = $2 AND group_id = $3",
-                    now, uid, gid
-                )
-            
-            # user_groups jadvalida bor-yo'qligini tekshirish
-            user_in_user_groups = await conn.fetchval(
-                "SELECT 1 FROM user_groups WHERE user_id = $1 AND group_id = $2", uid, gid
-            )
-            if user_in_user_groups:
-                await conn.execute(
-                    "UPDATE user_groups SET last_warning_sent_at = $1 WHERE user_id = $2 AND group_id = $3",
-                    now, uid, gid
-                )
-        
-        logger.info(f"Warning sent to user {uid} for group {gid} - timestamp saved")
+        logger.info(f"Warning sent to user {uid} for group {gid}")
     except Exception as e:
         logger.warning(f"Failed to send warning to user {uid}: {e}")
+    
+    # WARNING ISHLANGANINI DATABASE'GA YOZISH - kuniga 1 marta uchun
+    # (user botni bloklagan bo'lsa ham - adminlar baribir xabar oladi)
+    await mark_warning_handled(uid, gid)
+    
     tag = f"@{_username}" if _username else _full
-    titles = dict(await resolve_group_titles())
+    titles = dict(await resolve_group_titles([gid]))
     gtitle = titles.get(gid, str(gid))
     admin_title = "⏰ *Obuna yaqin orada tugaydi*" if reason == "soon" else "⚠️ *Obuna muddati tugagan a'zo*"
     msg = (f"{admin_title}\n" f"• Foydalanuvchi: {tag}\n" f"• ID: `{uid}`\n" f"• Guruh: {gtitle} (`{gid}`)\n" f"• Tugash: {exp_str}\n\n" "Amalni tanlang:")
     kb = warn_keyboard(uid, gid)
     
     # 3. Faqat bu guruhga access bo'lgan adminlarga yuborish
-    async with db_pool.acquire() as conn:
-        admin_list = await conn.fetch("""
-            SELECT DISTINCT a.user_id 
-            FROM admins a
-            LEFT JOIN admin_groups ag ON a.user_id = ag.admin_id
-            WHERE a.active = TRUE
-              AND (a.role = 'super_admin' OR ag.group_id = $1)
-        """, gid)
-        
-        for admin_row in admin_list:
-            aid = admin_row['user_id']
-            try:
-                await bot.send_message(aid, msg, reply_markup=kb, parse_mode="Markdown")
-            except Exception as e:
-                logger.warning(f"Failed to send warning to admin {aid}: {e}")
+    if admin_outbox is not None:
+        # fan_out_warnings() o'quvchilarga yuborib bo'lgach adminlarga yuboradi
+        admin_outbox.append((gid, msg, kb))
+        return True
+    
+    for aid in await _warning_admin_ids(gid):
+        try:
+            await bot.send_message(aid, msg, reply_markup=kb, parse_mode="Markdown")
+        except Exception as e:
+            logger.warning(f"Failed to send warning to admin {aid}: {e}")
+    return True
 
 async def send_expiry_warnings():
     """2 kun ichida muddati tugaydigan adminlarga eslatma yuborish"""
@@ -6972,47 +8814,428 @@ async def check_expired_admins():
     except Exception as e:
         logger.error(f"Error in check_expired_admins: {e}")
 
-async def auto_kick_loop():
-    await asyncio.sleep(5)
+# ==================== NOTIFICATION OUTBOX ====================
+# Handlerlar xabarlarni to'g'ridan yubormaydi: to'lov/obuna o'zgarishi bilan bitta
+# tranzaksiyada notification_outbox jadvaliga yoziladi, dispatcher esa fonda yuboradi
+# (partiyalab, qayta urinish bilan, har bir chat uchun yozilgan tartibda).
+# Restart bo'lsa ham yuborilmagan xabarlar yo'qolmaydi.
+
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "100"))
+OUTBOX_POLL_INTERVAL = int(os.getenv("OUTBOX_POLL_INTERVAL", "5"))  # soniya
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_LEASE_SECONDS = 120  # olingan qator shu vaqt ichida boshqa dispatcher'ga berilmaydi
+OUTBOX_KEEP_DAYS = 7  # yuborilgan qatorlar shuncha kundan keyin o'chiriladi
+
+_OUTBOX_WAKE = asyncio.Event()
+
+# Navbatdagi qatorlarni olish. Chatdagi eski qator hali kutayotgan (retry/lease) bo'lsa,
+# keyingilari olinmaydi - shu tariqa bitta chatga xabarlar tartibi saqlanadi.
+OUTBOX_CLAIM_SQL = """
+UPDATE notification_outbox SET locked_until = $2
+WHERE id IN (
+    SELECT o.id FROM notification_outbox o
+    WHERE o.status = 'pending'
+      AND o.next_attempt_at <= $1
+      AND COALESCE(o.locked_until, 0) < $1
+      AND NOT EXISTS (
+          SELECT 1 FROM notification_outbox p
+          WHERE p.chat_id = o.chat_id AND p.status = 'pending' AND p.id < o.id
+            AND (p.next_attempt_at > $1 OR COALESCE(p.locked_until, 0) >= $1)
+      )
+    ORDER BY o.id
+    LIMIT $3
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING id, chat_id, kind, payload, payment_id, attempts
+"""
+
+async def enqueue_notification(conn, chat_id: int, text: str, *, photo: Optional[str] = None,
+                               parse_mode: Optional[str] = None,
+                               reply_markup: Optional[InlineKeyboardMarkup | ReplyKeyboardMarkup] = None,
+                               payment_id: Optional[int] = None):
+    """Xabarni outbox'ga yozish (chaqiruvchining tranzaksiyasi ichida).
+    
+    Args:
+        conn: ochiq connection (odatda conn.transaction() ichida)
+        text: xabar matni (photo bo'lsa caption)
+        payment_id: berilsa, yuborilgan xabar ADMIN_MESSAGES[payment_id] ga qo'shiladi
+    """
+    payload = {
+        "text": text,
+        "photo": photo,
+        "parse_mode": parse_mode,
+        "reply_markup": reply_markup.model_dump(exclude_none=True) if reply_markup else None,
+        "reply_markup_type": type(reply_markup).__name__ if reply_markup else None,
+    }
+    now = int(datetime.utcnow().timestamp())
+    await conn.execute("""
+        INSERT INTO notification_outbox(chat_id, kind, payload, payment_id, next_attempt_at, created_at)
+        VALUES($1, $2, $3, $4, $5, $5)
+    """, chat_id, "photo" if photo else "message", json.dumps(payload), payment_id, now)
+
+async def enqueue_notifications(conn, chat_ids: list[int], text: str, *, parse_mode: Optional[str] = None):
+    """Bir xil matnni ko'p chatga outbox orqali yuborish (bitta executemany)."""
+    payload = json.dumps({"text": text, "photo": None, "parse_mode": parse_mode, "reply_markup": None})
+    now = int(datetime.utcnow().timestamp())
+    await conn.executemany("""
+        INSERT INTO notification_outbox(chat_id, kind, payload, next_attempt_at, created_at)
+        VALUES($1, 'message', $2, $3, $3)
+    """, [(chat_id, payload, now) for chat_id in chat_ids])
+
+def notify_outbox():
+    """Commit'dan keyin dispatcher'ni darhol uyg'otish."""
+    _OUTBOX_WAKE.set()
+
+async def _deliver_notification(row) -> Optional[Message]:
+    payload = json.loads(row['payload'])
+    kwargs = {"parse_mode": payload.get("parse_mode")}
+    if payload.get("reply_markup"):
+        markup_cls = ReplyKeyboardMarkup if payload.get("reply_markup_type") == "ReplyKeyboardMarkup" else InlineKeyboardMarkup
+        kwargs["reply_markup"] = markup_cls.model_validate(payload["reply_markup"])
+    if row['kind'] == "photo":
+        return await bot.send_photo(row['chat_id'], payload["photo"], caption=payload.get("text"), **kwargs)
+    return await bot.send_message(row['chat_id'], payload["text"], **kwargs)
+
+async def dispatch_outbox_batch() -> int:
+    """Bitta partiyani yuborish.
+    
+    Returns:
+        Olingan qatorlar soni (0 bo'lsa navbat bo'sh)
+    """
+    now = int(datetime.utcnow().timestamp())
+    async with db_pool.acquire() as conn:
+        rows = await conn.fetch(OUTBOX_CLAIM_SQL, now, now + OUTBOX_LEASE_SECONDS, OUTBOX_BATCH)
+    if not rows:
+        return 0
+    
+    # Chat bo'yicha guruhlash: chat ichida ketma-ket, chatlar orasida parallel
+    by_chat: dict[int, list] = {}
+    for row in sorted(rows, key=lambda r: r['id']):
+        by_chat.setdefault(row['chat_id'], []).append(row)
+    
+    sent: list[tuple[int, int]] = []
+    failed: list[tuple[int, int, str, str]] = []
+    released: list[int] = []
+    
+    async def deliver_chat(chat_rows: list):
+        for idx, row in enumerate(chat_rows):
+            attempts = row['attempts'] + 1
+            try:
+                msg = await _deliver_notification(row)
+            except TelegramRetryAfter as e:
+                failed.append((row['id'], int(time.time()) + int(e.retry_after) + 1, "pending", str(e)))
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Bot bloklangan / chat yo'q / noto'g'ri xabar - qayta urinish foydasiz
+                logger.warning(f"Outbox notification {row['id']} to chat {row['chat_id']} dropped: {e}")
+                failed.append((row['id'], now, "failed", str(e)))
+                continue
+            except Exception as e:
+                status = "failed" if attempts >= OUTBOX_MAX_ATTEMPTS else "pending"
+                retry_at = int(time.time()) + min(3600, 5 * 2 ** attempts)
+                logger.warning(f"Outbox notification {row['id']} to chat {row['chat_id']} failed (attempt {attempts}): {e}")
+                failed.append((row['id'], retry_at, status, str(e)))
+            else:
+                sent.append((row['id'], int(time.time())))
+                if row['payment_id'] is not None and msg is not None:
+                    ADMIN_MESSAGES.setdefault(row['payment_id'], []).append(msg.message_id)
+                continue
+            # Vaqtinchalik xato: shu chatdagi keyingi xabarlar tartib buzilmasligi uchun kutadi
+            released.extend(r['id'] for r in chat_rows[idx + 1:])
+            return
+    
+    await run_bounded(list(by_chat.values()), deliver_chat)
+    
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            if sent:
+                await conn.executemany(
+                    "UPDATE notification_outbox SET status='sent', sent_at=$2, attempts=attempts+1, locked_until=NULL WHERE id=$1",
+                    sent
+                )
+            if failed:
+                await conn.executemany("""
+                    UPDATE notification_outbox
+                    SET status=$3, next_attempt_at=$2, last_error=$4, attempts=attempts+1, locked_until=NULL
+                    WHERE id=$1
+                """, failed)
+            if released:
+                await conn.execute(
+                    "UPDATE notification_outbox SET locked_until=NULL WHERE id = ANY($1::bigint[])",
+                    released
+                )
+    return len(rows)
+
+async def outbox_dispatcher_loop():
+    """Outbox'ni fonda yuborish: yangi yozuvda darhol, aks holda OUTBOX_POLL_INTERVAL da bir."""
+    last_cleanup = 0.0
     while True:
         try:
-            # Admin muddati tugashini tekshirish
-            try:
-                await check_expired_admins()
-            except Exception:
-                logger.exception("check_expired_admins failed")
-            
-            # Admin muddati tugashidan 2 kun oldin eslatma
-            try:
-                await send_expiry_warnings()
-            except Exception:
-                logger.exception("send_expiry_warnings failed")
-            
-            # O'quvchilar uchun eskisi
-            try:
-                for uid, gid, exp_at in await soon_expiring_users(REMIND_DAYS):
-                    await _warn_and_buttons(uid, gid, exp_at, reason="soon")
-            except Exception:
-                logger.exception("soon_expiring_users failed")
+            await asyncio.wait_for(_OUTBOX_WAKE.wait(), timeout=OUTBOX_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _OUTBOX_WAKE.clear()
+        
+        try:
+            while await dispatch_outbox_batch() >= OUTBOX_BATCH:
+                pass
+        except Exception as e:
+            logger.error(f"Outbox dispatcher error: {e}")
+        
+        if time.time() - last_cleanup >= 3600:
+            last_cleanup = time.time()
             try:
-                for uid, gid, exp_at in await soon_expiring_user_groups(REMIND_DAYS):
-                    await _warn_and_buttons(uid, gid, exp_at, reason="soon")
-            except Exception:
-                logger.exception("soon_expiring_user_groups failed")
+                async with db_pool.acquire() as conn:
+                    await conn.execute(
+                        "DELETE FROM notification_outbox WHERE status <> 'pending' AND created_at < $1",
+                        int(time.time()) - OUTBOX_KEEP_DAYS * 86400
+                    )
+            except Exception as e:
+                logger.warning(f"Failed to clean up notification outbox: {e}")
+
+# ==================== EXPIRY SCHEDULER ====================
+# auto_kick_loop endi har 60 soniyada polling qilmaydi: users / user_groups / admins
+# jadvallaridagi keyingi muddatlar heap'ga yuklanadi va loop aynan eng yaqin
+# muddatgacha uxlaydi. Approve / renew / join handlerlari rearm_expiry() orqali
+# yangi muddatni heap'ga qo'shib, loop'ni uyg'otadi. Qayta eslatmalar (24 soatdan keyin)
+# va xatolik bo'lgan qatorlar EXPIRY_MAX_SLEEP oralig'idagi to'liq tekshiruvda ishlanadi.
+
+EXPIRY_PRELOAD = int(os.getenv("EXPIRY_PRELOAD", "500"))  # har bir jadval/oraliq uchun yuklanadigan qatorlar
+EXPIRY_MIN_INTERVAL = int(os.getenv("EXPIRY_MIN_INTERVAL", "30"))  # ikki tekshiruv orasidagi minimal vaqt (soniya)
+EXPIRY_MAX_SLEEP = int(os.getenv("EXPIRY_MAX_SLEEP", str(6 * 3600)))  # xavfsizlik uchun to'liq tekshiruv oralig'i
+EXPIRY_RETRY_SECONDS = 3600  # eslatma yuborilmagan qatorlarni qayta tekshirish (_WARNED_CACHE bilan bir xil)
+ADMIN_WARN_SECONDS = 2 * 24 * 60 * 60  # adminlarga 2 kun oldin eslatma
+
+EXPIRY_FAR_FUTURE = 2 ** 62
+
+# (due_at, source, user_id, group_id, expires_at); source: users | user_groups | admins | sweep | reload
+_EXPIRY_HEAP: list[tuple[int, str, int, int, int]] = []
+_EXPIRY_WAKE = asyncio.Event()
+_EXPIRY_LAST_RUN = 0
+
+# Keyingi muddatlar: expires_at oralig'i bo'yicha LIMIT bilan (idx_*_expiry_scan / idx_admins_expires)
+EXPIRY_NEXT_SQL = {
+    "users": """
+        SELECT user_id, group_id, expires_at FROM users
+        WHERE expires_at > 0 AND expires_at > $1 AND expires_at <= $2
+        ORDER BY expires_at LIMIT $3
+    """,
+    "user_groups": """
+        SELECT user_id, group_id, expires_at FROM user_groups
+        WHERE expires_at > 0 AND expires_at > $1 AND expires_at <= $2
+        ORDER BY expires_at LIMIT $3
+    """,
+    "subscriptions": """
+        SELECT user_id, group_id, expires_at FROM subscriptions
+        WHERE expires_at > 0 AND expires_at > $1 AND expires_at <= $2
+        ORDER BY expires_at LIMIT $3
+    """,
+    "admins": """
+        SELECT user_id, 0::BIGINT AS group_id, expires_at FROM admins
+        WHERE active = TRUE AND expires_at > $1 AND expires_at <= $2
+        ORDER BY expires_at LIMIT $3
+    """,
+}
+
+def _expiry_due_at(source: str, expires_at: int, last_warning: Optional[int] = None) -> int:
+    """Qator qachon eslatma tekshiruviga tushishini hisoblash."""
+    rewarn_at = (last_warning or 0) + 86401
+    if source == "admins":
+        return min(expires_at + 1, max(expires_at - ADMIN_WARN_SECONDS + 1, rewarn_at))
+    return max(expires_at - REMIND_DAYS * 86400, rewarn_at)
+
+def _expiry_job(source: str, expires_at: int, now: int) -> str:
+    """Muddati kelgan qator uchun qaysi tekshiruv kerakligini aniqlash."""
+    if source == "admins":
+        return "admins_expired" if expires_at < now else "admins_warn"
+    return f"{source}_soon" if expires_at > now else f"{source}_expired"
+
+def rearm_expiry(source: str, uid: int, gid: Optional[int], expires_at: Optional[int]):
+    """Yangi yoki uzaytirilgan muddatni scheduler'ga qo'shish.
+    
+    Approve, renew va join handlerlari (upsert_user, add_user_group, approve_renewal_payment,
+    add_admin_to_db, extend_admin ...) orqali chaqiriladi.
+    """
+    if not expires_at:
+        return
+    due_at = _expiry_due_at(source, expires_at)
+    heapq.heappush(_EXPIRY_HEAP, (due_at, source, uid, gid or 0, expires_at))
+    if _EXPIRY_HEAP[0][0] == due_at:
+        _EXPIRY_WAKE.set()
+
+async def _next_deadlines(conn, table: str, source: str, window: int, now: int) -> tuple[list[tuple], int]:
+    """Bitta jadvalning keyingi muddatlari va ular ishonchli bo'lgan chegara (horizon).
+    
+    Ikki oraliq o'qiladi: eslatma oynasi ichidagilar (now, now+window] - faqat tugash
+    vaqti; oynadan keyingilar - eslatma va tugash vaqti. LIMIT'ga yetgan oraliqda
+    yuklanmagan qatorlar horizon'dan oldin tekshiruvga tushmaydi.
+    """
+    sql = EXPIRY_NEXT_SQL[table]
+    entries: list[tuple] = []
+    horizon = EXPIRY_FAR_FUTURE
+    
+    rows = await conn.fetch(sql, now, now + window, EXPIRY_PRELOAD)
+    for r in rows:
+        entries.append((r['expires_at'] + 1, source, r['user_id'], r['group_id'], r['expires_at']))
+    if len(rows) == EXPIRY_PRELOAD:
+        horizon = min(horizon, rows[-1]['expires_at'] + 1)
+    
+    rows = await conn.fetch(sql, now + window, EXPIRY_FAR_FUTURE, EXPIRY_PRELOAD)
+    for r in rows:
+        exp = r['expires_at']
+        entries.append((_expiry_due_at(source, exp), source, r['user_id'], r['group_id'], exp))
+        entries.append((exp + 1, source, r['user_id'], r['group_id'], exp))
+    if len(rows) == EXPIRY_PRELOAD:
+        horizon = min(horizon, _expiry_due_at(source, rows[-1]['expires_at']))
+    return entries, horizon
+
+async def load_expiry_deadlines():
+    """Keyingi muddatlarni database'dan heap'ga yuklash (har jadvalda index bo'yicha LIMIT)."""
+    now = int(datetime.utcnow().timestamp())
+    # Yagona jadval: 'users' job'lari unified skanni ishga tushiradi
+    tables = [("subscriptions", "users")] if SUBSCRIPTIONS_READY else [("users", "users"), ("user_groups", "user_groups")]
+    tables.append(("admins", "admins"))
+    
+    loaded: set[tuple] = set()
+    horizon = EXPIRY_FAR_FUTURE
+    async with db_pool.acquire() as conn:
+        for table, source in tables:
+            window = ADMIN_WARN_SECONDS if source == "admins" else REMIND_DAYS * 86400
+            entries, table_horizon = await _next_deadlines(conn, table, source, window, now)
+            loaded.update(entries)
+            horizon = min(horizon, table_horizon)
+    
+    # rearm_expiry() orqali qo'shilgan (hali database'da ko'rinmagan) muddatlar ham saqlanadi;
+    # horizon'dan keyingilar keyingi yuklashda qayta o'qiladi
+    merged = {e for e in loaded | set(_EXPIRY_HEAP) if e[1] != "reload" and e[0] <= horizon}
+    if horizon < EXPIRY_FAR_FUTURE:
+        merged.add((horizon, "reload", 0, 0, 0))
+    _EXPIRY_HEAP[:] = list(merged)
+    heapq.heapify(_EXPIRY_HEAP)
+    if _EXPIRY_HEAP:
+        logger.info(f"Expiry scheduler: {len(_EXPIRY_HEAP)} deadlines loaded, next at {_EXPIRY_HEAP[0][0]}")
+
+async def wait_next_expiry() -> Optional[set[str]]:
+    """Eng yaqin muddatgacha uxlash.
+    
+    Returns:
+        Bajariladigan tekshiruvlar to'plami yoki None (to'liq tekshiruv)
+    """
+    sweep_at = _EXPIRY_LAST_RUN + EXPIRY_MAX_SLEEP
+    while True:
+        _EXPIRY_WAKE.clear()
+        now = int(datetime.utcnow().timestamp())
+        next_at = min(_EXPIRY_HEAP[0][0], sweep_at) if _EXPIRY_HEAP else sweep_at
+        if next_at <= now:
+            break
+        try:
+            await asyncio.wait_for(_EXPIRY_WAKE.wait(), timeout=next_at - now)
+        except asyncio.TimeoutError:
+            pass
+    
+    # Muddatlar zich bo'lsa ham tekshiruvlar EXPIRY_MIN_INTERVAL dan tez-tez bo'lmasin
+    now = int(datetime.utcnow().timestamp())
+    if now < _EXPIRY_LAST_RUN + EXPIRY_MIN_INTERVAL:
+        await asyncio.sleep(_EXPIRY_LAST_RUN + EXPIRY_MIN_INTERVAL - now)
+        now = int(datetime.utcnow().timestamp())
+    
+    jobs: set[str] = set()
+    full = now >= sweep_at
+    while _EXPIRY_HEAP and _EXPIRY_HEAP[0][0] <= now:
+        _due, source, _uid, _gid, expires_at = heapq.heappop(_EXPIRY_HEAP)
+        if source == "sweep":
+            full = True
+        elif source != "reload":
+            jobs.add(_expiry_job(source, expires_at, now))
+    return None if full else jobs
+
+async def run_expiry_jobs(jobs: Optional[set[str]] = None) -> int:
+    """Muddati kelgan tekshiruvlarni bajarish (None - hammasi).
+    
+    Returns:
+        Qayta urinish kerak bo'lgan (vaqtinchalik xatolik) qatorlar soni
+    """
+    def wanted(job: str) -> bool:
+        return jobs is None or job in jobs
+    
+    failed = 0
+    
+    # Admin muddati tugashini tekshirish
+    if wanted("admins_expired"):
+        try:
+            await check_expired_admins()
+        except Exception:
+            logger.exception("check_expired_admins failed")
+    
+    # Admin muddati tugashidan 2 kun oldin eslatma
+    if wanted("admins_warn"):
+        try:
+            await send_expiry_warnings()
+        except Exception:
+            logger.exception("send_expiry_warnings failed")
+    
+    # O'quvchilar uchun - barcha muddati kelgan qatorlar yig'ilib, parallel yuboriladi
+    items: list[tuple[int, int, int, str]] = []
+    legacy = not SUBSCRIPTIONS_READY
+    if not legacy:
+        # Yagona jadval: users va user_groups uchun bitta skan
+        if wanted("users_soon") or wanted("user_groups_soon"):
             try:
-                for uid, gid, exp_at in await expired_users():
-                    await _warn_and_buttons(uid, gid, exp_at, reason="expired")
+                items += [(uid, gid, exp_at, "soon") for uid, gid, exp_at in await soon_expiring_subscriptions(REMIND_DAYS)]
             except Exception:
-                logger.exception("expired_users failed")
+                logger.exception("soon_expiring_subscriptions failed")
+        if wanted("users_expired") or wanted("user_groups_expired"):
             try:
-                for uid, gid, exp_at in await expired_user_groups():
-                    await _warn_and_buttons(uid, gid, exp_at, reason="expired")
+                items += [(uid, gid, exp_at, "expired") for uid, gid, exp_at in await expired_subscriptions()]
             except Exception:
-                logger.exception("expired_user_groups failed")
-            await asyncio.sleep(60)
+                logger.exception("expired_subscriptions failed")
+    
+    if legacy and wanted("users_soon"):
+        try:
+            items += [(uid, gid, exp_at, "soon") for uid, gid, exp_at in await soon_expiring_users(REMIND_DAYS)]
+        except Exception:
+            logger.exception("soon_expiring_users failed")
+    if legacy and wanted("user_groups_soon"):
+        try:
+            items += [(uid, gid, exp_at, "soon") for uid, gid, exp_at in await soon_expiring_user_groups(REMIND_DAYS)]
+        except Exception:
+            logger.exception("soon_expiring_user_groups failed")
+    if legacy and wanted("users_expired"):
+        try:
+            items += [(uid, gid, exp_at, "expired") for uid, gid, exp_at in await expired_users()]
+        except Exception:
+            logger.exception("expired_users failed")
+    if legacy and wanted("user_groups_expired"):
+        try:
+            items += [(uid, gid, exp_at, "expired") for uid, gid, exp_at in await expired_user_groups()]
+        except Exception:
+            logger.exception("expired_user_groups failed")
+    
+    try:
+        failed = await fan_out_warnings(items)
+    except Exception:
+        logger.exception("fan_out_warnings failed")
+    
+    return failed
+
+async def auto_kick_loop():
+    global _EXPIRY_LAST_RUN
+    await asyncio.sleep(5)
+    jobs: Optional[set[str]] = None  # startup'da to'liq tekshiruv
+    while True:
+        try:
+            started = int(datetime.utcnow().timestamp())
+            failed = await run_expiry_jobs(jobs)
+            _EXPIRY_LAST_RUN = started
+            # Vaqtinchalik xatolik bo'lgan qatorlar bir soatdan keyin qayta tekshiriladi
+            # (ishlangan va guruhda yo'q qatorlar last_warning_sent_at bilan belgilangan)
+            if failed:
+                heapq.heappush(_EXPIRY_HEAP, (started + EXPIRY_RETRY_SECONDS, "sweep", 0, 0, 0))
+            await load_expiry_deadlines()
+            jobs = await wait_next_expiry()
         except Exception as e:
             logger.exception(e)
             await asyncio.sleep(10)
+            jobs = None
 
 @dp.callback_query(F.data.startswith("warn_paid:"))
 async def cb_warn_paid(c: CallbackQuery):
@@ -7054,8 +9277,8 @@ async def cb_warn_notpaid(c: CallbackQuery):
             return await c.answer("❌ Sizga bu guruhga ruxsat yo'q!", show_alert=True)
         
         key = (uid, gid)
-        count = NOT_PAID_COUNTER.get(key, 0) + 1
-        NOT_PAID_COUNTER[key] = count
+        count = state_get(NOT_PAID_COUNTER, key, 0) + 1
+        state_set(NOT_PAID_COUNTER, key, count)
         
         if count >= 3:
             # User guruhda borligini va admin emasligini tekshirish
@@ -7070,7 +9293,7 @@ async def cb_warn_notpaid(c: CallbackQuery):
                 # User guruhda emas bo'lsa, skip qilamiz
                 if member.status not in ("member", "administrator", "creator"):
                     await c.message.answer(f"ℹ️ Foydalanuvchi {uid} guruhda emas. Chiqarish kerak emas.")
-                    NOT_PAID_COUNTER.pop(key, None)
+                    state_pop(NOT_PAID_COUNTER, key)
                     return await c.answer("Guruhda emas")
                     
             except Exception as e:
@@ -7099,13 +9322,13 @@ async def cb_warn_notpaid(c: CallbackQuery):
             try:
                 # Ban qilib, keyin unban qilish = kick
                 await bot.ban_chat_member(chat_id=gid, user_id=uid)
-                await asyncio.sleep(0.5)  # Biroz kutamiz
                 await bot.unban_chat_member(chat_id=gid, user_id=uid)
+                invalidate_member_status(gid, uid)
                 
                 # Database'dan tozalash
                 await clear_user_group(uid, gid)
                 await clear_user_group_extra(uid, gid)
-                NOT_PAID_COUNTER.pop(key, None)
+                state_pop(NOT_PAID_COUNTER, key)
                 
                 await c.message.answer(f"✅ Foydalanuvchi {uid} guruhdan chiqarildi (3 marta to'lov qilmagan).")
                 logger.info(f"User {uid} kicked from group {gid} by admin {c.from_user.id}")
@@ -7231,6 +9454,7 @@ async def cb_warn_kick(c: CallbackQuery):
             # Endi guruhdan chiqarish
             await bot.ban_chat_member(gid, uid)
             await bot.unban_chat_member(gid, uid)
+            invalidate_member_status(gid, uid)
             await clear_user_group(uid, gid)
             await clear_user_group_extra(uid, gid)
             
@@ -7293,14 +9517,15 @@ async def cb_warn_kick(c: CallbackQuery):
 @dp.callback_query(F.data == "contract_agree")
 async def cb_contract_agree(c: CallbackQuery):
     """Shartnoma tasdiqlash."""
-    if c.from_user.id not in WAIT_CONTRACT_CONFIRM:
+    if not state_has(WAIT_CONTRACT_CONFIRM, c.from_user.id):
         return await c.answer("Sessiya topilmadi", show_alert=True)
     
     try:
         # Shartnomani tasdiqlash
         await update_user_agreed(c.from_user.id, int(datetime.utcnow().timestamp()))
-        WAIT_CONTRACT_CONFIRM.discard(c.from_user.id)
-        WAIT_CONTACT_FOR.add(c.from_user.id)
+        state_pop(WAIT_CONTRACT_CONFIRM, c.from_user.id)
+        state_set(WAIT_CONTACT_FOR, c.from_user.id)
+        await state_commit()
         
         # Telefon so'rash
         await c.message.answer(
@@ -7322,8 +9547,9 @@ async def cb_contract_agree(c: CallbackQuery):
 @dp.callback_query(F.data == "contract_decline")
 async def cb_contract_decline(c: CallbackQuery):
     """Shartnomani rad etish."""
-    if c.from_user.id in WAIT_CONTRACT_CONFIRM:
-        WAIT_CONTRACT_CONFIRM.discard(c.from_user.id)
+    if state_has(WAIT_CONTRACT_CONFIRM, c.from_user.id):
+        state_pop(WAIT_CONTRACT_CONFIRM, c.from_user.id)
+        await state_commit()
     
     await c.message.answer(
         "❌ <b>Shartnoma rad etildi</b>\n\n"
@@ -7356,7 +9582,7 @@ async def cb_reg_approve_now(c: CallbackQuery):
         # User ma'lumotlarini olish
         user_row = await get_user(user_id)
         username, fullname = await fetch_user_profile(user_id)
-        phone = user_row[5] if user_row and len(user_row) > 5 else "yo'q"
+        phone = user_row.phone if user_row else "yo'q"
         
         # Adminning birinchi ruxsat etilgan guruhiga qo'shish (primary)
         primary_gid = allowed_groups[0]
@@ -7409,7 +9635,8 @@ async def cb_reg_approve_date(c: CallbackQuery):
             return await c.answer("❌ Sizga hech qanday guruhga ruxsat yo'q!", show_alert=True)
         
         # Admin'dan sanani so'rash
-        WAIT_DATE_FOR[c.from_user.id] = user_id  # User ID ni payment ID o'rniga ishlatamiz
+        state_set(WAIT_DATE_FOR, c.from_user.id, user_id)  # User ID ni payment ID o'rniga ishlatamiz
+        await state_commit()
         
         await c.message.edit_text(
             "📅 *Obuna boshlanish sanasini kiriting:*\n\n"
@@ -7458,16 +9685,134 @@ async def cb_reg_reject(c: CallbackQuery):
         logger.error(f"Error in cb_reg_reject: {e}")
         await c.answer("Xatolik yuz berdi", show_alert=True)
 
+# ==================== RUNTIME: POLLING / WEBHOOK ====================
+# BOT_MODE=webhook bo'lsa Telegram update'larni o'zi yuboradi (aiohttp server),
+# aks holda odatdagi long polling ishlatiladi.
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # tashqi manzil, masalan https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # webhook rejimida majburiy
+WEBHOOK_SECRET_RE = re.compile(r"^[A-Za-z0-9_-]{1,256}$")  # Telegram secret_token formati
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_DRAIN_TIMEOUT = int(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+# chat_member update'larini qabul qilish uchun allowed_updates qo'shildi
+ALLOWED_UPDATES = ["message", "callback_query", "chat_member"]
+
+async def run_webhook():
+    """Webhook rejimi: aiohttp server + WEBHOOK_WORKERS ta update worker.
+    
+    Uzoq handlerlar (cmd_subscribers, cb_group_users) bitta worker'ni band qiladi,
+    qolgan update'lar boshqa worker'larda ishlanadi. SIGTERM/SIGINT kelganda yangi
+    so'rovlar qabul qilinmaydi, navbatdagi update'lar tugatiladi (graceful drain).
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_MODE=webhook uchun WEBHOOK_URL kerak")
+    # Secret'siz endpoint'ga har kim soxta update (masalan, to'lov tasdig'i) yubora oladi
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("BOT_MODE=webhook uchun WEBHOOK_SECRET kerak")
+    if not WEBHOOK_SECRET_RE.match(WEBHOOK_SECRET):
+        raise RuntimeError("WEBHOOK_SECRET faqat A-Z, a-z, 0-9, _ va - belgilaridan iborat bo'lishi kerak (1-256 ta)")
+    
+    queue: asyncio.Queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    
+    async def handle_update(request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(), WEBHOOK_SECRET.encode()):
+            logger.warning(f"Webhook request with invalid secret token from {request.remote}")
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except Exception as e:
+            logger.warning(f"Invalid webhook payload: {e}")
+            return web.Response(status=400)
+        # Navbat to'lsa kutamiz - Telegram javobni kutib, keyinroq qayta yuboradi
+        await queue.put(update)
+        return web.Response()
+    
+    async def worker(n: int):
+        while True:
+            update = await queue.get()
+            try:
+                await dp.feed_update(bot, update)
+            except Exception:
+                logger.exception(f"Webhook worker {n} failed on update {update.update_id}")
+            finally:
+                queue.task_done()
+    
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    
+    workers = [asyncio.create_task(worker(n)) for n in range(WEBHOOK_WORKERS)]
+    await dp.emit_startup(bot=bot)
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=ALLOWED_UPDATES,
+    )
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH} with {WEBHOOK_WORKERS} workers")
+    
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    
+    try:
+        await stop.wait()
+    finally:
+        # 1. Yangi so'rovlarni qabul qilmaslik (webhook o'chirilmaydi - boshqa replica'lar ishlayveradi)
+        logger.info(f"Shutting down webhook server, draining {queue.qsize()} queued update(s)")
+        await runner.cleanup()
+        # 2. Navbatdagi update'larni tugatish
+        try:
+            await asyncio.wait_for(queue.join(), timeout=WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Drain timeout: {queue.qsize()} update(s) left unprocessed")
+        for task in workers:
+            task.cancel()
+        await dp.emit_shutdown(bot=bot)
+
 async def main():
     logger.info("Starting bot...")
     await db_init()
+    try:
+        await load_conversation_state()
+    except Exception as e:
+        logger.warning(f"Failed to load conversation state: {e}")
+    asyncio.create_task(conversation_state_loop())
+    asyncio.create_task(conversation_state_listener_loop())
+    asyncio.create_task(outbox_dispatcher_loop())
+    asyncio.create_task(backfill_subscriptions())
     asyncio.create_task(auto_kick_loop())
-    logger.info("Bot is now polling for updates")
+    asyncio.create_task(group_titles_refresh_loop())
+    asyncio.create_task(dashboard_refresh_loop())
+    asyncio.create_task(dashboard_listener_loop())
+    asyncio.create_task(config_listener_loop())
     try:
-        # chat_member update'larini qabul qilish uchun allowed_updates qo'shildi
-        await dp.start_polling(bot, allowed_updates=["message", "callback_query", "chat_member"])
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            logger.info("Bot is now polling for updates")
+            # Polling rejimida Telegram'da eski webhook qolmasligi kerak
+            await bot.delete_webhook()
+            await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
     finally:
+        _CONTRACT_EXECUTOR.shutdown(wait=False, cancel_futures=True)
         if db_pool:
+            # Write-behind buferidagi oxirgi o'zgarishlarni yozib qo'yish
+            try:
+                await flush_conversation_state()
+            except Exception as e:
+                logger.warning(f"Failed to flush conversation state on shutdown: {e}")
             await db_pool.close()
             logger.info("Database connection pool closed")
 
@@ -0,0 +1,40 @@
+"""Per-chat Telegram rate limiter buckets must not grow without bound."""
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip("asyncpg")
+pytest.importorskip("aiogram")
+
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/test")
+
+import main  # noqa: E402
+
+EXTRA = 50
+
+
+async def _fill_and_add(idle_seconds: float) -> int:
+    """Use TG_CHAT_BUCKETS_MAX + EXTRA chat buckets, let them idle, then open one more chat."""
+    main._TG_CHAT_BUCKETS.clear()
+    try:
+        for chat_id in range(1, main.TG_CHAT_BUCKETS_MAX + EXTRA + 1):
+            await main.take_token(main._tg_chat_bucket(chat_id))
+        now = asyncio.get_running_loop().time()
+        for bucket in main._TG_CHAT_BUCKETS.values():
+            bucket["ts"] = now - idle_seconds
+        main._tg_chat_bucket(10 ** 9)
+        return len(main._TG_CHAT_BUCKETS)
+    finally:
+        main._TG_CHAT_BUCKETS.clear()
+
+
+def test_idle_chat_buckets_are_evicted():
+    # 1 msg/s, burst 1: after 1.2 s every used bucket is full again
+    assert asyncio.run(_fill_and_add(1.2)) == 1
+
+
+def test_busy_chat_buckets_are_kept():
+    total = main.TG_CHAT_BUCKETS_MAX + EXTRA
+    assert asyncio.run(_fill_and_add(0.0)) == total + 1